@@ -0,0 +1,298 @@
+# Honeyguide - a program for injecting image stack data into CreationWorkshop CWS files.
+# benchmark.py - times Honeyguide jobs on synthetic templates and slice stacks, and checks for slowdowns.
+#
+# Ben Weiss at the University of Washington
+#
+# Usage: python benchmark.py [options]; see --help. For example
+#     python benchmark.py --layers 100,1000 --sizes 1920x1080,3840x2160 --engine builtin --save-baseline
+# times every combination of layer count, projector size and variant (plain, mask, threshold, repeat_first), prints
+# the results as they finish and saves them all to a JSON file. Later runs with the same cases compare their slices
+# per second against the saved baseline and exit with status 1 if any case got slower by more than --max-regression
+# percent.
+#
+# The synthetic data is a stack of cone cross sections (a filled, slowly shrinking gray disc per layer) and a CWS
+# template with a manifest, gcode, slicing profile and a black slice per layer. It only needs the standard library to
+# make, and is kept in the work folder between runs.
+#
+# (c) 2015 Ben Weiss
+# License: MIT License:
+#
+#    Copyright (c) 2015 Ben Weiss; parts (c) 2015 Ben Weiss, University of Washington
+#
+#
+#    Permission is hereby granted, free of charge, to any person obtaining a
+#    copy of this software and associated documentation files (the "Software"),
+#    to deal in the Software without restriction, including without limitation
+#    the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#    and/or sell copies of the Software, and to permit persons to whom the
+#    Software is furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included
+#    in all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#    THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#    FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#    DEALINGS IN THE SOFTWARE.
+#
+#-------------------------------------------------------------------------------
+
+__author__ = 'Ben Weiss'
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import zipfile
+import zlib
+
+import cws_scripts
+
+VARIANTS = ["plain", "mask", "threshold", "repeat_first"]
+
+benchmark_path = os.path.join(cws_scripts.settings_path, "benchmarks")
+
+
+def png_bytes(width, height, rows):
+    """Returns the contents of an 8-bit grayscale png file of width x height, from rows, an iterable of height strings
+    of width bytes each."""
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+    raw = "".join("\x00" + row for row in rows)     # filter type 0 (none) on every row
+    return ("\x89PNG\r\n\x1a\n" +
+            chunk("IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)) +
+            chunk("IDAT", zlib.compress(raw, 1)) +
+            chunk("IEND", ""))
+
+
+def disc_rows(width, height, radius, value):
+    """Yields the rows of a black image with a disc of radius pixels and gray level value in the middle."""
+    spans = {}
+    for y in range(height):
+        dy = y - height / 2 + 0.5
+        half = int(math.sqrt(radius * radius - dy * dy)) if abs(dy) < radius else 0
+        if half not in spans:
+            left = max(width / 2 - half, 0)
+            right = min(width / 2 + half, width)
+            spans[half] = "\x00" * left + chr(value) * (right - left) + "\x00" * (width - right)
+        yield spans[half]
+
+
+def make_template(fname, name, layers, width, height):
+    """Writes a synthetic CWS template with layers black slices of width x height, named like Creation Workshop
+    names them (name0000.png, ...)."""
+    zf = zipfile.ZipFile(fname, "w")
+    try:
+        black = png_bytes(width, height, ["\x00" * width] * height)
+        for i in range(layers):
+            zf.writestr("%s%04i.png" % (name, i), black)
+        zf.writestr("manifest.xml",
+                    '<?xml version="1.0" encoding="utf-8"?>\n<manifest FileVersion="1">\n  <Slices>\n' +
+                    "".join("    <Slice>\n      <name>%s%04i.png</name>\n    </Slice>\n" % (name, i)
+                            for i in range(layers)) +
+                    "  </Slices>\n</manifest>\n")
+        zf.writestr("%s.gcode" % name,
+                    ";(X Resolution            = %i )\n;(Y Resolution            = %i )\n"
+                    ";(Layer Thickness         = 0.10000 mm )\n;Number of Slices        =  %i\n" % (width, height, layers) +
+                    "".join(";<Slice> %i \n;<Delay> 12000\n;<Slice> Blank \ng01z0.1\n" % i for i in range(layers)))
+        zf.writestr("default.slicing",
+                    '<?xml version="1.0" encoding="utf-8"?>\n<SliceBuildConfig FileVersion="2">\n'
+                    "  <XResolution>%i</XResolution>\n  <YResolution>%i</YResolution>\n</SliceBuildConfig>\n" %
+                    (width, height))
+    finally:
+        zf.close()
+
+
+def make_stack(folder, layers, width, height):
+    """Writes layers slice images of width x height into folder as slice0000.png, ... Returns the first one."""
+    top = min(width, height) * 0.45
+    for i in range(layers):
+        radius = top * (1. - 0.8 * i / max(layers - 1, 1))
+        value = 96 + (159 * i) / max(layers - 1, 1)      # so thresholds cut somewhere in the middle
+        with open(os.path.join(folder, "slice%04i.png" % i), "wb") as fout:
+            fout.write(png_bytes(width, height, disc_rows(width, height, radius, value)))
+    return os.path.join(folder, "slice0000.png")
+
+
+def make_mask(fname, width=640, height=360):
+    """Writes a vignette mask (bright in the middle, darker towards the corners), at a lower resolution than the
+    slices as real masks usually are."""
+    rows = []
+    for y in range(height):
+        dy = (y - height / 2.) / height
+        rows.append("".join(chr(255 - int(160 * min(1., 2 * (dy * dy + ((x - width / 2.) / width) ** 2))))
+                            for x in range(width)))
+    with open(fname, "wb") as fout:
+        fout.write(png_bytes(width, height, rows))
+
+
+def case_data(workdir, layers, width, height):
+    """Returns (template, first slice, mask) for a case, making them in workdir if they aren't there already."""
+    folder = os.path.join(workdir, "%i_%ix%i" % (layers, width, height))
+    template = os.path.join(folder, "bench.cws")
+    first_slice = os.path.join(folder, "stack", "slice0000.png")
+    mask = os.path.join(workdir, "mask.png")
+    if not os.path.exists(mask):
+        make_mask(mask)
+    if not os.path.exists(os.path.join(folder, "complete")):
+        print("Making %i layers at %ix%i..." % (layers, width, height))
+        if os.path.exists(folder):
+            shutil.rmtree(folder)
+        os.makedirs(os.path.join(folder, "stack"))
+        make_stack(os.path.join(folder, "stack"), layers, width, height)
+        make_template(template, "bench", layers, width, height)
+        open(os.path.join(folder, "complete"), "w").close()
+    return template, first_slice, mask
+
+
+def run_case(args, workdir, layers, width, height, variant):
+    """Runs one job and returns its result as a dictionary."""
+    template, first_slice, mask = case_data(workdir, layers, width, height)
+    output = os.path.join(workdir, "out.cws")
+
+    h = cws_scripts.Honeyguide()
+    h.quiet = True
+    h.echo = False
+    h.timing = True
+    h.slice_cache_bytes = 0     # we're timing the conversion, not the cache
+    h.imagemagick_cmd = args.imagemagick
+    h.engine = args.engine
+    h.streaming = args.streaming
+    h.workers = args.workers
+    h.use_mask = variant == "mask"
+    h.mask_image = mask
+    h.threshold = variant == "threshold"
+    h.threshold_val = 50
+    h.repeat_first = variant == "repeat_first"
+
+    success, message = h.do_honeyguide(template, first_slice, output)
+    if os.path.exists(output):
+        os.remove(output)
+    report = h.timing_report
+    return {"case": case_name(args, layers, width, height, variant),
+            "success": success,
+            "message": message,
+            "wall": report["wall"],
+            "slices_per_sec": round(layers / report["wall"], 3) if report["wall"] > 0 else 0.,
+            "timing": report}
+
+
+def case_name(args, layers, width, height, variant):
+    return "%s layers=%i size=%ix%i engine=%s workers=%i streaming=%i" % \
+           (variant, layers, width, height, args.engine, args.workers, args.streaming)
+
+
+def compare(results, baseline, max_regression):
+    """Compares results against baseline (both lists of run_case results). Returns a list of messages for the cases
+    whose throughput dropped by more than max_regression percent."""
+    before = dict((result["case"], result) for result in baseline)
+    regressions = []
+    for result in results:
+        old = before.get(result["case"])
+        if old is None or old["slices_per_sec"] <= 0:
+            continue
+        change = 100. * (result["slices_per_sec"] - old["slices_per_sec"]) / old["slices_per_sec"]
+        if change < -max_regression:
+            regressions.append("%s: %.1f slices/s, was %.1f (%.0f%%)" %
+                               (result["case"], result["slices_per_sec"], old["slices_per_sec"], change))
+    return regressions
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Times Honeyguide on synthetic templates and slice stacks.")
+    parser.add_argument("--layers", default="100", help="comma separated layer counts (default 100)")
+    parser.add_argument("--sizes", default="1280x800,1920x1080",
+                        help="comma separated projector sizes (default 1280x800,1920x1080)")
+    parser.add_argument("--variants", default=",".join(VARIANTS),
+                        help="comma separated variants out of %s (default all)" % ", ".join(VARIANTS))
+    parser.add_argument("--engine", default="builtin", choices=["imagemagick", "imagemagick_batch", "builtin"],
+                        help="how slices are converted (default builtin)")
+    parser.add_argument("--imagemagick", default="magick", help="ImageMagick command (default magick)")
+    parser.add_argument("--workers", type=int, default=1, help="slices to convert at the same time (default 1)")
+    parser.add_argument("--streaming", action="store_true", help="stream the CWS files instead of extracting them")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per case; the fastest counts (default 1)")
+    parser.add_argument("--workdir", help="folder for the synthetic data, kept between runs (default: a temporary "
+                                          "folder that's deleted afterwards)")
+    parser.add_argument("--results", help="file to save the results to (default: a time stamped file in %s)" %
+                                          benchmark_path)
+    parser.add_argument("--baseline", default=os.path.join(benchmark_path, "baseline.json"),
+                        help="results to compare against (default %(default)s)")
+    parser.add_argument("--save-baseline", action="store_true", help="save these results as the new baseline")
+    parser.add_argument("--max-regression", type=float, default=10.,
+                        help="fail if a case is this many percent slower than the baseline (default 10)")
+    args = parser.parse_args(argv)
+
+    try:
+        args.layers = [int(layers) for layers in args.layers.split(",")]
+        args.sizes = [tuple(int(n) for n in size.lower().split("x")) for size in args.sizes.split(",")]
+        if any(len(size) != 2 for size in args.sizes):
+            raise ValueError
+    except ValueError:
+        parser.error("layers are whole numbers and sizes look like 1920x1080")
+    args.variants = args.variants.split(",")
+    for variant in args.variants:
+        if variant not in VARIANTS:
+            parser.error("unknown variant %s" % variant)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    workdir = args.workdir or tempfile.mkdtemp()
+    if not os.path.exists(workdir):
+        os.makedirs(workdir)
+
+    results = []
+    try:
+        for layers in args.layers:
+            for width, height in args.sizes:
+                for variant in args.variants:
+                    runs = [run_case(args, workdir, layers, width, height, variant) for i in range(args.repeat)]
+                    result = max(runs, key=lambda run: run["slices_per_sec"])
+                    results.append(result)
+                    stages = ", ".join("%s %.2fs" % (stage["stage"], stage["wall"])
+                                       for stage in result["timing"]["stages"] if stage["wall"] >= 0.01)
+                    print("%s: %.2fs, %.1f slices/s (%s)%s" % (result["case"], result["wall"],
+                                                               result["slices_per_sec"], stages,
+                                                               "" if result["success"] else " FAILED: %s" %
+                                                               result["message"]))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, True)
+
+    if not os.path.exists(benchmark_path):
+        os.makedirs(benchmark_path)
+    results_file = args.results or os.path.join(benchmark_path, time.strftime("results-%Y%m%d-%H%M%S.json"))
+    with open(results_file, "w") as fout:
+        json.dump(results, fout, indent=1, sort_keys=True)
+    print("Results saved to %s" % results_file)
+
+    status = 0 if all(result["success"] for result in results) else 1
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as fin:
+            regressions = compare(results, json.load(fin), args.max_regression)
+        for regression in regressions:
+            print("Slower than the baseline: %s" % regression)
+        if regressions:
+            status = 1
+        else:
+            print("No case is more than %g%% slower than the baseline." % args.max_regression)
+    if args.save_baseline:
+        shutil.copy(results_file, args.baseline)
+        print("Saved as the baseline.")
+    return status
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
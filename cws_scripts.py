@@ -45,12 +45,47 @@ import shutil
 import threading
 import Queue
 import difflib
+import io
+import time
+import collections
+import functools
+import itertools
+import multiprocessing
+import multiprocessing.pool
+import struct
+import hashlib
+import json
+import xml.etree.ElementTree as ElementTree
+
+import image_engine
 
 on_posix = 'posix' in os.name
 
 # regular expressions we'll need:
 re_match_path = re.compile(".*[\\\\/]+(?!.*[\\\\/])")
 re_match_last_number = re.compile(r"([0-9]+)(?!.*[0-9])")
+re_match_cws_slice = re.compile(r"(.*?)([0-9]{4})\.png$", re.IGNORECASE)
+re_match_gcode_slice = re.compile(r";\s*<Slice>\s*([0-9]+)\s*$")
+re_match_gcode_count = re.compile(r"(;\s*Number of Slices\s*=\s*)[0-9]+")
+re_match_gcode_delay = re.compile(r"(;\s*<Delay>\s*)[0-9.]+")
+re_match_gcode_move = re.compile(r"\s*G0?[01](?![0-9]).*Z", re.IGNORECASE)
+re_match_gcode_feed = re.compile(r"(F)[0-9.]+", re.IGNORECASE)
+re_match_profile_layers = re.compile(r"layers?\s+([0-9]+)\s*(?:(-)\s*([0-9]+)?)?$", re.IGNORECASE)
+re_match_profile_value = re.compile(r"([0-9.]+)(?:\s+to\s+([0-9.]+))?$")
+
+# A snapshot of a job's progress, as handed to Honeyguide.subscribe() callbacks and returned by Honeyguide.progress().
+#   stage - what the job is doing: 'starting', 'reading template', 'sizing', 'indexing stack', 'checking cache',
+#           'converting', 'blanking', 'writing', 'cleanup' or 'done'; or 'extracting' for Honeyguide.extract_slices
+#   slice, slice_count - how many slices of this stage are done, out of how many
+#   slices_per_sec - average rate over this stage so far (0 until there's something to measure)
+#   bytes_written - size of the output slices written so far
+#   eta - estimated seconds left in this stage, or None if unknown
+#   percent - overall progress, 0-100
+#   message - the latest status message
+#   done, success - whether the job has finished, and if so whether it succeeded (None while running)
+ProgressEvent = collections.namedtuple("ProgressEvent", ["stage", "slice", "slice_count", "slices_per_sec",
+                                                         "bytes_written", "eta", "percent", "message", "done",
+                                                         "success"])
 
 # Find a folder where we can put settings files and logs on whatever platform we find ourselves on. Thanks to
 # http://stackoverflow.com/questions/21761982/creating-a-folder-in-the-appdata-roaming-directory-python
@@ -63,19 +98,864 @@ if not os.path.exists(settings_path):
     os.makedirs(settings_path)
 
 
+def progress_text(event):
+    """Returns a one line description of a ProgressEvent for showing to the user, including the throughput and time
+    left while slices are being worked through."""
+    if event.done or event.slice_count == 0:
+        return event.message
+    text = "%s: slice %i/%i" % (event.stage.capitalize(), event.slice, event.slice_count)
+    if event.slices_per_sec > 0:
+        text += ", %.1f slices/s" % event.slices_per_sec
+    if event.eta is not None:
+        text += ", about %i s left" % int(event.eta + 0.5)
+    return text
+
+
+class StageTimer:
+    """Wall clock and CPU time spent in each stage of a job (see ProgressEvent for the stages), plus how long each
+    slice took to convert. CPU time includes child processes (e.g. ImageMagick) once they've finished, where the
+    platform reports it. It is the CPU time of the whole process, so it only belongs to the job when the job has the
+    process to itself; with cpu False (e.g. when several jobs run side by side) only wall clock time is reported."""
+
+    def __init__(self, cpu=True):
+        self.cpu = cpu
+        self.stages = collections.OrderedDict()     # stage -> [wall seconds, cpu seconds]
+        self.slice_times = []
+        self._start = self._stage_start = time.time()
+        self._cpu_start = self._stage_cpu = self.cpu_time()
+        self._stage = None
+
+    @staticmethod
+    def cpu_time():
+        times = os.times()
+        return times[0] + times[1] + times[2] + times[3]
+
+    def stage(self, stage):
+        """Ends the current stage and starts timing stage (None to just end the current one)."""
+        now, cpu = time.time(), self.cpu_time()
+        if self._stage is not None:
+            totals = self.stages.setdefault(self._stage, [0., 0.])
+            totals[0] += now - self._stage_start
+            totals[1] += cpu - self._stage_cpu
+        self._stage, self._stage_start, self._stage_cpu = stage, now, cpu
+
+    def slice(self, seconds):
+        """Records that a slice took seconds to convert."""
+        self.slice_times.append(seconds)
+
+    def report(self):
+        """Returns the timings as a dictionary that can be written out as JSON. The cpu entries are left out if the
+        timer isn't timing CPU."""
+        report = {"stages": [{"stage": stage, "wall": round(wall, 4)} for stage, (wall, cpu) in self.stages.items()],
+                  "wall": round(time.time() - self._start, 4)}
+        if self.cpu:
+            for entry, (wall, cpu) in zip(report["stages"], self.stages.values()):
+                entry["cpu"] = round(cpu, 4)
+            report["cpu"] = round(self.cpu_time() - self._cpu_start, 4)
+        if self.slice_times:
+            times = sorted(self.slice_times)
+
+            def percentile(p):
+                return round(times[min(len(times) - 1, int(p / 100. * len(times)))], 4)
+            report["slices"] = {"count": len(times),
+                                "mean": round(sum(times) / len(times), 4),
+                                "p50": percentile(50),
+                                "p90": percentile(90),
+                                "p99": percentile(99),
+                                "max": round(times[-1], 4)}
+        return report
+
+
+class SliceStack:
+    """Index of a numbered image stack, built from a single scan of the folder holding its first slice.
+
+    Members:
+      * first_slice - the filename the stack was built from
+      * numpad - how many digits the number in first_slice has; successive slices are numbered with the same padding
+      * slices - list of (number, filename) for each successive slice, starting at first_slice and stopping at the
+                 first missing number
+      * gaps - numbers missing between the first slice and the highest numbered file in the folder
+      * duplicates - numbers at or after the first slice with more than one file, e.g. slice1.png and slice001.png
+      * mixed_padding - filenames in the stack's numbering whose number isn't padded like first_slice's
+    A SliceStack with no slices means first_slice doesn't exist or doesn't have a number in its filename."""
+
+    # True for stacks held in a single file; see ContainerStack.
+    container = False
+
+    # stacks we've already scanned, by folder, so the GUI doesn't rescan every time it validates.
+    _cache = collections.OrderedDict()
+    _cache_size = 8
+    _cache_lock = threading.Lock()
+
+    def __init__(self, first_slice):
+        self.first_slice = first_slice
+        self.numpad = 0
+        self.slices = []
+        self.gaps = []
+        self.duplicates = []
+        self.mixed_padding = []
+
+        folder, basename = os.path.split(first_slice)
+        result = re_match_last_number.search(basename)
+        if result is None:
+            if os.path.exists(first_slice):
+                self.slices.append((0, first_slice))
+            return
+        self.numpad = result.end() - result.start()
+        first_id = int(result.group())
+        prefix = basename[:result.start()]
+        suffix = basename[result.end():]
+
+        try:
+            names = os.listdir(folder or os.curdir)
+        except OSError:
+            return
+
+        # group the names in the folder that only differ from first_slice in their number by number
+        match_name = re.compile(re.escape(os.path.normcase(prefix)) + "([0-9]+)" + re.escape(os.path.normcase(suffix)) + "$")
+        numbered = {}
+        for name in names:
+            result = match_name.match(os.path.normcase(name))
+            if result is not None:
+                numbered.setdefault(int(result.group(1)), []).append((result.group(1), name))
+
+        slice_id = first_id
+        while True:
+            expected = "%0*i" % (self.numpad, slice_id)
+            found = [name for digits, name in numbered.get(slice_id, []) if digits == expected]
+            if not found:
+                break
+            self.slices.append((slice_id, os.path.join(folder, found[0])))
+            slice_id += 1
+
+        later = [n for n in numbered if n >= first_id]
+        if later:
+            self.gaps = [n for n in range(slice_id, max(later)) if n not in numbered]
+        self.duplicates = sorted(n for n in later if len(numbered[n]) > 1)
+        self.mixed_padding = sorted(os.path.join(folder, name) for n in later for digits, name in numbered[n]
+                                    if digits != "%0*i" % (self.numpad, n))
+
+    @property
+    def paths(self):
+        """Filenames of the successive slices, in order."""
+        return [fname for number, fname in self.slices]
+
+    def problems(self):
+        """Returns a list of short messages describing anything odd about the stack's numbering."""
+        problems = []
+        if self.gaps:
+            problems.append("slice %i is missing so the slices after it are ignored" % self.gaps[0])
+        if self.duplicates:
+            problems.append("slice %i has more than one file" % self.duplicates[0])
+        if self.mixed_padding:
+            problems.append("%s isn't numbered like the first slice" % re_match_path.sub("", self.mixed_padding[0]))
+        return problems
+
+    @classmethod
+    def scan(cls, first_slice):
+        """Returns the SliceStack for first_slice, reusing the last scan of its folder if the folder hasn't changed."""
+        folder = os.path.abspath(os.path.dirname(first_slice) or os.curdir)
+        try:
+            mtime = os.path.getmtime(folder)
+        except OSError:
+            return cls(first_slice)
+        key = (os.path.normcase(os.path.abspath(first_slice)), mtime)
+        with cls._cache_lock:
+            stack = cls._cache.pop(key, None)
+            if stack is not None:
+                cls._cache[key] = stack
+                return stack
+        stack = cls(first_slice)
+        # folder times are coarse on some filesystems; don't trust a folder that may still be changing.
+        if time.time() - mtime > 2:
+            with cls._cache_lock:
+                cls._cache[key] = stack
+                while len(cls._cache) > cls._cache_size:
+                    cls._cache.popitem(last=False)
+        return stack
+
+
+# Zip stacks being read. Opened as slices are first read and closed when the last job holding them is done.
+zip_files = image_engine.SharedFiles(lambda fname: zipfile.ZipFile(fname, "r"))
+
+
+def read_zip_member(fname, name):
+    """Returns the contents of the file name inside the zip file fname, keeping the zip open for the next one."""
+    return zip_files.use(fname, lambda zf: zf.read(name))
+
+
+def compare_slice_data(data1, data2, diff_fname, displayed):
+    """Returns how many pixels differ between two slices given as the contents of their files, writing a diff image to
+    diff_fname if any do (see image_engine.compare_images), or None if one of them can't be read. Runs on the worker
+    processes of Honeyguide._compare_cws_archives."""
+    try:
+        return image_engine.compare_images(io.BytesIO(data1), io.BytesIO(data2), diff_fname, displayed)
+    except IOError:
+        return None
+
+
+class ContainerStack(SliceStack):
+    """A slice stack held in a single file (see stack_sources) rather than a folder of numbered files. It has the same
+    members as SliceStack, but slices holds (number, entry) where entry stands in for a slice filename in jobs; see
+    StackPage and StackMember. numpad is 0. The slices are indexed from the container's directory without decoding
+    any of them."""
+
+    container = True
+
+    def __init__(self, fname, slices, gaps=(), duplicates=()):
+        self.first_slice = fname
+        self.numpad = 0
+        self.slices = list(slices)
+        self.gaps = list(gaps)
+        self.duplicates = list(duplicates)
+        self.mixed_padding = []
+
+    def hold(self):
+        """Keeps the container open between slices until release() (see image_engine.SharedFiles)."""
+        self.files.hold(self.first_slice)
+
+    def release(self):
+        self.files.release(self.first_slice)
+
+
+class TiffStack(ContainerStack):
+    """The pages of a multi-page TIFF, in order."""
+
+    files = image_engine.tiff_files
+
+    @classmethod
+    def open(cls, fname):
+        """Returns the stack in fname, or None if it isn't a TIFF file with more than one page. (A single-page TIFF
+        is the first slice of a stack of numbered files.)"""
+        if os.path.splitext(fname)[1].lower() not in (".tif", ".tiff"):
+            return None
+        try:
+            pages = len(tiff_page_offsets(fname))
+        except (IOError, ValueError):
+            return None
+        if pages < 2:
+            return None
+        return cls(fname, [(i, StackPage(fname, i)) for i in range(pages)])
+
+
+class ZipStack(ContainerStack):
+    """The images in a zip file, in the order of the last number in their names. Like a folder of numbered files, the
+    stack starts at the lowest number and stops at the first missing one. A zip without any numbered images is taken
+    in name order."""
+
+    extensions = (".png", ".tif", ".tiff", ".bmp", ".gif", ".jpg", ".jpeg")
+    files = zip_files
+
+    @classmethod
+    def open(cls, fname):
+        """Returns the stack in fname, or None if it isn't a zip file."""
+        if os.path.splitext(fname)[1].lower() != ".zip":
+            return None
+        try:
+            zf = zipfile.ZipFile(fname, "r")
+            try:
+                infos = zf.infolist()
+            finally:
+                zf.close()
+        except (IOError, zipfile.BadZipfile):
+            return None
+
+        numbered = {}
+        unnumbered = []
+        for info in sorted(infos, key=lambda info: info.filename):
+            basename = info.filename.rsplit("/", 1)[-1]
+            if os.path.splitext(basename)[1].lower() not in cls.extensions or info.filename.startswith("__MACOSX/"):
+                continue
+            result = re_match_last_number.search(basename)
+            if result is None:
+                unnumbered.append(info)
+            else:
+                numbered.setdefault(int(result.group()), []).append(info)
+
+        def entry(info):
+            return StackMember(fname, info.filename, info.CRC, info.file_size)
+        if not numbered:
+            return cls(fname, [(i, entry(info)) for i, info in enumerate(unnumbered)])
+
+        slices = []
+        slice_id = min(numbered)
+        while slice_id in numbered:
+            slices.append((slice_id, entry(numbered[slice_id][0])))
+            slice_id += 1
+        gaps = [n for n in range(slice_id, max(numbered)) if n not in numbered]
+        duplicates = sorted(n for n in numbered if len(numbered[n]) > 1)
+        return cls(fname, slices, gaps, duplicates)
+
+
+class StackPage(collections.namedtuple("StackPage", "container index")):
+    """One page (counting from 0) of a multi-page TIFF stack."""
+    __slots__ = ()
+
+    def __str__(self):
+        # ImageMagick's syntax for reading a single page
+        return "%s[%i]" % (self.container, self.index)
+
+    def open_image(self):
+        """Returns the page as a PIL image."""
+        return image_engine.tiff_page(self.container, self.index)
+
+    def fingerprint(self):
+        """Returns a string that changes when the page's contents might have."""
+        return "%s[%i]" % (file_digest(self.container), self.index)
+
+    def imagemagick_input(self):
+        """Returns (argument, stdin data) for reading the page with ImageMagick."""
+        return str(self), None
+
+
+class StackMember(collections.namedtuple("StackMember", "container name crc size")):
+    """One image file in a zip stack."""
+    __slots__ = ()
+
+    def __str__(self):
+        return "%s/%s" % (self.container, self.name)
+
+    def read(self):
+        """Returns the contents of the image file."""
+        return read_zip_member(self.container, self.name)
+
+    def open_image(self):
+        """Returns the image as a PIL image."""
+        return image_engine.Image.open(io.BytesIO(self.read()))
+
+    def fingerprint(self):
+        """Returns a string that changes when the image's contents might have, from the zip directory."""
+        return "%s:%08x:%i" % (self.name, self.crc, self.size)
+
+    def imagemagick_input(self):
+        """Returns (argument, stdin data) for reading the image with ImageMagick."""
+        return os.path.splitext(self.name)[1][1:].lower() + ":-", self.read()
+
+
+# Where slice stacks held in a single file come from. Each is a class whose open(fname) returns a ContainerStack for
+# fname, or None if fname isn't its kind of file. Anything none of them claims is the first of a folder of numbered
+# files (SliceStack).
+stack_sources = [TiffStack, ZipStack]
+
+
+def open_stack(first_slice):
+    """Returns the slice stack that starts with (or is held in) first_slice."""
+    return open_container(first_slice) or SliceStack.scan(first_slice)
+
+
+def open_container(fname):
+    """Returns the ContainerStack in fname, or None if fname isn't a stack container."""
+    for source in stack_sources:
+        stack = source.open(fname)
+        if stack is not None:
+            return stack
+    return None
+
+
+def tiff_page_offsets(fname):
+    """Returns the file offsets of the image directories of the pages in a TIFF (or BigTIFF) file, following the
+    chain of directories without reading any image data. Raises ValueError if fname isn't a TIFF file."""
+    with open(fname, "rb") as fin:
+        header = fin.read(16)
+        order = "<" if header[:2] == b"II" else ">"
+        if header[:4] in (b"II*\0", b"MM\0*"):
+            bigtiff = False
+            offset = struct.unpack(order + "I", header[4:8])[0]
+        elif header[:4] in (b"II+\0", b"MM\0+") and len(header) == 16:
+            bigtiff = True
+            offset = struct.unpack(order + "Q", header[8:16])[0]
+        else:
+            raise ValueError("%s isn't a TIFF file" % fname)
+
+        count_format, entry_size, offset_format = ("Q", 20, "Q") if bigtiff else ("H", 12, "I")
+        offsets = []
+        seen = set()
+        while offset != 0 and offset not in seen:
+            seen.add(offset)
+            offsets.append(offset)
+            fin.seek(offset)
+            data = fin.read(struct.calcsize(count_format))
+            if len(data) < struct.calcsize(count_format):
+                raise ValueError("%s is truncated" % fname)
+            entries = struct.unpack(order + count_format, data)[0]
+            fin.seek(offset + len(data) + entries * entry_size)
+            data = fin.read(struct.calcsize(offset_format))
+            if len(data) < struct.calcsize(offset_format):
+                raise ValueError("%s is truncated" % fname)
+            offset = struct.unpack(order + offset_format, data)[0]
+        return offsets
+
+
+# File contents hashes by (filename, size, modification time), so a container is only hashed once however many slices
+# it holds.
+_digests = {}
+_digests_lock = threading.Lock()
+
+
+def file_digest(fname):
+    """Returns the sha1 of the contents of the file fname as a hex string."""
+    stat = os.stat(fname)
+    key = (os.path.abspath(fname), stat.st_size, stat.st_mtime)
+    with _digests_lock:
+        if key in _digests:
+            return _digests[key]
+    sha = hashlib.sha1()
+    with open(fname, "rb") as fin:
+        for block in iter(lambda: fin.read(1024 * 1024), b""):
+            sha.update(block)
+    with _digests_lock:
+        _digests[key] = sha.hexdigest()
+    return _digests[key]
+
+
+class BoundedQueue:
+    """A first in, first out queue joining two stages of a pipeline, bounded by how many bytes its items hold rather
+    than how many of them there are. put() waits while the queue is full, holding back the stage that feeds it until
+    the one that empties it catches up. An item bigger than the whole queue is still let in once the queue is empty, so
+    nothing waits forever. None marks the end of the items; close() ends them early (e.g. on cancel), waking up both
+    sides."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.peak_bytes = 0
+        self._items = collections.deque()
+        self._bytes = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def put(self, item, size):
+        """Adds item, which holds size bytes, waiting for room if need be. Returns False if the queue was closed."""
+        with self._cond:
+            while self._items and self._bytes + size > self.max_bytes and not self._closed:
+                self._cond.wait()
+            if self._closed:
+                return False
+            self._items.append((item, size))
+            self._bytes += size
+            self.peak_bytes = max(self.peak_bytes, self._bytes)
+            self._cond.notify_all()
+            return True
+
+    def get(self):
+        """Removes and returns the next item, waiting for one if need be. Returns None if the queue was closed."""
+        with self._cond:
+            while not self._items and not self._closed:
+                self._cond.wait()
+            if self._closed:
+                return None
+            item, size = self._items.popleft()
+            self._bytes -= size
+            self._cond.notify_all()
+            return item
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._items.clear()
+            self._bytes = 0
+            self._cond.notify_all()
+
+
+class SliceCache:
+    """Converted slices kept on disk between jobs, so re-running a stack only converts the slices that changed.
+
+    Each converted slice is a png file in folder named by the hash of its input slice's contents together with the
+    processing parameters. The folder is kept under max_bytes by deleting the least recently used slices. hits and
+    misses count the lookups made since the cache was created."""
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, in_fname, params):
+        """Returns the cache key for converting the file in_fname (or stack container entry) with params, a string
+        describing everything else that affects the output."""
+        sha = hashlib.sha1(params.encode("utf-8"))
+        if not isinstance(in_fname, basestring):
+            # a slice in a stack container
+            sha.update(in_fname.fingerprint())
+            return sha.hexdigest()
+        with open(in_fname, "rb") as fin:
+            for block in iter(lambda: fin.read(1024 * 1024), b""):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def get(self, key):
+        """Returns the png contents stored under key, or None if there aren't any."""
+        fname = os.path.join(self.folder, key + ".png")
+        try:
+            with open(fname, "rb") as fin:
+                data = fin.read()
+            os.utime(fname, None)       # mark it as recently used
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        """Stores data, the png contents of a converted slice, under key. Failures are ignored; it's only a cache."""
+        fname = os.path.join(self.folder, key + ".png")
+        try:
+            if not os.path.exists(self.folder):
+                os.makedirs(self.folder)
+            # write under a scratch name first so a half written slice is never picked up by another job
+            fd, temp = tempfile.mkstemp(".part", dir=self.folder)
+            with os.fdopen(fd, "wb") as fout:
+                fout.write(data)
+            if os.path.exists(fname):
+                os.remove(fname)
+            os.rename(temp, fname)
+        except (IOError, OSError):
+            pass
+
+    def evict(self):
+        """Deletes the least recently used slices past max_bytes."""
+        entries = []
+        for fname in glob.glob(os.path.join(self.folder, "*.png")):
+            try:
+                entries.append((os.path.getmtime(fname), os.path.getsize(fname), fname))
+            except OSError:
+                pass
+        entries.sort(reverse=True)
+        total = 0
+        for mtime, size, fname in entries:
+            total += size
+            if total > self.max_bytes:
+                try:
+                    os.remove(fname)
+                except OSError:
+                    pass
+
+
+class CwsTemplate(collections.namedtuple("CwsTemplate", "fname size slices manifest_slices slicing")):
+    """What Honeyguide needs to know about a template CWS, read in place (see read) without extracting it or running
+    ImageMagick:
+      * fname - the template file.
+      * size - (width, height) of the slices, from the IHDR chunk of the first slice png, or None if it has no slices.
+      * slices - names of the slice pngs in the archive, in order (see Honeyguide._cws_slices).
+      * manifest_slices - names of the slices listed in manifest.xml, or None if there's no readable manifest.
+      * slicing - the settings in the .slicing file as text by tag name (e.g. 'XResolution', 'DotsPermmX', and from
+                  the selected ink 'SliceHeight' and 'LayerTime'); empty if there's no readable .slicing file."""
+    __slots__ = ()
+
+    @classmethod
+    def read(cls, fname):
+        """Reads the template CWS fname, looking at nothing but the zip directory, the first slice's png header,
+        manifest.xml and the .slicing file. Raises IOError if it isn't a CWS file Honeyguide can read."""
+        try:
+            zf = zipfile.ZipFile(fname, "r")
+        except zipfile.BadZipfile:
+            raise IOError("Not a valid CWS file")
+        try:
+            slices = [info.filename for info in Honeyguide._cws_slices(zf)]
+            size = None
+            if slices:
+                try:
+                    size = Honeyguide._png_size(zf.open(slices[0]).read(24))
+                except ValueError:
+                    raise IOError("%s isn't a png file" % slices[0])
+
+            manifest_slices = None
+            slicing = {}
+            for name in zf.namelist():
+                try:
+                    if name.lower().endswith("manifest.xml") and manifest_slices is None:
+                        manifest = ElementTree.fromstring(zf.read(name))
+                        if manifest.find("Slices") is not None:
+                            manifest_slices = [entry.text for entry in manifest.findall("Slices/Slice/name")]
+                    elif name.lower().endswith(".slicing") and not slicing:
+                        slicing = cls._slicing_settings(ElementTree.fromstring(zf.read(name)))
+                except ElementTree.ParseError:
+                    pass
+        except zipfile.BadZipfile:
+            raise IOError("Not a valid CWS file")
+        finally:
+            zf.close()
+        return cls(fname, size, slices, manifest_slices, slicing)
+
+    @staticmethod
+    def _slicing_settings(config):
+        """Flattens the root element of a .slicing file into a dictionary of its settings, taking the ones in
+        InkConfig from the selected ink."""
+        settings = dict((child.tag, child.text or "") for child in config if len(child) == 0)
+        for ink in config.findall("InkConfig"):
+            if ink.findtext("Name") == settings.get("SelectedInk"):
+                settings.update((child.tag, child.text or "") for child in ink if len(child) == 0)
+        return settings
+
+    @property
+    def layer_count(self):
+        return len(self.slices)
+
+    @property
+    def dots_per_mm(self):
+        """The (x, y) projector resolution in pixels per mm, or None if the .slicing file doesn't say."""
+        try:
+            return float(self.slicing["DotsPermmX"]), float(self.slicing["DotsPermmY"])
+        except (KeyError, ValueError):
+            return None
+
+    @property
+    def slice_height(self):
+        """The layer thickness in mm, or None if the .slicing file doesn't say."""
+        try:
+            return float(self.slicing["SliceHeight"])
+        except (KeyError, ValueError):
+            return None
+
+    def problems(self):
+        """Returns a list of descriptions of anything odd about the template."""
+        problems = []
+        if self.manifest_slices is not None and len(self.manifest_slices) != len(self.slices):
+            problems.append("manifest.xml lists %i slices but the CWS has %i" % (len(self.manifest_slices),
+                                                                                len(self.slices)))
+        resolution = (self.slicing.get("XResolution"), self.slicing.get("YResolution"))
+        if self.size is not None and None not in resolution and resolution != tuple(str(n) for n in self.size):
+            problems.append("the .slicing file is for %sx%s slices but the slices are %ix%i" %
+                            (resolution + tuple(self.size)))
+        return problems
+
+
+class ExposureProfile:
+    """Per-layer exposure times and lift speeds to write into the gcode of an output CWS, e.g. a burn-in ramp for the
+    first layers followed by shorter normal ones.
+
+    A profile is an ini file with one section per range of layers, named like [layers 0-4], [layers 5-] or [layer 12]
+    (layers count from 0). Each section can set
+      * exposure - how long each layer is exposed, in ms
+      * liftrate, retractrate - the feed rates of the lift and retract moves after each layer, in the gcode's own
+                       units (the same as LiftFeedRate and LiftRetractRate in the .slicing file)
+    Any of them can be given as 'A to B' to ramp evenly from A on the first layer of the range to B on the last. Where
+    ranges overlap the later section wins, and layers no section covers keep the template's settings."""
+
+    keys = ("exposure", "liftrate", "retractrate")
+
+    def __init__(self, fname, ranges):
+        self.fname = fname
+        self.ranges = ranges        # (first, last or None for no end, {key: (start, end or None)}) in file order
+
+    @classmethod
+    def read(cls, fname):
+        """Reads the profile in fname. Raises IOError if it can't be read and ValueError if it doesn't make sense."""
+        cp = ConfigParser.SafeConfigParser()
+        try:
+            if not cp.read(fname):
+                raise IOError("Couldn't read %s" % fname)
+        except ConfigParser.Error as e:
+            raise ValueError(str(e).strip())
+
+        ranges = []
+        for section in cp.sections():
+            result = re_match_profile_layers.match(section.strip())
+            if result is None:
+                raise ValueError("[%s] should be named like [layers 0-4], [layers 5-] or [layer 12]" % section)
+            first = int(result.group(1))
+            last = first if result.group(2) is None else (None if result.group(3) is None else int(result.group(3)))
+            if last is not None and last < first:
+                raise ValueError("[%s] ends before it starts" % section)
+            values = {}
+            for key, value in cp.items(section):
+                if key not in cls.keys:
+                    raise ValueError("[%s] has unknown setting %s" % (section, key))
+                result = re_match_profile_value.match(value.strip())
+                try:
+                    start, end = float(result.group(1)), result.group(2) and float(result.group(2))
+                except (AttributeError, ValueError):
+                    raise ValueError("[%s] %s should be a number, or 'A to B' for a ramp" % (section, key))
+                if end is not None and last is None:
+                    raise ValueError("[%s] can only ramp %s over a range of layers with an end" % (section, key))
+                values[key] = (start, end)
+            ranges.append((first, last, values))
+        return cls(fname, ranges)
+
+    def __str__(self):
+        return "%i layer range%s" % (len(self.ranges), "" if len(self.ranges) == 1 else "s")
+
+    def settings(self, layer):
+        """Returns a dictionary of the settings (see keys) the profile gives layer."""
+        settings = {}
+        for first, last, values in self.ranges:
+            if layer < first or (last is not None and layer > last):
+                continue
+            for key, (start, end) in values.items():
+                if end is None or last == first:
+                    settings[key] = start
+                else:
+                    settings[key] = start + (end - start) * (layer - first) / float(last - first)
+        return settings
+
+    def rewrite(self, lines):
+        """Applies the profile to Creation Workshop gcode, taking it and handing it back a line at a time so gcode
+        of any size goes through in constant memory. In each layer the first ;<Delay> after its ;<Slice> line is the
+        exposure, and the first two Z moves after its ;<Slice> Blank line are the lift and the retract. Everything
+        else, including the header comments (such as Layer Time) and the footer, is passed through untouched."""
+        settings = {}
+        exposing = False
+        moves = 0
+        for line in lines:
+            stripped = line.strip()
+            result = re_match_gcode_slice.match(stripped)
+            if result is not None:
+                settings = self.settings(int(result.group(1)))
+                exposing = True
+                moves = 0
+            elif "<Slice>" in stripped:
+                exposing = False        # ;<Slice> Blank: the exposure's over and the lift comes next
+            elif "Footer Start" in stripped:
+                settings = {}
+            elif settings and stripped.startswith(";"):
+                if exposing and "exposure" in settings and re_match_gcode_delay.match(stripped):
+                    line = re_match_gcode_delay.sub(lambda result: result.group(1) + "%i" %
+                                                    round(settings["exposure"]), line, 1)
+                    exposing = False
+            elif settings and not exposing and moves < 2 and re_match_gcode_move.match(line):
+                key = ("liftrate", "retractrate")[moves]
+                moves += 1
+                if key in settings:
+                    line = re_match_gcode_feed.sub(lambda result: result.group(1) + "%g" % settings[key], line, 1)
+            yield line
+
+
+class CwsThumbnails:
+    """Thumbnails of the slices of a CWS file, for scrubbing through its layers in a preview.
+
+    The CWS stays zipped: each slice is read straight out of the archive and shrunk to fit in size only when its
+    thumbnail is first needed, so files with thousands of layers open at once and never sit in memory. The last
+    cache_size thumbnails are kept, least recently used going first, and a background thread decodes up to prefetch
+    layers around the one last asked for (mostly in the direction the viewer is moving) so they're ready when the
+    viewer gets there. Needs the built-in image engine (numpy and Pillow)."""
+
+    def __init__(self, cws_file, size=(400, 225), cache_size=256, prefetch=8):
+        self.cws_file = cws_file
+        self.size = tuple(size)
+        self.cache_size = cache_size
+        self.prefetch = prefetch
+        self._zf = zipfile.ZipFile(cws_file, "r")
+        self._zip_lock = threading.Lock()
+        self.slices = Honeyguide._cws_slices(self._zf)
+        self._cache = collections.OrderedDict()     # layer -> thumbnail, or False if it couldn't be read
+        self._lock = threading.Condition()
+        self._wanted = None         # the layer the viewer is waiting for
+        self._around = (0, 1)       # (layer, direction) to prefetch around
+        self._closed = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __len__(self):
+        return len(self.slices)
+
+    def get(self, layer):
+        """Returns the thumbnail of layer (counting from 0) as a PIL image if it's ready, False if the slice can't be
+        read, or None if it isn't ready yet, in which case it's decoded next. Either way, the layers around it are
+        decoded after that. Never blocks on decoding, so it's safe to call from the GUI thread."""
+        with self._lock:
+            thumb = self._cache.pop(layer, None)
+            if thumb is not None:
+                self._cache[layer] = thumb      # now the most recently used
+            else:
+                self._wanted = layer
+            self._around = (layer, 1 if layer >= self._around[0] else -1)
+            self._lock.notify()
+        return thumb
+
+    def thumbnail(self, layer):
+        """Returns the thumbnail of layer like get(), but decodes it now if need be instead of returning None."""
+        with self._lock:
+            thumb = self._cache.get(layer)
+        if thumb is None:
+            thumb = self._decode(layer)
+            self._store(layer, thumb)
+        return thumb
+
+    def close(self):
+        """Stops the background thread and closes the CWS file."""
+        with self._lock:
+            self._closed = True
+            self._lock.notify()
+        self._thread.join()
+        with self._zip_lock:
+            self._zf.close()
+
+    def _decode(self, layer):
+        try:
+            with self._zip_lock:
+                data = self._zf.read(self.slices[layer])
+            return image_engine.thumbnail(data, self.size)
+        except (IOError, ValueError, zipfile.BadZipfile):
+            return False
+
+    def _store(self, layer, thumb):
+        with self._lock:
+            self._cache[layer] = thumb
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            if self._wanted == layer:
+                self._wanted = None
+
+    def _next_layer(self):
+        """Returns the layer to decode next, or None if there's nothing to do. Call with _lock held."""
+        if self._wanted is not None and self._wanted not in self._cache:
+            return self._wanted
+        layer, direction = self._around
+        for distance in range(1, self.prefetch + 1):
+            candidates = [layer + direction * distance]
+            if distance <= self.prefetch // 2:
+                candidates.append(layer - direction * distance)
+            for candidate in candidates:
+                if 0 <= candidate < len(self.slices) and candidate not in self._cache:
+                    return candidate
+        return None
+
+    def _run(self):
+        while True:
+            with self._lock:
+                layer = self._next_layer()
+                while layer is None and not self._closed:
+                    self._lock.wait()
+                    layer = self._next_layer()
+                if self._closed:
+                    return
+            self._store(layer, self._decode(layer))
+
+
 class Honeyguide:
 
     def __init__(self, logfile=None):
         # Status variables used for communicating with the host.
         self.quiet = False
+        self.echo = True
         self.imagemagick_cmd = 'magick'
         self.negate = False
         self.threshold = False
         self.threshold_val = 0
         self.repeat_first = False
+        self.trim_to_stack = False
+        self.exposure_profile = ''
         self.logfile = logfile
         self.use_mask = False
         self.mask_image = ''
+        self.resize = 'none'
+        self.input_pitch = 0.
+        self.slice_encoding = 'auto'
+        self.png_compress_level = 6
+        self.png_filter = 'none'
+        self.engine = 'imagemagick'
+        self.streaming = False
+        self.workers = 1
+        self.pipeline = False
+        self.pipeline_bytes = 64 * 1024 * 1024
+        self.batch_size = 500
+        self.mask_cache_bytes = 256 * 1024 * 1024
+        self.slice_cache_bytes = 0
+        self.slice_memory_bytes = 128 * 1024 * 1024
+        self.timing = False
+        self.timing_log = False
+        self.timing_cpu = True
+        self.timing_report = None
         
         # background processing variables
         self._thread = None
@@ -85,60 +965,76 @@ class Honeyguide:
         self._message_final = ""
         self._percent = 0.
         self._cancel = False
+        self._procs = set()
+        self._procs_lock = threading.Lock()
+        self._pipeline = ()
+        self._stack = None
+        self._slice_cache = None
+        self._slice_keys = {}
+        self._resize_geometry = None
+
+        # progress reporting (see subscribe and progress)
+        self._status_lock = threading.RLock()
+        self._subscribers = []
+        self._stage = "starting"
+        self._stage_start = time.time()
+        self._slice = 0
+        self._slice_count = 0
+        self._bytes_written = 0
+        self._last_message = ""
+        self._timer = None
 
     @staticmethod
     def template_check(template_cws):
-        """Checks whether a template CWS contains image slices we can use in Honeyguide.
-        Best to do this in a background thread. Returns a tuple (success, message, sliceCount)
-        where Success is a boolean, Message is a string to tell the user, and SliceCount is the
-        number of slices found in the cws file."""
+        """Checks whether a template CWS contains image slices we can use in Honeyguide. Only the zip directory and
+        a few small entries are read (see CwsTemplate), so this is quick. Returns a tuple (success, message, template)
+        where success is a boolean, message is a string to tell the user, and template is the CwsTemplate, or None if
+        it couldn't be read."""
 
         # Check -- is the cws file a real file?
         if not os.path.exists(template_cws):
-            return False, "Please select a template CWS file.", 0
+            return False, "Please select a template CWS file.", None
         if not zipfile.is_zipfile(template_cws):
-            return False, "Not a valid CWS file.", 0
+            return False, "Not a valid CWS file.", None
 
-        # Check the contents on the zip file manifest for images.
         try:
-            zf = zipfile.ZipFile(template_cws, "r")
-            files = []
-            for fl in zf.filelist:
-                if ".png" == fl.orig_filename[-4:].lower():
-                    files.append(fl.orig_filename)
-            zf.close()
-        except:
-            try:
-                zf.close()
-            except:
-                pass
-            return False, "Error opening CWS file.", 0
+            template = CwsTemplate.read(template_cws)
+        except IOError:
+            return False, "Error opening CWS file.", None
 
-        if len(files) > 0:
-            return True, "CWS file has %i slices" % len(files), len(files)
-        else:
-            return False, "CWS has no embedded slices!", 0
+        if template.layer_count == 0:
+            return False, "CWS has no embedded slices!", template
+        message = "CWS file has %i slices of %ix%i" % ((template.layer_count,) + tuple(template.size))
+        return True, "; ".join([message] + template.problems()), template
 
     @staticmethod
     def imstack_check(input_slice):
         """Checks whether an image stack is valid, and returns (valid, message, image_count) where
         valid is a boolean, True if the image stack is valid and False otherwise,
         message is a message to give to your user, and
-        image_count is the number of successive images found in the same folder."""
+        image_count is the number of successive images found in the same folder, or in the stack container (a
+        multi-page TIFF or zip file; see stack_sources) input_slice."""
 
         # check that the image file exists
         if not os.path.exists(input_slice):
             return False, "Please select your first image slice.", 0
 
-        # figure out how long the numbers are (by testing length of result on first slice)
-        result = re_match_last_number.search(input_slice)
-        if result is None:
+        stack = open_stack(input_slice)
+        if stack.container:
+            count = len(stack.slices)
+            if count == 0:
+                return False, "Couldn't find any slice images in this file", 0
+            problems = stack.problems()
+            if problems:
+                return True, "Found %i slice images in this file, but %s." % (count, "; ".join(problems)), count
+            return True, "Found %i slice images in this file." % count, count
+        if stack.numpad == 0:
             return False, "Couldn't find a number in your image filename", 1
-        slice_numpad = result.span()[1] - result.span()[0]
-        slice_id = int(result.group())
-
-        count = Honeyguide._count_slice_images(input_slice, slice_numpad, slice_id)
 
+        count = len(stack.slices)
+        problems = stack.problems()
+        if problems:
+            return True, "Found %i slice images, but %s." % (count, "; ".join(problems)), count
         return True, "Found %i slice images." % count, count
 
     @staticmethod
@@ -153,27 +1049,36 @@ class Honeyguide:
         return os.path.exists(path.group())
 
     @staticmethod
-    def mask_check(input_slice):
+    def mask_check(input_slice, size=None):
         """Checks whether an image is a valid mask, and returns (valid, message) where
         valid is a boolean, True if the image stack is valid and False otherwise,
         message is a message to give to your user, and
-        image_count is the number of successive images found in the same folder."""
+        image_count is the number of successive images found in the same folder.
+        If size, the (width, height) of the template slices, is given, the mask is also prepared for the built-in
+        engine ahead of time so the first job with it doesn't have to."""
 
         # check that the image file exists
         if not os.path.exists(input_slice):
             return False, "File doesn't exist"
 
+        if size is not None and image_engine.available:
+            try:
+                image_engine.mask_cache.get(input_slice, size)
+            except (IOError, OSError):
+                return False, "Couldn't read this image"
+
         return True, "OK"
 
     def do_honeyguide_background(self, template_cws, input_slice, output_cws):
         """Launches the honeyguide stack replacement process in a background thread. For arguments, see the following
         declaration. This just does that in background. Returns success if the job started.
 
-        To check on output, use status_check() and status_message()"""
+        To check on output, use status_check() and status_message(), or progress() and subscribe()"""
         # build args
         args = (template_cws, input_slice, output_cws)
         try:
             self._done = False
+            self._set_stage("starting")
             # create the thread
             self._thread = threading.Thread(target=self.do_honeyguide, args=args)
             # set to daemon - kill the thread if the app quits
@@ -193,124 +1098,244 @@ class Honeyguide:
           * output_cws - filename of CWS file to output results to.
         The following options are now class members:
           * quiet - Suppress most command line output.
+          * echo - print messages to the console as well as the message queue and logfile.
           * im_path - path to ImageMagick executable. '' means it's in the system's PATH environment variable.
           * negate - negate the images before running the script.
           * threshold - threshold (binarize) the images before processing
           * threshold_val - value to use for the 1/0 transition threshold (0-255)
           * repeat_first - if True, instead of using successively numbered images from input_slice, just repeat the
                            same one over and over again.
+          * trim_to_stack - if True and the image stack is shorter than the template, the print ends at the last
+                           image instead of exposing blank layers for the rest of the template. The template's layers
+                           past the end of the stack are left out of the output, along with their layers in the gcode
+                           and manifest.xml (see _trim_gcode); the header, the kept layers' lift sequences and the
+                           footer are copied as they are. If the gcode's layers can't be found, the extra layers are
+                           blanked as usual.
+          * exposure_profile - an ExposureProfile file of per-layer exposure times and lift speeds to write into the
+                           output gcode, or '' to copy the template's gcode as it is. The gcode is rewritten a line at
+                           a time on its way into the output, so its size doesn't matter.
           * use_mask - use a mask image which is multiplied with the input image on each slice to compensate for
                            projection system irregularities
           * mask_image - image to use for masking.
+          * resize - 'none' to put the slices on the template at their own size (centered, and padded with black or
+                           cropped), 'fit' to scale them to fit the template first, keeping their aspect ratio, or
+                           'pitch' to scale them so each input pixel is input_pitch across on the projector, using the
+                           projector resolution (DotsPermmX/Y) from the template's .slicing file. Slices are scaled
+                           with a triangle filter before negate, threshold and the mask. The scale is worked out once
+                           per job; the built-in engine also works out the filter weights just once (see
+                           image_engine.Resampler) and matches ImageMagick's scaling to within rounding.
+          * input_pitch - with resize 'pitch', the size of an input slice pixel in micrometers.
+          * slice_encoding - 'auto' writes each slice as the smallest png type that holds it losslessly (up to 16
+                           bits, with alpha). 'compact' flattens it over black and writes it the way the printer host
+                           shows it: a 1-bit grayscale png if it's only black and white (e.g. thresholded), and 8-bit
+                           grayscale otherwise, which makes for smaller CWS files that load faster. Compact slices are
+                           checked against references with compare_cws_files(displayed=True).
+          * png_compress_level, png_filter - with compact encoding, the zlib level (0-9) and png filter (one of
+                           image_engine.PNG_FILTERS or 'adaptive'; see image_engine.write_gray_png).
+          * engine - 'imagemagick' to run ImageMagick once per slice, 'imagemagick_batch' to run it once per
+                           batch_size slices from a generated script, or 'builtin' to process the slices in-process
+                           with numpy and Pillow (see image_engine.py). All three produce the same pixels.
+          * streaming - if True, read the template entries straight out of the template zip and write the converted
+                           slices straight into the output zip, instead of going through a temporary directory.
+          * workers - number of slices to convert at the same time. 1 converts them one at a time on this thread;
+                           0 uses one worker per processor core.
+          * pipeline - with the 'builtin' engine, streaming and one worker, decode, convert and write the slices on
+                           three threads at once instead of one after another (see _convert_slices_pipelined). With
+                           more workers the worker pool overlaps them already, and is used instead.
+          * pipeline_bytes - with pipeline, the most memory the slices waiting between the stages may take.
+          * batch_size - with the 'imagemagick_batch' engine, how many slices each ImageMagick process converts.
+          * mask_cache_bytes - how much memory (built-in engine) or disk (ImageMagick) to spend keeping prepared
+                           masks around between jobs.
+          * slice_cache_bytes - how much disk to spend keeping converted slices around between jobs (see SliceCache),
+                           so a re-run only converts the slices that changed. Every input slice is hashed and
+                           every converted slice written a second time to fill it, so it's off (0) unless asked for.
+          * slice_memory_bytes - with the 'builtin' engine, roughly how much scratch memory each worker may use per
+                           slice. Larger slices (4K and 8K projectors, oversized source images) are converted a strip
+                           at a time to stay within it; the pixels are the same. 0 means no limit.
+          * timing - if True, time each stage of the job and each slice conversion. The results are left in
+                           timing_report (see StageTimer.report) when the job finishes.
+          * timing_log - if True as well, also append timing_report as a line of JSON to timing.log in settings_path.
+          * timing_cpu - if True, timing_report includes CPU time. That's the CPU time of the whole process, so turn
+                           this off when other jobs run in the same process at the same time.
 
         Output: Returns (success, message), where success is a boolean and message is a string explaining what went wrong.
 
         Notes: Only basic checks on arguments are performed here. Be sure to run the first three through the corresponding
             check functions directly above.
         """
-        self._done = False
-        self._success = True
-        self._message_final = "Success"
-        self._cancel = False
-        self._percent = 0
-
+        self._start_job()
+        image_engine.mask_cache.max_bytes = self.mask_cache_bytes
+        self._slice_cache = None
+        self._slice_keys = {}
+        self._resize_geometry = None
+
+        cws_dir = None
+        tzf = None
+        out_zf = None
+        out_temp = None
         try:
             if not os.path.exists(template_cws) or not os.path.exists(input_slice) or output_cws == '' or \
                         (self.use_mask and not os.path.exists(self.mask_image)):
                 self._write_message("Invalid input to Honeyguide! One of the input paths is invalid.")
                 self._success = False
                 self._message_final = "Invalid input filenames"     # cancel!
-                self._done = True
+                self._finish()
                 return self._success, self._message_final
 
-            cws_dir = tempfile.mkdtemp()
-
-            # Unzip the file
+            # everything we need to know about the template comes straight out of the zip
+            self._set_stage("reading template")
             try:
-                zf = zipfile.ZipFile(template_cws, "r")
-                zf.extractall(cws_dir)
-                zf.close()
-            except:
-                try:
-                    zf.close()
-                finally:
-                    self._write_message("Error reading template CWS file.")
-                    self._success = False
-                    self._message_final = "Error reading template CWS file."
-                    self._done = True
-                    return self._success, self._message_final
-
-            # get the size of the template images as well as their name form
-            imlist = glob.glob(cws_dir + "/*.png")
-
-            if len(imlist) == 0:
+                template = CwsTemplate.read(template_cws)
+            except IOError:
+                self._write_message("Error reading template CWS file.")
+                self._success = False
+                self._message_final = "Error reading template CWS file."
+                self._finish()
+                return self._success, self._message_final
+            if template.layer_count == 0:
                 self._write_message("Couldn't find any png images in the CWS! Make sure you slice before you save!")
                 self._success = False
                 self._message_final = "Invalid CWS file. No embedded images."
-                self._done = True
+                self._finish()
                 return self._success, self._message_final
+            for problem in template.problems():
+                self._write_message("Warning: %s." % problem)
+            sizestr = "%ix%i" % template.size
+
+            # how much to scale the slices by, for the whole job
+            scale = None
+            if self.resize == 'fit':
+                scale = "fit"
+            elif self.resize == 'pitch':
+                dots = template.dots_per_mm
+                if dots is None or self.input_pitch <= 0:
+                    self._write_message("Scaling to pixel pitch needs an input pixel pitch above 0 and a template "
+                                        "with DotsPermmX and DotsPermmY in its .slicing file.")
+                    self._success = False
+                    self._message_final = "Can't work out the scale for the pixel pitch"
+                    self._finish()
+                    return self._success, self._message_final
+                scale = (self.input_pitch / 1000. * dots[0], self.input_pitch / 1000. * dots[1])
+                self._write_message("Scaling slices by %.4g x %.4g for the pixel pitch." % scale)
 
-            cws_imname = imlist[0]
+            profile = None
+            if self.exposure_profile:
+                try:
+                    profile = ExposureProfile.read(self.exposure_profile)
+                except (IOError, ValueError) as e:
+                    self._write_message("Error reading the exposure profile: %s" % e)
+                    self._success = False
+                    self._message_final = "Error reading the exposure profile"
+                    self._finish()
+                    return self._success, self._message_final
 
-            sizestr = self._get_size_str(cws_imname)
-            if sizestr == "":
-                self._write_message("Error getting the size of the CWS template image! Is your ImageMagick path correct?")
-                self._success = False
-                self._message_final = "Error using ImageMagick"
-                self._done = True
-                return self._success, self._message_final
-            # set up the conversion function.
-            #  -negate - invert the image colors
-            #  -threshold - threshold at 50% brightness (to deal with gray inputs)
-            #  -background - set the background of any unused portion of the frame to black
-            #  -compose - operator for use when compositing new images on top of background pixels
-            #  -gravity - center the new image on the scene
-            #  -extent - size of output image (on which the input image will be composited)
-            #  -composite - command to combine the images
-            #  () - imagemagick groupings. Note that these have to be escaped on *nix shells, so I'll use variables for them
-
-            im_bp = '\\(' if on_posix else '('
-            im_ep = '\\)' if on_posix else ')'
-            imagemagick_prefix = [im_bp]
-            imagemagick_flags = []
-            if self.negate:
-                imagemagick_flags.extend(['-channel', 'RGB', '-negate'])
-            if self.threshold:
-                imagemagick_flags.extend(['-threshold', '%i%%'%self.threshold_val])
-            imagemagick_flags.extend(['-background', 'black', '-compose', 'Copy', '-gravity', 'center', '-extent', sizestr, '-composite', im_ep])
-            if self.use_mask:
-                imagemagick_flags.extend([im_bp, self.mask_image, '-resize', '%s!'%sizestr, im_ep, '-compose',
-                                          'Multiply', '-gravity', 'center', '-composite'])
-
-
-            # figure out how long the numbers are (by testing length of result on first slice)
-            result = re_match_last_number.search(input_slice)
-            if result is None and not self.repeat_first:
-                self._write_message("Couldn't find number in the filename of your slice input.")
-                self._success = False
-                self._message_final = "Couldn't find number in the filename of your slice input."
-                self._done = True
-                return self._success, self._message_final
-            if self.repeat_first:
-                slice_numpad = 0
-                slice_id = 0
+            if self.streaming:
+                # Leave the template zipped; we'll pull entries out of it as we need them.
+                try:
+                    tzf = zipfile.ZipFile(template_cws, "r")
+                except:
+                    self._write_message("Error reading template CWS file.")
+                    self._success = False
+                    self._message_final = "Error reading template CWS file."
+                    self._finish()
+                    return self._success, self._message_final
+                cws_imname = template.slices[0]
             else:
-                slice_numpad = result.span()[1] - result.span()[0]
-                slice_id = int(result.group())
+                cws_dir = tempfile.mkdtemp()
+
+                # Unzip the file
+                try:
+                    zf = zipfile.ZipFile(template_cws, "r")
+                    zf.extractall(cws_dir)
+                    zf.close()
+                except:
+                    try:
+                        zf.close()
+                    finally:
+                        self._write_message("Error reading template CWS file.")
+                        self._success = False
+                        self._message_final = "Error reading template CWS file."
+                        self._finish()
+                        return self._success, self._message_final
+                cws_imname = os.path.join(cws_dir, template.slices[0])
+            imlist = template.slices
+
+            self._set_stage("sizing")
+            processor = None
+            if self.engine == 'builtin':
+                if not image_engine.available:
+                    self._write_message("The built-in image engine needs numpy and Pillow. Install them or use ImageMagick.")
+                    self._success = False
+                    self._message_final = "Built-in image engine unavailable"
+                    self._finish()
+                    return self._success, self._message_final
+                try:
+                    processor = image_engine.SliceEngine(template.size, self.negate, self.threshold,
+                                                         self.threshold_val, self.mask_image if self.use_mask else None,
+                                                         memory_budget=self.slice_memory_bytes or None,
+                                                         scale=scale, compact=self.slice_encoding == 'compact',
+                                                         compress_level=self.png_compress_level,
+                                                         png_filter=self.png_filter)
+                except (IOError, OSError):
+                    self._write_message("Error reading the mask image!")
+                    self._success = False
+                    self._message_final = "Error reading mask image"
+                    self._finish()
+                    return self._success, self._message_final
+            if scale == "fit":
+                self._resize_geometry = sizestr
+            elif scale is not None:
+                self._resize_geometry = "%.6f%%x%.6f%%" % (100. * scale[0], 100. * scale[1])
+            # ImageMagick resizes the mask once up front instead of on every slice.
+            mask_source = None
+            if self.use_mask and processor is None:
+                mask_source = self._prepare_imagemagick_mask(sizestr)
+            imagemagick_prefix, imagemagick_flags = self._imagemagick_flags(sizestr, mask_source)
+
+            # index the stack of slice images in one pass over their folder
+            self._set_stage("indexing stack")
+            repeated_slice = input_slice
+            if not self.repeat_first:
+                stack = open_stack(input_slice)
+                if stack.container and not stack.slices:
+                    self._write_message("Couldn't find any slice images in %s." % input_slice)
+                    self._success = False
+                    self._message_final = "Couldn't find any slice images in your slice input."
+                    self._finish()
+                    return self._success, self._message_final
+                if not stack.container and stack.numpad == 0:
+                    self._write_message("Couldn't find number in the filename of your slice input.")
+                    self._success = False
+                    self._message_final = "Couldn't find number in the filename of your slice input."
+                    self._finish()
+                    return self._success, self._message_final
+                for problem in stack.problems():
+                    self._write_message("Warning: %s." % problem)
+            else:
+                # repeat the first slice of a container, or the input file itself
+                stack = open_container(input_slice)
+                if stack is not None and stack.slices:
+                    repeated_slice = stack.paths[0]
+            if stack is not None and stack.container:
+                # this job's hold on the container is let go by _cleanup_job
+                stack.hold()
+                self._stack = stack
 
             # Set up the file name templates
             cws_id = 0
             cws_numpad = 4      # the cws format alwasy uses 4-digit file numbers.
             next_cws_in = cws_imname[:-8] + "0000.png"
-            next_slice = input_slice
             # figure out the name of the output image
-            first_cws_out = re_match_path.match(cws_imname).group() + re_match_path.sub("", output_cws)[:-4] + "0000.png"
+            if self.streaming:
+                first_cws_out = re_match_path.sub("", output_cws)[:-4] + "0000.png"
+            else:
+                first_cws_out = re_match_path.match(cws_imname).group() + re_match_path.sub("", output_cws)[:-4] + "0000.png"
             next_cws_out = first_cws_out
 
             # check that we have enough slices in the cws to incorporate the whole slice stack.
             if not self.repeat_first:
                 # figure out how many images are in the set of slice images
-                slice_count = self._count_slice_images(input_slice, slice_numpad, slice_id)
+                slice_count = len(stack.slices)
                 leftover_slices = slice_count - len(imlist)
                 if len(imlist) < slice_count:
                     self._write_message("There are not enough slices in the CWS to fill all the slices in your dataset! %i slices will be lost" % leftover_slices)
@@ -320,95 +1345,129 @@ class Honeyguide:
             else:
                 slice_count = len(imlist)
 
-            self._percent = 5
-
-            if self._cancel:
-                # delete the temporary directory
+            # cut the gcode and manifest down to the stack, so the print ends with its last image
+            trimmed_files = None
+            if self.trim_to_stack and not self.repeat_first and slice_count < len(imlist):
+                trimmed_files = self._trim_print(template, slice_count)
+                if trimmed_files is not None:
+                    self._write_message("Trimming the print to %i of the template's %i layers." %
+                                        (slice_count, len(imlist)))
+
+            if self.streaming:
+                # Copy everything that isn't a slice straight across, then add the slices as we convert them. The
+                # output goes to a scratch name next to output_cws so we never write over the template as we read it,
+                # and a cancelled job doesn't leave half a CWS behind.
                 try:
-                    filelist = glob.glob(cws_dir + "/*.*")
-                    for filename in filelist:
-                        os.remove(filename)
-                    os.rmdir(cws_dir)
-                finally:
-                    self._write_message("Cancelled!")
-                    self._percent = 100
-                    self._message_final = "Cancelled!"
+                    out_temp = output_cws + ".part"
+                    out_zf = zipfile.ZipFile(out_temp, "w")
+                    slice_names = set()
+                    i = 0
+                    while self._template_has(cws_imname[:-8] + ("%04i" % i) + ".png", tzf):
+                        slice_names.add(cws_imname[:-8] + ("%04i" % i) + ".png")
+                        i += 1
+                    for info in tzf.infolist():
+                        if profile is not None and info.filename.lower().endswith(".gcode"):
+                            if trimmed_files is not None and info.filename in trimmed_files:
+                                source = io.BytesIO(trimmed_files[info.filename])
+                            else:
+                                source = tzf.open(info)
+                            self._write_profiled_gcode(profile, source, out_zf, info)
+                        elif trimmed_files is not None and info.filename in trimmed_files:
+                            out_zf.writestr(info, trimmed_files[info.filename])
+                        elif info.filename not in slice_names:
+                            out_zf.writestr(info, tzf.read(info))
+                except:
+                    self._write_message("Error writing new CWS file.")
                     self._success = False
-                    self._done = True
+                    self._message_final = "Error writing new CWS file"
+                    self._cleanup_job(cws_dir, tzf, out_zf, out_temp)
+                    self._finish()
                     return self._success, self._message_final
 
+            self._set_progress(5)
+
+            if self._cancel:
+                return self._cancel_job(cws_dir, tzf, out_zf, out_temp)
+
             # go through the files until we run out of source or destination filenames.
             # CW is strange in that the names of the image files need to match the name
             # of the output archive, not the input!
-            while os.path.exists(next_cws_in) and os.path.exists(next_slice):
-                if not self.quiet:
-                    self._write_message("Converting slice %i/%i\r" % (cws_id, slice_count))
-                # filter the slice and copy it onto the cws:
-                args = [self.imagemagick_cmd]
-                args.extend(imagemagick_prefix)
-                args.append(next_slice)
-                args.extend(imagemagick_flags)
-                args.append(next_cws_out)
-                # TESTING
-                #print(args)
-                if subprocess.call(args, shell=True) != 0:
-                    self._write_message("Got an odd return code form ImageMagick. Output CWS may be corrupt, or ImageMagick Install Folder may need to be set.")
-                    self._success = False
-                    self._message_final = "Got an odd return code form ImageMagick. Output CWS may be corrupt, or ImageMagick Install Folder may need to be set."
-
-                # delete the input cws image file if it is different than the output cws image file
-                if re_match_path.sub("", next_cws_in).lower() != re_match_path.sub("", next_cws_out).lower():
-                    #pass
-                    try:
-                        os.remove(next_cws_in)
-                    finally:
-                        pass        # don't care if it fails...
+            jobs = []
+            for next_slice in itertools.repeat(repeated_slice) if self.repeat_first else stack.paths:
+                if not self._template_has(next_cws_in, tzf):
+                    break
+                jobs.append((next_slice, next_cws_in, next_cws_out))
 
                 # figure out the next filenames based on the current ones.
                 cws_id += 1
-                if not self.repeat_first:
-                    slice_id += 1
-                    next_slice = re_match_last_number.sub(("%0" + ("%i"%slice_numpad) + "i") % slice_id, input_slice)
                 next_cws_out = first_cws_out[:-8] + ("%04i" % cws_id) + ".png"
                 next_cws_in = cws_imname[:-8] + ("%04i" % cws_id) + ".png"
 
-                # update status; check for cancel
-                self._percent = 5 + 80.0 * float(cws_id) / slice_count
-                if self._cancel:
-                    # delete the temporary directory
+            # Output slices that only exist as png contents (layers that repeat an image we already have), by output
+            # filename. When not streaming they're added to the zip alongside the temporary folder at the end.
+            shared_slices = collections.OrderedDict()
+
+            # fill in the slices we converted on an earlier run; only the rest need converting.
+            if self.slice_cache_bytes > 0:
+                self._slice_cache = SliceCache(os.path.join(settings_path, "slices"), self.slice_cache_bytes)
+                jobs = self._reuse_cached_slices(jobs, sizestr, out_zf, shared_slices)
+                if jobs is None:
+                    return self._cancel_job(cws_dir, tzf, out_zf, out_temp)
+            convert_count = max(len(jobs), 1)
+
+            if self.engine == 'imagemagick_batch' and not self.repeat_first:
+                if not self._convert_slices_batch(jobs, convert_count, sizestr, mask_source, out_zf):
+                    return self._cancel_job(cws_dir, tzf, out_zf, out_temp)
+            elif self.pipeline and processor is not None and self.streaming and not self.repeat_first and \
+                    (self.workers if self.workers > 0 else multiprocessing.cpu_count()) == 1:
+                if not self._convert_slices_pipelined(jobs, convert_count, processor, out_zf, shared_slices):
+                    return self._cancel_job(cws_dir, tzf, out_zf, out_temp)
+            elif not self._convert_slices(jobs, convert_count, processor, (imagemagick_prefix, imagemagick_flags),
+                                          out_zf, shared_slices):
+                return self._cancel_job(cws_dir, tzf, out_zf, out_temp)
+
+            # if we ran out of slice files before we ran out of cws slices, set all remaining cws slices to black, or
+            # with trim_to_stack leave them out.
+            blank_data = None
+            if trimmed_files is not None:
+                if not self.streaming:
                     try:
-                        filelist = glob.glob(cws_dir + "/*.*")
-                        for filename in filelist:
-                            os.remove(filename)
-                        os.rmdir(cws_dir)
-                    finally:
-                        self._write_message("Cancelled!")
-                        self._percent = 100
-                        self._message_final = "Cancelled!"
+                        for name, data in trimmed_files.items():
+                            with open(os.path.join(cws_dir, name), "wb") as outfile:
+                                outfile.write(data)
+                        for name in imlist[cws_id:]:
+                            os.remove(os.path.join(cws_dir, name))
+                    except (IOError, OSError):
+                        self._write_message("Error trimming the print. Resulting CWS may be corrupt.")
                         self._success = False
-                        self._done = True
-                        return self._success, self._message_final
-
-            # if we ran out of slice files before we ran out of cws slices, set all remaining cws slices to black.
-            blankfile = os.path.join(cws_dir, "blank.png")
-            # generate a blank image and save it to blankfile
-            args = [self.imagemagick_cmd, "-size", sizestr, "xc:black", blankfile]
-            # TESTING
-            print(args)
-            subprocess.call(args, shell=True)
-            while os.path.exists(next_cws_in):
+                        self._message_final = "Error trimming the print. Resulting CWS may be corrupt."
+            elif self._template_has(next_cws_in, tzf):
+                self._set_stage("blanking", len(imlist) - cws_id)
+                # generate the blank image once and reuse the same bytes for every remaining slice
+                try:
+                    if processor is not None:
+                        blank_data = processor.blank_bytes()
+                    else:
+                        blank_data = self._run_imagemagick([self.imagemagick_cmd, "-size", sizestr, "xc:black", "png:-"],
+                                                           True)
+                except (subprocess.CalledProcessError, OSError):
+                    blank_data = None
+            while trimmed_files is None and self._template_has(next_cws_in, tzf):
                 if not self.quiet:
                     self._write_message("Blanking slice %i/%i\r" % (cws_id, len(imlist)))
 
                 try:
-                    shutil.copy(blankfile, next_cws_out)
+                    if blank_data is None:
+                        raise IOError("No blank image")
+                    self._store_slice(out_zf, shared_slices, next_cws_out, blank_data)
+                    self._count_written(next_cws_out, blank_data)
                 except:
                     self._write_message("Error creating blanked file. Resulting CWS may be corrupt.")
                     self._success = False
                     self._message_final = "Error creating blanked file. Resulting CWS may be corrupt."
 
                 # delete the input cws image file if it is different than the output cws image file
-                if re_match_path.sub("",next_cws_in).lower() != re_match_path.sub("",next_cws_out).lower() :
+                if not self.streaming and re_match_path.sub("",next_cws_in).lower() != re_match_path.sub("",next_cws_out).lower() :
                     #pass
                     try:
                         os.remove(next_cws_in)
@@ -421,59 +1480,748 @@ class Honeyguide:
                 next_cws_in = cws_imname[:-8] + ("%04i" % cws_id) + ".png"
 
                 # update status; check for cancel
-                self._percent = 85 + 10.0 * float(cws_id - slice_count) / float(len(imlist) - slice_count + 1)
+                self._set_progress(85 + 10.0 * float(cws_id - slice_count) / float(len(imlist) - slice_count + 1),
+                                   self._slice + 1)
                 if self._cancel:
-                    # delete the temporary directory
+                    return self._cancel_job(cws_dir, tzf, out_zf, out_temp)
+
+            if profile is not None and not self.streaming:
+                try:
+                    for gcode_fname in glob.glob(os.path.join(cws_dir, "*.gcode")):
+                        with open(gcode_fname, "rb") as source:
+                            self._write_profiled_gcode(profile, source, None, gcode_fname + ".part")
+                        os.remove(gcode_fname)
+                        os.rename(gcode_fname + ".part", gcode_fname)
+                except (IOError, OSError):
+                    self._write_message("Error applying the exposure profile. Resulting CWS may be corrupt.")
+                    self._success = False
+                    self._message_final = "Error applying the exposure profile. Resulting CWS may be corrupt."
+
+            self._set_stage("writing")
+            if self.streaming:
+                # finish the output archive and move it into place
+                try:
+                    out_zf.close()
+                    out_zf = None
+                    tzf.close()
+                    tzf = None
+                    if os.path.exists(output_cws):
+                        os.remove(output_cws)
+                    os.rename(out_temp, output_cws)
+                    out_temp = None
+                except:
+                    self._write_message("Error writing new CWS file.")
+                    self._success = False
+                    self._message_final = "Error writing new CWS file"
+            else:
+                # re-zip the files into the "new" cws, plus the slices we only have in memory
+                filelist = glob.glob(cws_dir + "/*.*")
+                shared_names = set(re_match_path.sub("", name).lower() for name in shared_slices)
+                try:
+                    zf = zipfile.ZipFile(output_cws, "w")
+                    for file in filelist:
+                        if re_match_path.sub("", file).lower() not in shared_names:
+                            zf.write(file, re_match_path.sub("", file))
+                    for name, data in shared_slices.items():
+                        zf.writestr(self._slice_info(re_match_path.sub("", name)), data)
+                    zf.close()
+                except:
+                    self._write_message("Error writing new CWS file.")
+                    self._success = False
+                    self._message_final = "Error writing new CWS file"
+
+            self._set_progress(99)
+            self._set_stage("cleanup")
+
+            if self._slice_cache is not None:
+                self._write_message("Slice cache: %i hits, %i misses." %
+                                    (self._slice_cache.hits, self._slice_cache.misses))
+                self._slice_cache.evict()
+
+            # delete the temporary directory
+            try:
+                self._cleanup_job(cws_dir, tzf, out_zf, out_temp)
+            finally:
+                self._write_message("Done!")
+                self._percent = 100
+                self._finish()
+                return self._success, self._message_final
+
+        except: # catch-all for the whole process.
+            self._cleanup_job(cws_dir, tzf, out_zf, out_temp)
+            self._write_message("An unknown error occurred")
+            self._success = False
+            self._message_final = "An unknown error occurred"
+            self._finish()
+            return self._success, self._message_final
+
+    def _convert_slices(self, jobs, slice_count, processor, im_flags, out_zf, shared_slices):
+        """Converts the slices listed in jobs, a list of (input slice, template slice, output slice) filenames, with
+        the built-in engine processor or (if processor is None) ImageMagick using im_flags, a tuple of the
+        (prefix, flags) ImageMagick arguments that go before and after the input filename. Converted slices are written
+        to out_zf in order when streaming, or to the output slice files otherwise.
+
+        With self.workers other than 1, slices are converted on a pool of workers (processes for the built-in engine,
+        threads driving ImageMagick processes otherwise) while results are written in order as they come back.
+
+        With self.repeat_first, the image is converted once and the same png contents are stored for every layer (see
+        _store_slice for where they go when not streaming).
+        Returns False if the job was cancelled."""
+        self._set_stage("converting", len(jobs))
+        workers = self.workers if self.workers > 0 else multiprocessing.cpu_count()
+        pool = None
+        if workers > 1 and len(jobs) > 1 and not self.repeat_first:
+            if processor is not None:
+                pool = multiprocessing.Pool(workers, image_engine.init_worker, (processor.settings(),))
+                convert = image_engine.convert_in_worker
+            else:
+                pool = multiprocessing.pool.ThreadPool(workers)
+                convert = functools.partial(self._convert_slice, None, im_flags)
+        else:
+            convert = functools.partial(self._convert_slice, processor, im_flags)
+        timer = self._timer
+        if timer is not None and pool is not None:
+            # time the slices where they're converted, not counting the wait in the queue
+            convert = functools.partial(image_engine.timed_call, convert)
+
+        try:
+            pending = collections.deque()
+            submitted = 0
+            repeated = None
+            for cws_id, (in_fname, cws_in, cws_out) in enumerate(jobs):
+                # Keep a few slices queued per worker. Finished slices wait here until they can be written in order,
+                # so this also bounds how many of them we hold on to.
+                while pool is not None and submitted < len(jobs) and len(pending) < 4 * workers:
+                    out_fname = None if self.streaming else jobs[submitted][2]
+                    pending.append(pool.apply_async(convert, (jobs[submitted][0], out_fname)))
+                    submitted += 1
+
+                if not self.quiet:
+                    self._write_message("Converting slice %i/%i\r" % (cws_id, slice_count))
+                # filter the slice and copy it onto the cws:
+                try:
+                    if repeated is not None:
+                        data = repeated
+                    elif pool is None:
+                        start = time.time()
+                        data = convert(in_fname, None if self.streaming or self.repeat_first else cws_out)
+                        if timer is not None:
+                            timer.slice(time.time() - start)
+                    else:
+                        while not pending[0].ready():
+                            pending[0].wait(0.1)
+                            # count everything that's finished, not just what's been written
+                            finished = cws_id + sum(1 for r in pending if r.ready())
+                            self._set_progress(5 + 80.0 * float(finished) / slice_count, finished)
+                            if self._cancel:
+                                return False
+                        data = pending.popleft().get()
+                        if timer is not None:
+                            data, seconds = data
+                            timer.slice(seconds)
+                    if self.repeat_first:
+                        repeated = data
+                    if data is not None:
+                        self._store_slice(out_zf, shared_slices, cws_out, data)
+                    self._cache_slice(cws_out, data)
+                    self._count_written(cws_out, data)
+                except IOError:
+                    self._write_message("Error converting %s. Output CWS may be corrupt." % (in_fname,))
+                    self._success = False
+                    self._message_final = "Error converting %s. Output CWS may be corrupt." % (in_fname,)
+                except subprocess.CalledProcessError:
+                    if self._cancel:
+                        return False
+                    self._write_message("Got an odd return code form ImageMagick. Output CWS may be corrupt, or ImageMagick Install Folder may need to be set.")
+                    self._success = False
+                    self._message_final = "Got an odd return code form ImageMagick. Output CWS may be corrupt, or ImageMagick Install Folder may need to be set."
+
+                # delete the input cws image file if it is different than the output cws image file
+                if not self.streaming and re_match_path.sub("", cws_in).lower() != re_match_path.sub("", cws_out).lower():
+                    #pass
                     try:
-                        filelist = glob.glob(cws_dir + "/*.*")
-                        for filename in filelist:
-                            os.remove(filename)
-                        os.rmdir(cws_dir)
+                        os.remove(cws_in)
                     finally:
-                        self._write_message("Cancelled!")
-                        self._percent = 100
-                        self._message_final = "Cancelled!"
-                        self._success = False
-                        self._done = True
-                        return self._success, self._message_final
+                        pass        # don't care if it fails...
 
+                # update status; check for cancel
+                self._set_progress(5 + 80.0 * float(cws_id + 1) / slice_count, cws_id + 1)
+                if self._cancel:
+                    return False
+            return True
+        finally:
+            # stop anything still running (only the case if we're bailing out early)
+            self._kill_imagemagick()
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    def _convert_slices_pipelined(self, jobs, slice_count, processor, out_zf, shared_slices):
+        """Converts the slices listed in jobs (see _convert_slices) with the built-in engine processor, streaming them
+        into out_zf, as a pipeline of three stages: a reader thread decodes the input slices, this thread converts
+        them and a writer thread stores them in the zip and the slice cache. So while slice N is converted, slice N+1
+        is decoded and slice N-1 written. The stages are joined by BoundedQueues that between them hold at most
+        pipeline_bytes (decoded images on one side, png contents on the other); when a stage falls behind, the one
+        feeding it waits. Returns False if the job was cancelled."""
+        self._set_stage("converting", len(jobs))
+        decoded = BoundedQueue(self.pipeline_bytes // 2)
+        encoded = BoundedQueue(self.pipeline_bytes - self.pipeline_bytes // 2)
+        self._pipeline = (decoded, encoded)
+        written = [0]
+        write_errors = []
+
+        def read_slices():
             try:
-                os.remove(blankfile)
+                for in_fname, cws_in, cws_out in jobs:
+                    try:
+                        im = image_engine.open_image(in_fname)
+                        im.load()
+                        item, size = im, image_engine.image_bytes(im)
+                    except Exception as e:
+                        item, size = e, 0       # reported in turn by the converter
+                    if not decoded.put(item, size):
+                        return
             finally:
-                pass        # don't care if it fails.
+                decoded.put(None, 0)
 
-            # re-zip the files into the "new" cws
-            filelist = glob.glob(cws_dir + "/*.*")
+        def write_slices():
             try:
-                zf = zipfile.ZipFile(output_cws, "w")
-                for file in filelist:
-                    zf.write(file, re_match_path.sub("", file))
-                zf.close()
-            except:
+                while True:
+                    item = encoded.get()
+                    if item is None:
+                        return
+                    cws_out, data = item
+                    self._store_slice(out_zf, shared_slices, cws_out, data)
+                    self._cache_slice(cws_out, data)
+                    self._count_written(cws_out, data)
+                    written[0] += 1
+            except Exception as e:
+                write_errors.append(e)
+                decoded.close()
+                encoded.close()
+
+        reader = threading.Thread(target=read_slices)
+        writer = threading.Thread(target=write_slices)
+        for thread in (reader, writer):
+            thread.daemon = True
+            thread.start()
+        timer = self._timer
+        try:
+            for cws_id, (in_fname, cws_in, cws_out) in enumerate(jobs):
+                im = decoded.get()
+                if im is None:
+                    break       # cancelled, or the writer failed
+                if not self.quiet:
+                    self._write_message("Converting slice %i/%i\r" % (cws_id, slice_count))
+                try:
+                    if isinstance(im, Exception):
+                        raise im
+                    start = time.time()
+                    data = processor.convert_image_to_bytes(im)
+                    if timer is not None:
+                        timer.slice(time.time() - start)
+                    im = None
+                    if not encoded.put((cws_out, data), len(data)):
+                        break
+                except IOError:
+                    self._write_message("Error converting %s. Output CWS may be corrupt." % (in_fname,))
+                    self._success = False
+                    self._message_final = "Error converting %s. Output CWS may be corrupt." % (in_fname,)
+
+                # update status; check for cancel
+                self._set_progress(5 + 80.0 * float(written[0]) / slice_count, written[0])
+                if self._cancel:
+                    return False
+
+            # let the writer catch up
+            encoded.put(None, 0)
+            while writer.is_alive():
+                writer.join(0.1)
+                self._set_progress(5 + 80.0 * float(written[0]) / slice_count, written[0])
+                if self._cancel:
+                    return False
+            if self._cancel:
+                return False
+            if write_errors:
                 self._write_message("Error writing new CWS file.")
                 self._success = False
                 self._message_final = "Error writing new CWS file"
+            return True
+        finally:
+            self._pipeline = ()
+            decoded.close()
+            encoded.close()
+            reader.join()
+            writer.join()
+
+    def _convert_slices_batch(self, jobs, slice_count, sizestr, mask_source, out_zf):
+        """Converts the slices listed in jobs (see _convert_slices) with as few ImageMagick processes as possible. Each
+        chunk of self.batch_size slices becomes one ImageMagick script that runs the usual flags on every slice in
+        turn. The mask comes from mask_source, the prepared mask file, or if that is None it is resized once per chunk.
+        The script prints each slice's number as it is written, which is what we use for progress. Returns False if
+        the job was cancelled."""
+        def quote(arg):
+            # ImageMagick scripts treat backslashes as escapes, but take forward slashes on every platform
+            arg = arg.replace('\\', '/')
+            return '"%s"' % arg if ' ' in arg else arg
+
+        self._set_stage("converting", len(jobs))
+        # slices are written to files, so when streaming they go through a scratch folder on their way into the zip
+        scratch = tempfile.mkdtemp() if self.streaming else None
+        # without a prepared mask, each script resizes the mask into memory once and reads it from there
+        mask_arg = None
+        if mask_source is not None:
+            mask_arg = quote(mask_source)
+        elif self.use_mask:
+            mask_arg = "mpr:hgmask"
+        try:
+            for start in range(0, len(jobs), self.batch_size):
+                chunk = jobs[start:start + self.batch_size]
+
+                # build the script. Grouping follows the command line, minus the *nix escaping.
+                prefix, flags = self._imagemagick_flags(sizestr, mask_arg, False)
+                lines = []
+                extracted = []
+                if mask_arg == "mpr:hgmask":
+                    lines.append(" ".join(["(", quote(self.mask_image), "-resize", "%s!" % sizestr, ")",
+                                           "-write", "mpr:hgmask", "+delete"]))
+                for cws_id, (in_fname, cws_in, cws_out) in enumerate(chunk, start):
+                    out_fname = os.path.join(scratch, "%04i.png" % cws_id) if self.streaming else cws_out
+                    if not isinstance(in_fname, basestring):
+                        in_fname, in_data = in_fname.imagemagick_input()
+                        if in_data is not None:
+                            # scripts can't read stdin, so slices from a zip stack go through the scratch folder
+                            if scratch is None:
+                                scratch = tempfile.mkdtemp()
+                            in_fname = os.path.join(scratch, "in%04i.%s" % (cws_id, in_fname.split(":")[0]))
+                            with open(in_fname, "wb") as fout:
+                                fout.write(in_data)
+                            extracted.append(in_fname)
+                    args = prefix + [quote(in_fname)] + flags + ["-write", quote(out_fname),
+                                                                 "-print", '"%i\\n"' % cws_id, "+delete"]
+                    lines.append(" ".join(args))
+                lines.append("-exit")
+                script_fd, script = tempfile.mkstemp(".mgk", dir=scratch)
+                with os.fdopen(script_fd, "w") as fout:
+                    fout.write("\n".join(lines) + "\n")
+
+                with self._procs_lock:
+                    if self._cancel:
+                        return False
+                    proc = subprocess.Popen([self.imagemagick_cmd, "-script", script], stdout=subprocess.PIPE,
+                                            shell=True)
+                    self._procs.add(proc)
+                try:
+                    # ImageMagick works through the script in order, so each number printed means that slice is done.
+                    last_done = time.time()
+                    for line in iter(proc.stdout.readline, ""):
+                        if not line.strip().isdigit():
+                            continue
+                        cws_id = int(line)
+                        if self._timer is not None:
+                            # one slice at a time, so the time since the last one is how long this one took
+                            self._timer.slice(time.time() - last_done)
+                            last_done = time.time()
+                        in_fname, cws_in, cws_out = jobs[cws_id]
+                        if not self.quiet:
+                            self._write_message("Converting slice %i/%i\r" % (cws_id, slice_count))
+
+                        if self.streaming:
+                            out_fname = os.path.join(scratch, "%04i.png" % cws_id)
+                            with open(out_fname, "rb") as fin:
+                                data = fin.read()
+                            out_zf.writestr(self._slice_info(cws_out), data)
+                            self._cache_slice(cws_out, data)
+                            self._count_written(cws_out, data)
+                            os.remove(out_fname)
+                        else:
+                            self._cache_slice(cws_out, None)
+                            self._count_written(cws_out, None)
+                            if re_match_path.sub("", cws_in).lower() != re_match_path.sub("", cws_out).lower():
+                                # delete the input cws image file if it is different than the output cws image file
+                                try:
+                                    os.remove(cws_in)
+                                except OSError:
+                                    pass        # don't care if it fails...
+
+                        self._set_progress(5 + 80.0 * float(cws_id + 1) / slice_count, cws_id + 1)
+                        if self._cancel:
+                            return False
+                    proc.wait()
+                finally:
+                    with self._procs_lock:
+                        self._procs.discard(proc)
+                    if proc.poll() is None:
+                        proc.kill()
+                    os.remove(script)
+                    for in_fname in extracted:
+                        os.remove(in_fname)
 
-            self._percent = 99
+                if self._cancel:
+                    return False
+                if proc.returncode != 0:
+                    self._write_message("Got an odd return code form ImageMagick. Output CWS may be corrupt, or ImageMagick Install Folder may need to be set.")
+                    self._success = False
+                    self._message_final = "Got an odd return code form ImageMagick. Output CWS may be corrupt, or ImageMagick Install Folder may need to be set."
+            return True
+        finally:
+            if scratch is not None:
+                shutil.rmtree(scratch, True)
+
+    def _prepare_imagemagick_mask(self, sizestr):
+        """Resizes the mask to sizestr with ImageMagick and saves it as an .mpc file (ImageMagick's own pixel cache
+        format, so nothing is lost to rounding) in the masks folder under settings_path. Later jobs with the same mask
+        file, modification time and size reuse it; the folder is kept under mask_cache_bytes by deleting the least
+        recently used masks. Returns the .mpc filename, or None if ImageMagick failed."""
+        mask_dir = os.path.join(settings_path, "masks")
+        key = "%s|%r|%s" % (os.path.abspath(self.mask_image), os.path.getmtime(self.mask_image), sizestr)
+        mpc = os.path.join(mask_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".mpc")
+        if os.path.exists(mpc) and os.path.exists(mpc[:-4] + ".cache"):
+            os.utime(mpc, None)     # mark it as recently used
+            return mpc
 
-            # delete the temporary directory
+        try:
+            if not os.path.exists(mask_dir):
+                os.makedirs(mask_dir)
+            self._run_imagemagick([self.imagemagick_cmd, self.mask_image, '-resize', '%s!' % sizestr, mpc])
+        except (subprocess.CalledProcessError, OSError):
+            return None
+
+        # evict the least recently used masks past the size limit
+        masks = []
+        for fname in glob.glob(os.path.join(mask_dir, "*.mpc")):
+            parts = [fname, fname[:-4] + ".cache"]
+            masks.append((os.path.getmtime(fname), sum(os.path.getsize(p) for p in parts if os.path.exists(p)), parts))
+        masks.sort(reverse=True)
+        total = 0
+        for mtime, size, parts in masks:
+            total += size
+            if total > self.mask_cache_bytes and parts[0] != mpc:
+                for part in parts:
+                    try:
+                        os.remove(part)
+                    except OSError:
+                        pass
+        return mpc
+
+    def _imagemagick_flags(self, sizestr, mask_source=None, escape=on_posix):
+        """Builds the ImageMagick arguments that convert one slice, returning (prefix, flags) to go before and after
+        the input slice filename. mask_source stands in for the mask filename (e.g. an mpr: image that has already
+        been resized), and escape escapes the parentheses for *nix shells."""
+        # set up the conversion function.
+        #  -filter Triangle -resize - scale the slice (see resize)
+        #  -negate - invert the image colors
+        #  -threshold - threshold at 50% brightness (to deal with gray inputs)
+        #  -background - set the background of any unused portion of the frame to black
+        #  -compose - operator for use when compositing new images on top of background pixels
+        #  -gravity - center the new image on the scene
+        #  -extent - size of output image (on which the input image will be composited)
+        #  -composite - command to combine the images
+        #  -alpha remove -colorspace Gray -depth 8 -strip - compact encoding (see slice_encoding); ImageMagick's png
+        #                 coder goes down to 1 bit by itself when the slice is only black and white
+        #  () - imagemagick groupings. Note that these have to be escaped on *nix shells, so I'll use variables for them
+
+        im_bp = '\\(' if escape else '('
+        im_ep = '\\)' if escape else ')'
+        imagemagick_prefix = [im_bp]
+        imagemagick_flags = []
+        if self._resize_geometry is not None:
+            imagemagick_flags.extend(['-filter', 'Triangle', '-resize', self._resize_geometry])
+        if self.negate:
+            imagemagick_flags.extend(['-channel', 'RGB', '-negate'])
+        if self.threshold:
+            imagemagick_flags.extend(['-threshold', '%i%%'%self.threshold_val])
+        imagemagick_flags.extend(['-background', 'black', '-compose', 'Copy', '-gravity', 'center', '-extent', sizestr, '-composite', im_ep])
+        if self.use_mask and mask_source is not None:
+            imagemagick_flags.extend([mask_source, '-compose', 'Multiply', '-gravity', 'center', '-composite'])
+        elif self.use_mask:
+            imagemagick_flags.extend([im_bp, self.mask_image, '-resize', '%s!'%sizestr, im_ep, '-compose',
+                                      'Multiply', '-gravity', 'center', '-composite'])
+        if self.slice_encoding == 'compact':
+            png_filter = 5 if self.png_filter == 'adaptive' else image_engine.PNG_FILTERS.index(self.png_filter)
+            imagemagick_flags.extend(['-background', 'black', '-alpha', 'remove', '-colorspace', 'Gray', '-depth', '8',
+                                      '-strip', '-define', 'png:compression-level=%i' % self.png_compress_level,
+                                      '-define', 'png:compression-filter=%i' % png_filter])
+        return imagemagick_prefix, imagemagick_flags
+
+    @staticmethod
+    def _png_size(data):
+        """Returns the (width, height) of a png from the start of its file contents (at least 24 bytes), which hold
+        the IHDR chunk. Raises ValueError if data isn't a png."""
+        if len(data) < 24 or data[:8] != "\x89PNG\r\n\x1a\n" or data[12:16] != "IHDR":
+            raise ValueError("Not a png file")
+        return struct.unpack(">II", data[16:24])
+
+    def _reuse_cached_slices(self, jobs, sizestr, out_zf, shared_slices):
+        """Looks up each of jobs (see _convert_slices) in the slice cache, and puts the slices it already has straight
+        into the output. Returns the jobs still to be converted, whose cache keys are left in _slice_keys for
+        _cache_slice, or None if the job was cancelled."""
+        params = [self.engine, self.negate, self.threshold, self.threshold_val, sizestr]
+        if self._resize_geometry is not None:
+            params.append(self._resize_geometry)
+        if self.slice_encoding == 'compact':
+            params.extend([self.slice_encoding, self.png_compress_level, self.png_filter])
+        if self.use_mask:
+            with open(self.mask_image, "rb") as fin:
+                params.append(hashlib.sha1(fin.read()).hexdigest())
+        params = repr(params)
+
+        self._set_stage("checking cache", len(jobs))
+        # keys and lookups by input slice, since repeat_first uses the same one for every layer
+        keys = {}
+        found = {}
+        misses = []
+        for cws_id, (in_fname, cws_in, cws_out) in enumerate(jobs):
+            if self._cancel:
+                return None
+            if not self.quiet:
+                self._write_message("Checking slice %i/%i\r" % (cws_id, len(jobs)))
+            if in_fname not in keys:
+                try:
+                    keys[in_fname] = self._slice_cache.key(in_fname, params)
+                except (IOError, OSError):
+                    keys[in_fname] = None       # let the conversion report the problem
+                else:
+                    found[in_fname] = self._slice_cache.get(keys[in_fname])
+                    if found[in_fname] is None:
+                        self._slice_keys[cws_out] = keys[in_fname]
+            data = found.get(in_fname)
+            if data is None:
+                misses.append((in_fname, cws_in, cws_out))
+                continue
+            if self.streaming or self.repeat_first:
+                self._store_slice(out_zf, shared_slices, cws_out, data)
+            else:
+                with open(cws_out, "wb") as fout:
+                    fout.write(data)
+            self._count_written(cws_out, data)
+            self._set_progress(5, cws_id + 1)
+
+            # delete the input cws image file if it is different than the output cws image file
+            if not self.streaming and re_match_path.sub("", cws_in).lower() != re_match_path.sub("", cws_out).lower():
+                try:
+                    os.remove(cws_in)
+                except OSError:
+                    pass        # don't care if it fails...
+        return misses
+
+    def _cache_slice(self, cws_out, data):
+        """Stores the newly converted output slice cws_out in the slice cache: data is its png contents, or None if it
+        was written to the file cws_out."""
+        key = self._slice_keys.pop(cws_out, None)
+        if key is None or self._slice_cache is None:
+            return
+        if data is None:
             try:
+                with open(cws_out, "rb") as fin:
+                    data = fin.read()
+            except IOError:
+                return
+        self._slice_cache.put(key, data)
+
+    def _store_slice(self, out_zf, shared_slices, cws_out, data):
+        """Stores data, the png contents of output slice cws_out. When streaming, it goes straight into the output zip
+        out_zf; otherwise it's kept in shared_slices (output slice filename -> png contents) and zipped at the end, so
+        layers that share an image don't each need a file in the temporary folder."""
+        if self.streaming:
+            out_zf.writestr(self._slice_info(cws_out), data)
+        else:
+            shared_slices[cws_out] = data
+
+    def _convert_slice(self, processor, im_flags, in_fname, out_fname):
+        """Converts one slice with the built-in engine processor or, if processor is None, ImageMagick using the
+        (prefix, flags) arguments in im_flags. Writes the result to out_fname, or returns the png contents if
+        out_fname is None. in_fname is a filename or a stack container entry (see ContainerStack)."""
+        if processor is not None:
+            if out_fname is None:
+                return processor.convert_to_bytes(in_fname)
+            processor.convert(in_fname, out_fname)
+            return None
+
+        in_arg, in_data = in_fname, None
+        if not isinstance(in_fname, basestring):
+            in_arg, in_data = in_fname.imagemagick_input()
+        args = [self.imagemagick_cmd]
+        args.extend(im_flags[0])
+        args.append(in_arg)
+        args.extend(im_flags[1])
+        args.append("png:-" if out_fname is None else out_fname)
+        # TESTING
+        #print(args)
+        return self._run_imagemagick(args, out_fname is None, in_data)
+
+    def _run_imagemagick(self, args, capture=False, input_data=None):
+        """Runs ImageMagick with args, returning its output if capture is True and feeding it input_data on stdin if
+        given. Raises CalledProcessError on an odd return code. The process is tracked so cancel() can kill it in the
+        middle of a slice."""
+        with self._procs_lock:
+            if self._cancel:
+                raise subprocess.CalledProcessError(-1, args)
+            proc = subprocess.Popen(args, stdout=subprocess.PIPE if capture else None,
+                                    stdin=subprocess.PIPE if input_data is not None else None, shell=True)
+            self._procs.add(proc)
+        try:
+            output = proc.communicate(input_data)[0]
+        finally:
+            with self._procs_lock:
+                self._procs.discard(proc)
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, args)
+        return output
+
+    def _kill_imagemagick(self):
+        """Kills any ImageMagick processes started by _run_imagemagick that are still running."""
+        with self._procs_lock:
+            for proc in self._procs:
+                try:
+                    proc.kill()
+                except OSError:
+                    pass        # already finished
+
+    def _cancel_job(self, cws_dir, tzf, out_zf, out_temp):
+        """Cleans up after a cancelled do_honeyguide job and sets the status to match. Returns (success, message)."""
+        try:
+            self._cleanup_job(cws_dir, tzf, out_zf, out_temp)
+        finally:
+            self._write_message("Cancelled!")
+            self._percent = 100
+            self._message_final = "Cancelled!"
+            self._success = False
+            self._finish()
+            return self._success, self._message_final
+
+    def _cleanup_job(self, cws_dir, tzf, out_zf, out_temp):
+        """Deletes the temporary directory (if any), closes the template and output zip files (if open) and removes
+        the unfinished output file (if any), and lets go of this job's slice stack container (if any). Never raises."""
+        try:
+            if self._stack is not None:
+                self._stack.release()
+        except:
+            pass
+        self._stack = None
+        for zf in (tzf, out_zf):
+            if zf is not None:
+                try:
+                    zf.close()
+                except:
+                    pass
+        try:
+            if out_temp is not None and os.path.exists(out_temp):
+                os.remove(out_temp)
+            if cws_dir is not None:
                 filelist = glob.glob(cws_dir + "/*.*")
                 for filename in filelist:
                     os.remove(filename)
                 os.rmdir(cws_dir)
-            finally:
-                self._write_message("Done!")
-                self._percent = 100
-                self._done = True
-                return self._success, self._message_final
+        except:
+            pass
 
-        except: # catch-all for the whole process.
-            self._write_message("An unknown error occurred")
-            self._success = False
-            self._message_final = "An unknown error occurred"
-            self._done = True
-            return self._success, self._message_final
+    def _trim_print(self, template, layers):
+        """Returns the gcode and manifest.xml of template (a CwsTemplate) cut down to their first layers layers, as a
+        dictionary of new contents by entry name, or None (after a warning) if the gcode can't be cut down."""
+        trimmed = {}
+        zf = zipfile.ZipFile(template.fname, "r")
+        try:
+            for name in zf.namelist():
+                if name.lower().endswith(".gcode"):
+                    gcode = self._trim_gcode(zf.read(name), layers, template.slicing.get("GCodeFooter"))
+                    if gcode is None:
+                        self._write_message("Warning: couldn't find the layers in %s, so the print isn't trimmed." %
+                                            name)
+                        return None
+                    trimmed[name] = gcode
+                elif name.lower().endswith("manifest.xml"):
+                    trimmed[name] = self._trim_manifest(zf.read(name), layers)
+        finally:
+            zf.close()
+        return trimmed
+
+    @staticmethod
+    def _write_profiled_gcode(profile, source, out_zf, out_name):
+        """Writes the gcode lines from source with profile applied (see ExposureProfile.rewrite) to the file called
+        out_name, or with out_zf given, into that zip file as entry out_name (a name or ZipInfo). zipfile can only
+        add whole entries, so the gcode goes through a scratch file on its way into the zip rather than memory."""
+        if out_zf is None:
+            with open(out_name, "wb") as outfile:
+                outfile.writelines(profile.rewrite(source))
+            return
+        handle, scratch = tempfile.mkstemp(suffix=".gcode")
+        try:
+            with os.fdopen(handle, "wb") as outfile:
+                outfile.writelines(profile.rewrite(source))
+            if isinstance(out_name, zipfile.ZipInfo):
+                out_zf.write(scratch, out_name.filename, out_name.compress_type)
+            else:
+                out_zf.write(scratch, out_name)
+        finally:
+            os.remove(scratch)
+
+    @staticmethod
+    def _trim_gcode(gcode, layers, footer=None):
+        """Returns Creation Workshop gcode with only its first layers layers, or None if it doesn't have that many.
+        A layer runs from its pre-slice block (or its ;<Slice> line if there isn't one) through its exposure, blank
+        and lift sequence, so the header, the Z moves and lift sequences of the layers we keep and the footer stay
+        exactly as they were. The footer starts at its Footer Start comment, or failing that at the first line of
+        footer (the GCodeFooter setting from the .slicing file). The Number of Slices comment is updated to match."""
+        lines = gcode.splitlines(True)
+        starts = {}
+        for i, line in enumerate(lines):
+            result = re_match_gcode_slice.match(line.strip())
+            if result is not None:
+                starts.setdefault(int(result.group(1)), i)
+        if layers not in starts:
+            return None
+
+        # back up to the start of the first dropped layer's pre-slice block
+        cut = starts[layers]
+        for i in range(cut - 1, starts.get(layers - 1, -1), -1):
+            if "Pre-Slice Start" in lines[i]:
+                cut = i
+                break
+
+        last = max(starts.values())
+        footer_start = None
+        for i in range(last, len(lines)):
+            if "Footer Start" in lines[i]:
+                footer_start = i
+                break
+        if footer_start is None and footer is not None:
+            footer_lines = footer.strip().splitlines()
+            if not footer_lines:
+                footer_start = len(lines)
+            for i in range(last, len(lines)):
+                if footer_lines and lines[i].strip() == footer_lines[0].strip():
+                    footer_start = i
+                    break
+        if footer_start is None:
+            return None
+        return re_match_gcode_count.sub(lambda result: result.group(1) + str(layers),
+                                        "".join(lines[:cut] + lines[footer_start:]), 1)
+
+    @staticmethod
+    def _trim_manifest(manifest, layers):
+        """Returns the text of a manifest.xml listing only its first layers slices. Everything else, formatting
+        included, is left alone."""
+        entries = list(re.finditer(r"\s*<Slice>.*?</Slice>", manifest, re.DOTALL))
+        if len(entries) <= layers:
+            return manifest
+        return manifest[:entries[layers].start()] + manifest[entries[-1].end():]
+
+    @staticmethod
+    def _template_has(cws_name, tzf):
+        """Returns True if the template slice cws_name exists, either in the zip file tzf (streaming) or on disk
+        (tzf is None)."""
+        if tzf is None:
+            return os.path.exists(cws_name)
+        return cws_name in tzf.NameToInfo
+
+    @staticmethod
+    def _slice_info(name):
+        """Returns the ZipInfo to use when writing the slice called name into an output CWS."""
+        info = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+        info.compress_type = zipfile.ZIP_STORED     # pngs are already compressed
+        info.external_attr = 0o644 << 16
+        return info
 
     def status_check(self):
         """Returns the status of a background honeyguide operation in the tuple (done?, success?, message, percent)
@@ -481,7 +2229,112 @@ class Honeyguide:
         operation failed and True if it succeeded (value indeterminate if done==False), message is the final output
         message from the process (but indeterminate during run) and percent stores the percentage of the
         operation that's complete at this time."""
-        return self._done, self._success, self._message_final, self._percent
+        with self._status_lock:
+            return self._done, self._success, self._message_final, self._percent
+
+    def progress(self):
+        """Returns a ProgressEvent snapshot of the job as it is right now."""
+        with self._status_lock:
+            elapsed = time.time() - self._stage_start
+            rate = self._slice / elapsed if self._slice > 0 and elapsed > 0 else 0.
+            eta = None
+            if rate > 0 and self._slice_count >= self._slice:
+                eta = (self._slice_count - self._slice) / rate
+            return ProgressEvent(self._stage, self._slice, self._slice_count, rate, self._bytes_written, eta,
+                                 self._percent, self._last_message, self._done,
+                                 self._success if self._done else None)
+
+    def subscribe(self, callback, interval=0.1):
+        """Calls callback(event) with a ProgressEvent as the job goes. Events are coalesced to at most one every
+        interval seconds, except that the start of each stage and the end of the job are always sent. Callbacks run
+        on the job's thread (so GUIs should hand them back to their own thread) and mustn't take long."""
+        with self._status_lock:
+            self._subscribers.append([callback, interval, 0.])
+
+    def unsubscribe(self, callback):
+        """Stops sending events to callback."""
+        with self._status_lock:
+            self._subscribers = [sub for sub in self._subscribers if sub[0] != callback]
+
+    def _start_job(self):
+        """Resets the status for a new job."""
+        with self._status_lock:
+            self._done = False
+            self._success = True
+            self._message_final = "Success"
+            self._cancel = False
+            self._percent = 0
+            self._bytes_written = 0
+            self._last_message = ""
+        self._messages = Queue.Queue()      # status_message() is only for the job at hand
+        self.timing_report = None
+        self._timer = StageTimer(self.timing_cpu) if self.timing else None
+        self._set_stage("starting")
+
+    def _set_stage(self, stage, slice_count=0):
+        """Starts a new stage of the job, with slice_count slices to get through (0 if it isn't counted in slices)."""
+        if self._timer is not None:
+            self._timer.stage(stage)
+        with self._status_lock:
+            self._stage = stage
+            self._stage_start = time.time()
+            self._slice = 0
+            self._slice_count = slice_count
+        self._publish(True)
+
+    def _set_progress(self, percent, slice_id=None):
+        """Updates the overall percent complete and, if given, how many slices of this stage are done."""
+        with self._status_lock:
+            self._percent = percent
+            if slice_id is not None:
+                self._slice = slice_id
+        self._publish(False)
+
+    def _count_written(self, cws_out, data):
+        """Adds the size of output slice cws_out to the bytes written: len(data), or the file's size if data is None."""
+        try:
+            size = len(data) if data is not None else os.path.getsize(cws_out)
+        except OSError:
+            return
+        with self._status_lock:
+            self._bytes_written += size
+
+    def _finish(self):
+        """Marks the job as done and sends the final event. _success and _message_final need to be set already."""
+        if self._timer is not None:
+            self._timer.stage(None)
+            report = self._timer.report()
+            report.update(success=self._success, message=self._message_final, engine=self.engine,
+                          workers=self.workers, streaming=self.streaming, pipeline=self.pipeline)
+            self.timing_report = report
+            self._timer = None
+            if self.timing_log:
+                try:
+                    with open(os.path.join(settings_path, "timing.log"), "a") as fout:
+                        fout.write(json.dumps(report, sort_keys=True) + "\n")
+                except IOError:
+                    pass
+        with self._status_lock:
+            self._stage = "done"
+            self._done = True
+        self._publish(True)
+
+    def _publish(self, force):
+        """Sends the current progress to the subscribers that are due an event (all of them if force)."""
+        if not self._subscribers:
+            return
+        now = time.time()
+        with self._status_lock:
+            due = [sub for sub in self._subscribers if force or now - sub[2] >= sub[1]]
+            for sub in due:
+                sub[2] = now
+        if due:
+            event = self.progress()
+            for sub in due:
+                try:
+                    sub[0](event)
+                except Exception:
+                    pass        # a broken subscriber shouldn't take the job down with it
 
     def status_message(self):
         """Returns the most recent status message from the background honeyguide job. If nothing's new, returns an
@@ -489,17 +2342,24 @@ class Honeyguide:
         return "" if self._messages.empty() else self._messages.get()
 
     def cancel(self):
-        """Cancels the background Honeyguide operation."""
+        """Cancels the background Honeyguide operation. Any ImageMagick processes still running are killed so the job
+        stops promptly."""
         self._cancel = True
+        self._kill_imagemagick()
+        for queue in self._pipeline:
+            queue.close()
     
     def _write_message(self, message):
         """Writes a message to the status message queue for future reading if running in background. Also prints
         it to the console. Doesn't use the mutex because queues are thread safe"""
         self._messages.put(message)
+        with self._status_lock:
+            self._last_message = message.rstrip("\r")
         self._log(message)
 
     def _log(self, message):
-        print(message)
+        if self.echo:
+            print(message)
         try:
             if self.logfile is not None:
                 self.logfile.write(message + "\n")
@@ -516,39 +2376,145 @@ class Honeyguide:
         else:
             return filename
 
-    def _get_size_str(self, im_name) :
-        """Returns the size of an image as a string, "WWWxHHH" in a format ImageMagick can recognize.
-        * im_name = name of image to check size of.
-        """
-        # gets the size of the image in a form imagemagick can understand
+    def extract_slices(self, cws_file, out_dir, first=0, last=None, out_format="png", depth=None):
+        """Copies slices out of a CWS file, reading them straight from the zip instead of extracting the archive.
+        Options:
+          * cws_file - CWS file to read the slices from.
+          * out_dir - folder to write the slices to; it's created if need be. The slices keep their names from the
+                      CWS, with out_format's extension.
+          * first, last - numbers (the NNNN in the slice names) of the first and last slices to extract. last=None
+                      means through the last slice in the CWS.
+          * out_format - 'png', 'tif' or 'bmp'.
+          * depth - bits per channel of the extracted slices, 1, 8 or 16, or None to keep each slice's own.
+
+        With the default out_format and depth the slices are copied byte for byte. Otherwise each is decoded and saved
+        again with the built-in image engine, on self.workers processes at a time. Progress, cancel() and the
+        status work as for do_honeyguide, with the stage 'extracting'.
+
+        Output: Returns (success, message), where success is a boolean and message is a string explaining what went
+        wrong."""
+        self._start_job()
+        convert = out_format != "png" or depth is not None
+        zf = None
+        pool = None
         try:
-            sizestr = subprocess.check_output([self.imagemagick_cmd, im_name, '-ping', '-format', '"%wx%h"', 'info:'], shell=True)
-            return sizestr[1:-1]     # trim leading & trailing quotes
-        except subprocess.CalledProcessError:
-            return ""
+            if out_format not in ("png", "tif", "bmp") or depth not in (None, 1, 8, 16):
+                self._write_message("Can't extract slices as %s at %s bits." % (out_format, depth))
+                self._success = False
+                self._message_final = "Unsupported output format"
+                return self._success, self._message_final
+            if convert and not image_engine.available:
+                self._write_message("Converting extracted slices needs numpy and Pillow.")
+                self._success = False
+                self._message_final = "Built-in image engine unavailable"
+                return self._success, self._message_final
+            try:
+                zf = zipfile.ZipFile(cws_file, "r")
+            except (IOError, zipfile.BadZipfile):
+                self._write_message("Error reading CWS file.")
+                self._success = False
+                self._message_final = "Error reading CWS file."
+                return self._success, self._message_final
 
-    @staticmethod
-    def _count_slice_images(slice_fname, slice_numpad, slice_id):
-        # iterate until we can't find a next matching slice image name.
-        next_slice = slice_fname
-        count = 0
+            chosen = []
+            for info in self._cws_slices(zf):
+                number = int(re_match_cws_slice.match(info.filename).group(2))
+                if number >= first and (last is None or number <= last):
+                    chosen.append(info)
+            if not chosen:
+                self._write_message("No slices in %s are in the range asked for." % cws_file)
+                self._success = False
+                self._message_final = "No slices to extract"
+                return self._success, self._message_final
+            if not os.path.exists(out_dir):
+                os.makedirs(out_dir)
+
+            self._set_stage("extracting", len(chosen))
+            workers = self.workers if self.workers > 0 else multiprocessing.cpu_count()
+            if convert and workers > 1 and len(chosen) > 1:
+                pool = multiprocessing.Pool(workers)
+            def write(out_fname, data):
+                with open(out_fname, "wb") as fout:
+                    fout.write(data)
+
+            def save(info, out_fname, work):
+                # work() writes out_fname
+                try:
+                    work()
+                    self._count_written(out_fname, None)
+                except (IOError, ValueError) as e:
+                    self._write_message("Error extracting %s: %s" % (info.filename, e))
+                    self._success = False
+                    self._message_final = "Error extracting %s" % info.filename
+
+            pending = collections.deque()
+            for slice_id, info in enumerate(chosen):
+                out_fname = os.path.join(out_dir, re_match_path.sub("", info.filename)[:-4] + "." + out_format)
+                data = zf.read(info)
+                if pool is not None:
+                    pending.append((info, out_fname, pool.apply_async(image_engine.save_as,
+                                                                      (data, out_fname, out_format, depth))))
+                elif convert:
+                    save(info, out_fname, functools.partial(image_engine.save_as, data, out_fname, out_format, depth))
+                else:
+                    save(info, out_fname, functools.partial(write, out_fname, data))
+
+                # keep a few slices queued per worker, which also bounds how many we hold in memory
+                while pending and (len(pending) >= 4 * workers or slice_id == len(chosen) - 1):
+                    while not pending[0][2].ready():
+                        pending[0][2].wait(0.1)
+                        if self._cancel:
+                            return self._cancel_extract()
+                    pending_info, pending_fname, result = pending.popleft()
+                    save(pending_info, pending_fname, result.get)
+
+                done = slice_id + 1 - len(pending)
+                self._set_progress(100.0 * done / len(chosen), done)
+                if self._cancel:
+                    return self._cancel_extract()
 
-        while os.path.exists(next_slice):
-            # figure out the next filenames based on the current ones.
-            slice_id += 1
-            count += 1
-            next_slice = re_match_last_number.sub(("%0" + ('%i'%slice_numpad) + "i") % slice_id, slice_fname)
+            self._write_message("Extracted %i slices to %s." % (len(chosen), out_dir))
+            return self._success, self._message_final
+        except:
+            self._write_message("An unknown error occurred")
+            self._success = False
+            self._message_final = "An unknown error occurred"
+            return self._success, self._message_final
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            if zf is not None:
+                zf.close()
+            if not self._done:
+                self._finish()
 
-        return count
+    def _cancel_extract(self):
+        """Finishes a cancelled extract_slices. The slices already written are left in place."""
+        self._write_message("Cancelled.")
+        self._success = False
+        self._message_final = "Cancelled"
+        return self._success, self._message_final
 
-    def compare_cws_files(self, file1, file2, imagemagick_cmd="magick"):
+    def compare_cws_files(self, file1, file2, imagemagick_cmd="magick", in_process=None, displayed=False):
         """Compares two CWS files, checking for differences and storing them in ./<file1 fname>_diff.
         Returns True if the cws files contain identical data (images, gcode, slicing files, and manifest)
-        and False otherwise."""
+        and False otherwise.
+        With in_process, the files are compared where they are with the built-in image engine instead of being
+        extracted and compared with ImageMagick (see _compare_cws_archives). None means do that if numpy and Pillow
+        are available.
+        With displayed, slices are compared as the printer host shows them (see image_engine.compare_images), so
+        slices written with compact encoding match references that hold the same picture at a higher bit depth or with
+        alpha. This always compares in process."""
         if not os.path.exists(file1) or not os.path.exists(file2):
             self._log("Can't find one of the input files for comparing")
             return False
 
+        if in_process is None:
+            in_process = image_engine.available
+        if in_process or displayed:
+            return self._compare_cws_archives(file1, file2, os.path.join(".", file1[:-4] + "_diff"), displayed)
+
         same = True
 
         cws_dir1 = tempfile.mkdtemp()
@@ -571,6 +2537,8 @@ class Honeyguide:
                 zf.close()
             finally:
                 self._log("Error reading CWS files.")
+                shutil.rmtree(cws_dir1, True)
+                shutil.rmtree(cws_dir2, True)
                 return False
 
         # use the filenames to find the images inside. This is not intuitive, but it's how CW works.
@@ -685,8 +2653,105 @@ class Honeyguide:
             except:
                 pass
 
+        shutil.rmtree(cws_dir1, True)
+        shutil.rmtree(cws_dir2, True)
+        return same
+
+    def _compare_cws_archives(self, file1, file2, diff_dir, displayed=False):
+        """Does the work of compare_cws_files without ImageMagick or temporary folders, reading both CWS files in
+        place. Slice pairs whose CRC32 and size in the zip directories already match are taken to be the same without
+        reading them; the rest are compared pixel by pixel with image_engine.compare_images, on self.workers processes
+        at a time. diff_dir is only created if something differs, and diff images are only written for the slices that
+        do."""
+        try:
+            zf1 = zipfile.ZipFile(file1, "r")
+            try:
+                zf2 = zipfile.ZipFile(file2, "r")
+            except:
+                zf1.close()
+                raise
+        except (IOError, zipfile.BadZipfile):
+            self._log("Error reading CWS files.")
+            return False
+
+        same = True
+        pool = None
+        try:
+            slices1 = self._cws_slices(zf1)
+            slices2 = self._cws_slices(zf2)
+            if len(slices1) != len(slices2):
+                self._log("CWS's have a different number of images in them!")
+                same = False
+
+            changed = [(cws_id, info1, info2) for cws_id, (info1, info2) in enumerate(zip(slices1, slices2))
+                       if info1.CRC != info2.CRC or info1.file_size != info2.file_size]
+            workers = self.workers if self.workers > 0 else multiprocessing.cpu_count()
+            if workers > 1 and len(changed) > 1:
+                pool = multiprocessing.Pool(workers)
+
+            diffcount = 0
+            pending = collections.deque()
+            for i, (cws_id, info1, info2) in enumerate(changed):
+                diffname = os.path.join(diff_dir, "diff%04u.png" % cws_id)
+                args = (zf1.read(info1), zf2.read(info2), diffname, displayed)
+                if pool is None:
+                    pending.append((diffname, compare_slice_data(*args)))
+                else:
+                    pending.append((diffname, pool.apply_async(compare_slice_data, args)))
+
+                # keep a few pairs queued per worker, which also bounds how many we hold in memory, and log the
+                # differences in slice order
+                while pending and (pool is None or len(pending) >= 4 * workers or i == len(changed) - 1):
+                    diffname, count = pending.popleft()
+                    if pool is not None:
+                        count = count.get()
+                    if count is None or count > 0:
+                        diffcount += 1
+                        self._log("Found differences: %s" % diffname)
+
+            if diffcount > 0:
+                self._log("Found differences on at least one slice.")
+                same = False
+
+            # check the gcode, slicing and manifest files
+            for ending, kind, mismatch in ((".gcode", "gcode", "Gcode files don't match."),
+                                           (".slicing", "slicing", "Slicing files don't match."),
+                                           ("manifest.xml", "manifest", "Manifest files don't match. This usually does not cause issues.")):
+                names1 = [name for name in zf1.namelist() if name.lower().endswith(ending)]
+                names2 = [name for name in zf2.namelist() if name.lower().endswith(ending)]
+                if len(names1) != 1 or len(names2) != 1:
+                    self._log("More than one %s file detected! Only the first one is checked." % kind)
+                if len(names1) == 0 or len(names2) == 0:
+                    self._log("No %s file in one of the CWS files." % kind)
+                    same = False
+                    continue
+                if not Honeyguide._diff_text(zf1.read(names1[0]).splitlines(True), zf2.read(names2[0]).splitlines(True),
+                                             os.path.split(file1)[1], os.path.split(file2)[1], diff_dir,
+                                             os.path.split(names1[0])[1]):
+                    self._log(mismatch)
+                    same = False
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            zf1.close()
+            zf2.close()
+
         return same
 
+    @staticmethod
+    def _cws_slices(zf):
+        """Returns the ZipInfos of the slices in an open CWS file, in order. Slices are the pngs named <stem>NNNN.png;
+        if more than one stem turns up, the one with the most slices wins."""
+        stacks = {}
+        for info in zf.infolist():
+            result = re_match_cws_slice.match(info.filename)
+            if result is not None:
+                stacks.setdefault(result.group(1), []).append((int(result.group(2)), info.filename, info))
+        if not stacks:
+            return []
+        return [info for number, name, info in sorted(max(stacks.values(), key=len))]
+
     @staticmethod
     def _diff_text_files(file1, file2, name1, name2, diffdir):
         """Compares two text files. If there are differences, creates an html diff using pythons diff utility.
@@ -695,25 +2760,26 @@ class Honeyguide:
 
         fromlines = open(file1, 'U').readlines()
         tolines = open(file2, 'U').readlines()
+        return Honeyguide._diff_text(fromlines, tolines, name1, name2, diffdir, os.path.split(file1)[1])
 
-        # check for any differences between the two files
-        same = True
-        for line_id in range(len(tolines)):
-            if fromlines[line_id] != tolines[line_id]:
-                same = False
-                break
-
-        if same:
+    @staticmethod
+    def _diff_text(fromlines, tolines, name1, name2, diffdir, diffname):
+        """Compares two lists of lines. If there are differences, writes an html diff called diffname into diffdir
+        (creating it if need be). Returns same? (boolean)"""
+        # line endings don't count
+        if [line.rstrip("\r\n") for line in fromlines] == [line.rstrip("\r\n") for line in tolines]:
             return True
-        else:
-            diff = difflib.HtmlDiff().make_file(fromlines, tolines, name1, name2, context=True, numlines=3)
-            with open(os.path.join(diffdir, os.path.split(file1)[1]), "w") as fout:
-                fout.writelines(diff)
-            return False
+        diff = difflib.HtmlDiff().make_file(fromlines, tolines, name1, name2, context=True, numlines=3)
+        if not os.path.exists(diffdir):
+            os.makedirs(diffdir)
+        with open(os.path.join(diffdir, diffname), "w") as fout:
+            fout.writelines(diff)
+        return False
 
 
 # Run some checks to see if my cws files match a reference set
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
 
     h = Honeyguide()
     cp = ConfigParser.SafeConfigParser()
@@ -723,6 +2789,20 @@ if __name__ == "__main__":
     temp_dir = tempfile.mkdtemp()
 
     h.imagemagick_cmd = cp.get("General", "imagemagickcmd")
+    if cp.has_option("General", "engine"):
+        h.engine = cp.get("General", "engine")
+    if cp.has_option("General", "streaming"):
+        h.streaming = cp.getboolean("General", "streaming")
+    if cp.has_option("General", "workers"):
+        h.workers = cp.getint("General", "workers")
+    if cp.has_option("General", "pipeline"):
+        h.pipeline = cp.getboolean("General", "pipeline")
+    if cp.has_option("General", "slice_encoding"):
+        h.slice_encoding = cp.get("General", "slice_encoding")
+    # the tests check conversion, so don't let converted slices from an earlier run stand in for it
+    h.slice_cache_bytes = 0
+    if cp.has_option("General", "slice_cache_bytes"):
+        h.slice_cache_bytes = cp.getint("General", "slice_cache_bytes")
     h.quiet = True
 
     all_passed = True
@@ -749,7 +2829,7 @@ if __name__ == "__main__":
 
             # check the results
             print("Checking %s" % test)
-            if h.compare_cws_files(refcws, temp_cws, h.imagemagick_cmd):
+            if h.compare_cws_files(refcws, temp_cws, h.imagemagick_cmd, displayed=h.slice_encoding == 'compact'):
                 print("%s Passed" % test)
             else:
                 print("%s Failed!" % test)
@@ -38,11 +38,6 @@
 # TODO:
 #  - Document advanced options in Instructions
 #  - Have the app log capture python errors, if possible
-#
-# Future Features:
-#  - Add image resizing
-#  - Add output CWS preview
-#  - Add extracting slices from CWS files
 
 
 __author__ = 'Ben Weiss'
@@ -50,19 +45,111 @@ __author__ = 'Ben Weiss'
 import sys
 import ttk
 import os
+import multiprocessing
+import threading
+import Queue
+import collections
 import cws_scripts
 import ConfigParser as cp
 import workingDialog
+import previewDialog
 
 import Tkinter as tk
 import tkFileDialog
 
 
+class BackgroundChecker:
+    """Runs the slow validation checks (opening a CWS zip, scanning a slice stack) on a worker thread so the window
+    stays responsive, and hands their results back on the Tk thread. Only the latest check for each field counts:
+    asking again cancels an earlier check that hasn't started yet, and drops the result of one that's running.
+    Results are cached by the path, size and modification time of the files they looked at."""
+
+    cache_size = 64
+
+    def __init__(self, widget):
+        self.widget = widget
+        self._requests = Queue.Queue()
+        self._results = Queue.Queue()
+        self._latest = {}       # field -> id of the newest check for it
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._cache = collections.OrderedDict()
+
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+        self.widget.after(50, self._poll)
+
+    def check(self, field, callback, failed, func, *args, **kwargs):
+        """Runs func(*args) in the background and calls callback(result) on the Tk thread when it's done, unless
+        another check for field was asked for in the meantime. failed is the result to use if func raises. Pass
+        key_files, a list of filenames, to cache the result for as long as those files don't change."""
+        with self._lock:
+            self._next_id += 1
+            self._latest[field] = self._next_id
+            request = (field, self._next_id, callback, failed, func, args, kwargs.get("key_files"))
+        self._requests.put(request)
+
+    def cancel(self, field):
+        """Forgets about any check running for field."""
+        with self._lock:
+            self._latest.pop(field, None)
+
+    def _current(self, field, request_id):
+        with self._lock:
+            return self._latest.get(field) == request_id
+
+    def _run(self):
+        while True:
+            field, request_id, callback, failed, func, args, key_files = self._requests.get()
+            if not self._current(field, request_id):
+                continue        # superseded before it started
+
+            key = None
+            if key_files is not None:
+                key = [func.__name__] + list(args)
+                for fname in key_files:
+                    try:
+                        key.append((os.path.abspath(fname), os.path.getsize(fname), os.path.getmtime(fname)))
+                    except OSError:
+                        key.append((fname, None, None))
+                key = tuple(key)
+            with self._lock:
+                result = self._cache.pop(key, None) if key is not None else None
+                if result is not None:
+                    self._cache[key] = result
+
+            if result is None:
+                try:
+                    result = func(*args)
+                except Exception:
+                    result = failed
+                else:
+                    if key is not None:
+                        with self._lock:
+                            self._cache[key] = result
+                            while len(self._cache) > self.cache_size:
+                                self._cache.popitem(last=False)
+            self._results.put((field, request_id, callback, result))
+
+    def _poll(self):
+        try:
+            while True:
+                field, request_id, callback, result = self._results.get_nowait()
+                if self._current(field, request_id):
+                    self.cancel(field)
+                    callback(result)
+        except Queue.Empty:
+            pass
+        self.widget.after(50, self._poll)
+
+
 class Application(ttk.Frame):
     def __init__(self, master=None, logfile=None):
         # Non-TK class variables:
         self.logfile = logfile
         self.template_slices = 0
+        self.template = None        # the CwsTemplate from the last template check
         self.image_slices = 0
         self.cws = cws_scripts.Honeyguide(logfile)
         self.imagemagick_command = 'magick'
@@ -109,6 +196,29 @@ class Application(ttk.Frame):
         self.imagemagick_path = tk.StringVar(value=os.path.abspath("./ImageMagick"))
         self.imagemagick_message = tk.StringVar()
 
+        self.engine = tk.StringVar()
+        self.engine.set("imagemagick")
+
+        self.workers = tk.StringVar()
+        self.workers.set("0")
+
+        self.resize = tk.StringVar()
+        self.resize.set("none")
+        self.input_pitch = tk.StringVar()
+        self.input_pitch.set("50")
+
+        self.compact = tk.BooleanVar()
+        self.compact.set(False)
+
+        self.trim_to_stack = tk.BooleanVar()
+        self.trim_to_stack.set(False)
+
+        self.slice_cache = tk.BooleanVar()
+        self.slice_cache.set(False)
+
+        self.exposure_profile = tk.StringVar()
+        self.profile_message = tk.StringVar()
+
         # Text validators
         templateValCmd = self.register(self.template_validate)
         imageValCmd = self.register(self.image_validate)
@@ -116,6 +226,9 @@ class Application(ttk.Frame):
         maskValCmd = self.register(self.mask_validate)
         threshValCmd = self.register(self.threshold_validate)
         impValCmd = self.register(self.imagemagick_path_validate)
+        workersValCmd = self.register(self.workers_validate)
+        pitchValCmd = self.register(self.pitch_validate)
+        profileValCmd = self.register(self.profile_validate)
 
         # Associated conditions for Process button enabling:
         self.template_ok = False
@@ -123,6 +236,13 @@ class Application(ttk.Frame):
         self.output_ok = False
         self.thresh_ok = False
         self.imagemagick_ok = False
+        self.workers_ok = True
+        self.pitch_ok = True
+        self.profile_ok = True
+        self.mask_ok = False
+
+        # template, image and mask checks run in the background
+        self.checker = BackgroundChecker(self)
 
         # Create the widgets
         ttk.Label(self, text="Template CWS:").grid(column=0, row=1, sticky=tk.E)
@@ -168,7 +288,11 @@ class Application(ttk.Frame):
         self.go_button = ttk.Button(subframe, text='Process', command=self.go)
         self.go_button.state(["disabled"])
         self.go_button.grid(column=2, row=0)
-        ttk.Button(subframe, text='Quit', command=self.close).grid(column=3, row=0)
+        self.preview_button = ttk.Button(subframe, text='Preview', command=self.preview)
+        if not previewDialog.available:
+            self.preview_button.state(["disabled"])     # needs numpy and Pillow with ImageTk
+        self.preview_button.grid(column=3, row=0)
+        ttk.Button(subframe, text='Quit', command=self.close).grid(column=4, row=0)
         for child in subframe.winfo_children(): child.grid_configure(padx=3, pady=4)
 
         # Advanced options
@@ -209,6 +333,51 @@ class Application(ttk.Frame):
                         command=self.image_validate)\
             .grid(column=0, row=5, padx=3, pady=4, sticky=tk.W)
 
+        subframe = ttk.Frame(self.adv_frame)
+        subframe.grid(column=0, row=7, sticky=tk.W)
+        ttk.Label(subframe, text="Image Processing:").grid(column=0, row=0, padx=3, pady=4, sticky=tk.W)
+        for column, (text, value) in enumerate([("ImageMagick", "imagemagick"),
+                                                ("ImageMagick (batched)", "imagemagick_batch"),
+                                                ("Built-in (no ImageMagick)", "builtin")]):
+            ttk.Radiobutton(subframe, text=text, variable=self.engine, value=value,
+                            command=self.imagemagick_path_validate)\
+                .grid(column=column + 1, row=0, padx=3, pady=4, sticky=tk.W)
+
+        subframe = ttk.Frame(self.adv_frame)
+        subframe.grid(column=0, row=8, sticky=tk.W)
+        ttk.Label(subframe, text="Parallel Workers (0 = all cores):").grid(column=0, row=0, padx=3, pady=4, sticky=tk.W)
+        ttk.Entry(subframe, textvariable=self.workers, width=5, validate='all', validatecommand=workersValCmd)\
+            .grid(column=1, row=0, padx=3, pady=4, sticky=tk.W)
+
+        subframe = ttk.Frame(self.adv_frame)
+        subframe.grid(column=0, row=9, sticky=tk.W)
+        ttk.Label(subframe, text="Scale Slices:").grid(column=0, row=0, padx=3, pady=4, sticky=tk.W)
+        for column, (text, value) in enumerate([("No", "none"), ("To Fit", "fit"), ("To Pixel Pitch", "pitch")]):
+            ttk.Radiobutton(subframe, text=text, variable=self.resize, value=value, command=self.pitch_validate)\
+                .grid(column=column + 1, row=0, padx=3, pady=4, sticky=tk.W)
+        ttk.Label(subframe, text="Input Pixel (um):").grid(column=4, row=0, padx=3, pady=4, sticky=tk.W)
+        ttk.Entry(subframe, textvariable=self.input_pitch, width=8, validate='all', validatecommand=pitchValCmd)\
+            .grid(column=5, row=0, padx=3, pady=4, sticky=tk.W)
+
+        ttk.Checkbutton(self.adv_frame, text="Compact Slices (1-bit or 8-bit grayscale)", variable=self.compact)\
+            .grid(column=0, row=10, padx=3, pady=4, sticky=tk.W)
+
+        ttk.Checkbutton(self.adv_frame, text="End Print at Last Image (don't blank the rest of the template)",
+                        variable=self.trim_to_stack, command=self.output_validate)\
+            .grid(column=0, row=11, padx=3, pady=4, sticky=tk.W)
+
+        subframe = ttk.Frame(self.adv_frame)
+        subframe.grid(column=0, row=12, sticky=tk.W)
+        ttk.Label(subframe, text="Exposure Profile:").grid(column=0, row=0, padx=3, pady=4, sticky=tk.W)
+        self.profile_entry = ttk.Entry(subframe, width=35, textvariable=self.exposure_profile, validate='focusout',
+                                       validatecommand=profileValCmd)
+        self.profile_entry.grid(column=1, row=0, padx=3, pady=4, sticky=tk.W)
+        ttk.Button(subframe, text="...", width=3, command=self.profile_dialog).grid(column=2, row=0, padx=3, pady=4)
+        ttk.Label(subframe, textvariable=self.profile_message).grid(column=3, row=0, padx=3, pady=4)
+
+        ttk.Checkbutton(self.adv_frame, text="Reuse Converted Slices From Earlier Runs", variable=self.slice_cache)\
+            .grid(column=0, row=13, padx=3, pady=4, sticky=tk.W)
+
         subframe = ttk.Frame(self.adv_frame)
         subframe.grid(column=0, row=6, sticky=tk.W)
         ttk.Label(subframe, text="ImageMagick Install Folder:").grid(column=0, row=0, padx=3, pady=4)
@@ -234,6 +403,9 @@ class Application(ttk.Frame):
         self.tl = tk.Toplevel(self)
         self.tl.withdraw()
         self.working_dialog = workingDialog.Working(self.tl, logfile)
+        self.preview_tl = tk.Toplevel(self)
+        self.preview_tl.withdraw()
+        self.preview_dialog = previewDialog.Preview(self.preview_tl)
 
         self.load_settings()
 
@@ -253,8 +425,11 @@ class Application(ttk.Frame):
         defdir = ''
         if cur != '':
             defdir = self.cws.get_path(cur)
-        fname = tkFileDialog.askopenfilename(filetypes=[('Image Files', '.png;.bmp;.tif;.tiff'), ('All Files', '.*') ],
-                                             title="Select FIRST Slice File", parent=self, initialdir=defdir)
+        fname = tkFileDialog.askopenfilename(filetypes=[('Image Files', '.png;.bmp;.tif;.tiff'),
+                                                        ('Image Stacks (multi-page TIFF or zip)', '.tif;.tiff;.zip'),
+                                                        ('All Files', '.*') ],
+                                             title="Select FIRST Slice File or Image Stack", parent=self,
+                                             initialdir=defdir)
 
         if fname != "":
             self.input_image.set(fname)
@@ -285,6 +460,18 @@ class Application(ttk.Frame):
             self.mask_image.set(fname)
             self.mask_validate()
 
+    def profile_dialog(self):
+        cur = self.exposure_profile.get()
+        defdir = ''
+        if cur != '':
+            defdir = self.cws.get_path(cur)
+        fname = tkFileDialog.askopenfilename(filetypes=[('Exposure Profiles', '.ini'), ('All Files', '.*')],
+                                             title="Select Exposure Profile", parent=self, initialdir=defdir)
+
+        if fname != "":
+            self.exposure_profile.set(fname)
+            self.profile_validate()
+
     def imagemagick_dialog(self):
         def_dir = self.imagemagick_path.get()
         if def_dir == "":
@@ -315,19 +502,41 @@ class Application(ttk.Frame):
         os.system("instructions.html")
 
     def template_validate(self):
-        """Validates changes to the Template field using the CWS scripts"""
-        # TODO: Figure out whether this needs to go on a background thread.
-        self.template_ok, message, slices = self.cws.template_check(self.template_cws.get())
-        self.template_slices = slices
-        self.template_message.set(message)
-        self.template_entry.xview(len(self.template_cws.get()))
+        """Validates changes to the Template field using the CWS scripts. The check runs in the background; the
+        field counts as invalid until it's done."""
+        template = self.template_cws.get()
+        self.template_ok = False
+        self.template_message.set("Checking...")
+        self.checker.check("template", self.template_checked, (False, "Error opening CWS file.", None),
+                           self.cws.template_check, template, key_files=[template])
+        self.template_entry.xview(len(template))
         self.evaluate_go()
         return True
 
+    def template_checked(self, result):
+        self.template_ok, message, self.template = result
+        self.template_slices = self.template.layer_count if self.template is not None else 0
+        self.template_message.set(message)
+        if self.use_mask.get() and self.engine.get() == "builtin":
+            self.mask_validate()    # now the mask can be prepared at the template's size
+        self.output_validate()      # the output message depends on the slice count
+
     def image_validate(self):
         """Validates whether the image selected is acceptable for use. Called both as the input_image validator
-        and as the command for the Replicate First checkbox."""
-        self.image_ok, message, self.image_slices = self.cws.imstack_check(self.input_image.get())
+        and as the command for the Replicate First checkbox. The stack is scanned in the background; the field counts
+        as invalid until it's done."""
+        input_image = self.input_image.get()
+        self.image_ok = False
+        self.image_message.set("Checking...")
+        self.checker.check("image", self.image_checked, (False, "Couldn't read the image folder.", 0),
+                           self.cws.imstack_check, input_image,
+                           key_files=[input_image, os.path.dirname(input_image) or os.curdir])
+        self.image_entry.xview(len(input_image))
+        self.evaluate_go()
+        return True
+
+    def image_checked(self, result):
+        self.image_ok, message, self.image_slices = result
         # Special case: If Replicate is set to True, we can be OK even if imstack_check returns False, as long
         # as we have at least one image_slice.
         if self.image_slices > 0 and self.replicate_first.get():
@@ -335,9 +544,7 @@ class Application(ttk.Frame):
             self.image_message.set("This image will be used for all slices.")
         else:
             self.image_message.set(message)
-        self.image_entry.xview(len(self.input_image.get()))
-        self.evaluate_go()
-        return True
+        self.output_validate()      # the output message depends on the slice count
 
     def output_validate(self):
         self.output_ok = self.cws.output_check(self.output_cws.get())
@@ -348,6 +555,9 @@ class Application(ttk.Frame):
                 if self.template_slices < self.image_slices:
                     self.output_message.set("Image stack is bigger than CWS template. %i slices will be lost" %
                                             (self.image_slices - self.template_slices))
+                elif self.trim_to_stack.get() and not self.replicate_first.get() and \
+                        self.image_slices < self.template_slices:
+                    self.output_message.set("OK. The print will end after %i layers" % self.image_slices)
                 else:
                     self.output_message.set("OK")
             else:
@@ -359,12 +569,23 @@ class Application(ttk.Frame):
     def mask_validate(self):
         """Validates whether the image selected is acceptable for use. Called both as the input_image validator
         and as the command for the Replicate First checkbox."""
-        self.mask_ok, message = self.cws.mask_check(self.mask_image.get())
-        self.mask_message.set(message)
+        # with the built-in engine, get the mask ready for the first job while we're at it
+        size = None
+        if self.template_ok and self.use_mask.get() and self.engine.get() == "builtin":
+            size = self.template.size
+        self.mask_ok = False
+        self.mask_message.set("Checking...")
+        self.checker.check("mask", self.mask_checked, (False, "Couldn't read this image"),
+                           self.cws.mask_check, self.mask_image.get(), size)
         self.mask_entry.xview(len(self.mask_image.get()))
         self.evaluate_go()
         return True
 
+    def mask_checked(self, result):
+        self.mask_ok, message = result
+        self.mask_message.set(message)
+        self.evaluate_go()
+
     def threshold_validate(self):
         val = self.threshold_val.get()
         self.thresh_ok = False
@@ -375,8 +596,49 @@ class Application(ttk.Frame):
         self.evaluate_go()
         return True
 
+    def workers_validate(self):
+        self.workers_ok = self.workers.get().strip().isdigit()
+        self.evaluate_go()
+        return True
+
+    def pitch_validate(self):
+        self.pitch_ok = True
+        if self.resize.get() == "pitch":
+            try:
+                self.pitch_ok = float(self.input_pitch.get().strip()) > 0
+            except ValueError:
+                self.pitch_ok = False
+        self.evaluate_go()
+        return True
+
+    def profile_validate(self):
+        """An empty profile leaves the template's exposures alone; otherwise the profile has to make sense."""
+        fname = self.exposure_profile.get().strip()
+        if fname == "":
+            self.profile_ok = True
+            self.profile_message.set("None. Using the template's exposures.")
+        else:
+            try:
+                self.profile_message.set("OK. %s" % cws_scripts.ExposureProfile.read(fname))
+                self.profile_ok = True
+            except (IOError, ValueError) as e:
+                self.profile_message.set(str(e))
+                self.profile_ok = False
+        self.profile_entry.xview(len(self.exposure_profile.get()))
+        self.evaluate_go()
+        return True
+
     def imagemagick_path_validate(self):
         dirname = self.imagemagick_path.get()
+        if self.engine.get() == "builtin":
+            if cws_scripts.image_engine.available:
+                self.imagemagick_message.set("Not needed with built-in image processing.")
+                self.imagemagick_ok = True
+            else:
+                self.imagemagick_message.set("Built-in image processing needs numpy and Pillow.")
+                self.imagemagick_ok = False
+            self.evaluate_go()
+            return True
         # ImageMagick version 7, with almost no documentation, changes the executable from "convert" to "magick"...
         # but now I'm dependent on version 7 features, so don't run if we don't have the magick
         if os.path.exists(os.path.join(dirname, "magick")) or os.path.exists(os.path.join(dirname, "magick.exe")):
@@ -393,17 +655,18 @@ class Application(ttk.Frame):
 
     def evaluate_go(self):
         if self.image_ok and self.imagemagick_ok and self.output_ok and self.template_ok and (not self.threshold.get()
-                or self.thresh_ok) and (not self.use_mask.get() or self.mask_ok):
+                or self.thresh_ok) and (not self.use_mask.get() or self.mask_ok) and self.workers_ok and self.pitch_ok \
+                and self.profile_ok:
             self.go_button.state(["!disabled"])
         else:
             self.go_button.state(["disabled"])
 
     def go(self):
-        self.log("Args:\nTemplate %s\nImage %s\nOutput %s\nUse Mask %s\nMaskImage %s\nNegate %s\nThresh %s Val %i\nReplicate %s\nIMPath %s" %
+        self.log("Args:\nTemplate %s\nImage %s\nOutput %s\nUse Mask %s\nMaskImage %s\nNegate %s\nThresh %s Val %i\nReplicate %s\nIMPath %s\nEngine %s\nWorkers %s" %
               (self.template_cws.get(), self.input_image.get(), self.output_cws.get(),
                self.use_mask.get(), self.mask_image.get(),
                self.negate.get(), self.threshold.get(), int(self.threshold_val.get().strip()), self.replicate_first.get(),
-               self.imagemagick_path.get()))
+               self.imagemagick_path.get(), self.engine.get(), self.workers.get()))
         thresh_val = 50
         if self.threshold.get():
             try:
@@ -416,9 +679,21 @@ class Application(ttk.Frame):
         self.cws.threshold = self.threshold.get()
         self.cws.threshold_val = int(self.threshold_val.get().strip())
         self.cws.repeat_first = self.replicate_first.get()
+        self.cws.trim_to_stack = self.trim_to_stack.get()
+        self.cws.exposure_profile = self.exposure_profile.get().strip()
+        self.cws.slice_cache_bytes = 512 * 1024 * 1024 if self.slice_cache.get() else 0
         self.cws.imagemagick_cmd = os.path.join(self.imagemagick_path.get(), self.imagemagick_command)
         self.cws.use_mask = self.use_mask.get()
         self.cws.mask_image = self.mask_image.get()
+        self.cws.engine = self.engine.get()
+        # the built-in engine hands back png bytes, so it can also skip the temporary folder
+        self.cws.streaming = self.engine.get() == "builtin"
+        self.cws.pipeline = self.engine.get() == "builtin"
+        self.cws.workers = int(self.workers.get().strip())
+        self.cws.resize = self.resize.get()
+        if self.resize.get() == "pitch":
+            self.cws.input_pitch = float(self.input_pitch.get().strip())
+        self.cws.slice_encoding = "compact" if self.compact.get() else "auto"
 
         # Open the window and launch the job.
         self.tl.update()
@@ -426,6 +701,10 @@ class Application(ttk.Frame):
         self.working_dialog.go(self.cws, self.template_cws.get(), self.input_image.get(), self.output_cws.get())
         self.wait_window(self.tl)
 
+    def preview(self):
+        """Shows the layers of the output CWS file, or the template if there's no output yet."""
+        self.preview_dialog.show(self.output_cws.get(), self.template_cws.get())
+
     def save_settings(self):
         config = cp.SafeConfigParser()
         config.add_section('Honeyguide')
@@ -439,6 +718,14 @@ class Application(ttk.Frame):
         config.set('Honeyguide', 'ThreshVal', self.threshold_val.get())
         config.set('Honeyguide', 'ReplicateFirst', str(self.replicate_first.get()))
         config.set('Honeyguide', 'ImageMagickPath', self.imagemagick_path.get())
+        config.set('Honeyguide', 'Engine', self.engine.get())
+        config.set('Honeyguide', 'Workers', self.workers.get())
+        config.set('Honeyguide', 'Resize', self.resize.get())
+        config.set('Honeyguide', 'InputPitch', self.input_pitch.get())
+        config.set('Honeyguide', 'Compact', str(self.compact.get()))
+        config.set('Honeyguide', 'TrimToStack', str(self.trim_to_stack.get()))
+        config.set('Honeyguide', 'ExposureProfile', self.exposure_profile.get())
+        config.set('Honeyguide', 'SliceCache', str(self.slice_cache.get()))
         #config.set('Honeyguide', 'Window', self._root().winfo_geometry())
 
         with open(os.path.join(cws_scripts.settings_path, "settings.ini"), "wb") as outfile:
@@ -459,6 +746,22 @@ class Application(ttk.Frame):
             self.threshold_val.set(config.get('Honeyguide', 'ThreshVal'))
             self.replicate_first.set(config.getboolean('Honeyguide', 'ReplicateFirst'))
             self.imagemagick_path.set(config.get('Honeyguide', 'ImageMagickPath'))
+            if config.has_option('Honeyguide', 'Engine'):
+                self.engine.set(config.get('Honeyguide', 'Engine'))
+            if config.has_option('Honeyguide', 'Workers'):
+                self.workers.set(config.get('Honeyguide', 'Workers'))
+            if config.has_option('Honeyguide', 'Resize'):
+                self.resize.set(config.get('Honeyguide', 'Resize'))
+            if config.has_option('Honeyguide', 'InputPitch'):
+                self.input_pitch.set(config.get('Honeyguide', 'InputPitch'))
+            if config.has_option('Honeyguide', 'Compact'):
+                self.compact.set(config.getboolean('Honeyguide', 'Compact'))
+            if config.has_option('Honeyguide', 'TrimToStack'):
+                self.trim_to_stack.set(config.getboolean('Honeyguide', 'TrimToStack'))
+            if config.has_option('Honeyguide', 'ExposureProfile'):
+                self.exposure_profile.set(config.get('Honeyguide', 'ExposureProfile'))
+            if config.has_option('Honeyguide', 'SliceCache'):
+                self.slice_cache.set(config.getboolean('Honeyguide', 'SliceCache'))
             #self._root().geometry(config.get('Honeyguide', 'Window'))
             self.log("Settings loaded successfully")
 
@@ -474,11 +777,16 @@ class Application(ttk.Frame):
         self.mask_validate()
         self.imagemagick_path_validate()
         self.threshold_validate()
+        self.workers_validate()
+        self.pitch_validate()
+        self.profile_validate()
 
     def close(self):
         self.save_settings()
         self.working_dialog.quit()
         self.working_dialog.destroy()
+        self.preview_dialog.close()
+        self.preview_dialog.destroy()
         self.quit()
         self.destroy()
 
@@ -500,4 +808,5 @@ def main():
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()        # needed for the worker pool in py2exe builds
     main()
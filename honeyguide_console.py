@@ -1,5 +1,326 @@
 __author__ = 'Ben'
-# This is just a mirror of honeyguide.py to give setup.py a separate target for the console version.
-import honeyguide
+# Command line version of Honeyguide, for running jobs without the GUI (e.g. on a build server). It deliberately never
+# imports Tkinter; use honeyguide.py for the GUI.
+#
+# Run a single job:
+#     honeyguide_console.py template.cws first_slice0000.png output.cws [options]
+# or every job in a manifest:
+#     honeyguide_console.py --manifest jobs.ini [options]
+# or copy slices out of existing CWS files:
+#     honeyguide_console.py --extract job1.cws [job2.cws ...] --out-dir slices [--slices 10-20] [--format tif]
+#                           [--depth 8] [options]
+# Extracted slices go straight into --out-dir when there's one CWS file, or into a folder per CWS file named after it
+# when there are more. See Honeyguide.extract_slices; --workers sets how many slices are decoded at the same time.
+#
+# A manifest is an ini file with one section per job. Each section needs template, inputimages and output keys, and
+# can override the command line options with the same keys Tests/tests.ini uses (negate, threshold, threshval,
+# replicatefirst, usemask, maskimage) plus trim, profile, resize, pitch, encoding, compresslevel, pngfilter, engine,
+# streaming, workers and pipeline. Keys in a [DEFAULT] section apply to every job.
+#
+# Each finished job is printed to stdout as one line of JSON:
+#     {"job": ..., "template": ..., "input": ..., "output": ..., "success": ..., "message": ..., "seconds": ...}
+# Progress messages go to stderr with --verbose, and with --progress SECONDS each job's progress (stage, slices done,
+# slices per second, bytes written and time left; see cws_scripts.ProgressEvent) goes to stderr as JSON lines at most
+# that often. With --timing, each result also has a "timing" entry with the wall and CPU time of each stage of the job
+# and percentiles of how long the slices took to convert (see cws_scripts.StageTimer). CPU time is measured for the
+# whole process, so with --jobs above 1 only wall clock times are reported. The exit code is 0 if every job succeeded
+# and 1 otherwise.
 
-honeyguide.main()
\ No newline at end of file
+import argparse
+import ConfigParser
+import json
+import multiprocessing
+import multiprocessing.pool
+import os
+import sys
+import threading
+import time
+
+import cws_scripts
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Honeyguide: replaces the slices of a CWS file with your own images.")
+    parser.add_argument("template", nargs="?", help="template CWS file")
+    parser.add_argument("input", nargs="?", help="first image of the slice stack, or a multi-page TIFF or zip of them")
+    parser.add_argument("output", nargs="?", help="CWS file to write")
+    parser.add_argument("--manifest", help="ini file listing jobs to run, one per section")
+    parser.add_argument("--extract", nargs="+", metavar="CWS", help="CWS files to copy slices out of")
+    parser.add_argument("--out-dir", help="folder to extract slices to")
+    parser.add_argument("--slices", default="0-", metavar="RANGE",
+                        help="slices to extract, by number: N, N-M or N- (default all)")
+    parser.add_argument("--format", default="png", choices=["png", "tif", "bmp"],
+                        help="file type of extracted slices (default png)")
+    parser.add_argument("--depth", type=int, choices=[1, 8, 16],
+                        help="bits per channel of extracted slices (default: as they are in the CWS)")
+    parser.add_argument("--jobs", type=int, default=1, help="number of jobs to run at the same time (default 1)")
+    parser.add_argument("--imagemagick", default="magick", help="ImageMagick command (default magick)")
+    parser.add_argument("--engine", default="imagemagick", choices=["imagemagick", "imagemagick_batch", "builtin"],
+                        help="how slices are converted (default imagemagick)")
+    parser.add_argument("--streaming", action="store_true",
+                        help="read and write the CWS files directly instead of through a temporary folder")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="slices to convert at the same time within each job; 0 for one per core (default 1)")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="with the builtin engine, --streaming and one worker, decode, convert and write slices "
+                             "at the same time")
+    parser.add_argument("--pipeline-bytes", type=int,
+                        help="memory the slices waiting between pipeline stages may take")
+    parser.add_argument("--negate", action="store_true", help="negate the slices")
+    parser.add_argument("--threshold", type=int, metavar="VALUE",
+                        help="threshold the slices at VALUE percent (in a manifest, threshval; 50 if not given)")
+    parser.add_argument("--repeat-first", action="store_true", help="use the first image for every slice")
+    parser.add_argument("--trim", action="store_true",
+                        help="end the print at the last image when the stack is shorter than the template, instead "
+                             "of exposing blank layers")
+    parser.add_argument("--profile", metavar="INI",
+                        help="per-layer exposure times and lift speeds to write into the gcode (see "
+                             "cws_scripts.ExposureProfile)")
+    parser.add_argument("--mask", metavar="IMAGE", help="multiply every slice by this mask image")
+    parser.add_argument("--resize", default="none", choices=["none", "fit", "pitch"],
+                        help="scale the slices to fit the template, or to the template's pixel pitch (default none)")
+    parser.add_argument("--pitch", type=float, default=0., metavar="UM",
+                        help="with --resize pitch, the size of an input pixel in micrometers")
+    parser.add_argument("--encoding", default="auto", choices=["auto", "compact"],
+                        help="compact writes 1-bit grayscale slices when they're black and white and 8-bit grayscale "
+                             "otherwise (default auto: the smallest lossless png type)")
+    parser.add_argument("--compress-level", type=int, default=6, choices=range(10), metavar="0-9",
+                        help="zlib level for compact slices (default 6)")
+    parser.add_argument("--png-filter", default="none",
+                        choices=list(cws_scripts.image_engine.PNG_FILTERS) + ["adaptive"],
+                        help="png filter for compact slices (default none)")
+    parser.add_argument("--slice-cache-bytes", type=int,
+                        help="disk to spend caching converted slices between runs, so re-runs only convert the "
+                             "slices that changed (default 0: no cache)")
+    parser.add_argument("--slice-memory-bytes", type=int,
+                        help="scratch memory per worker for the builtin engine; bigger slices are done in strips")
+    parser.add_argument("--verbose", action="store_true", help="print progress messages to stderr")
+    parser.add_argument("--timing", action="store_true", help="include per-stage timings in the results")
+    parser.add_argument("--progress", type=float, metavar="SECONDS",
+                        help="print progress events to stderr as JSON, at most every SECONDS")
+    args = parser.parse_args(argv)
+
+    if args.extract is not None:
+        if args.manifest is not None or args.template is not None:
+            parser.error("--extract can't be combined with other jobs")
+        if args.out_dir is None:
+            parser.error("--extract needs an --out-dir")
+        first, dash, last = args.slices.partition("-")
+        try:
+            if not dash:
+                args.slices = (int(first), int(first))
+            else:
+                args.slices = (int(first), int(last) if last else None)
+        except ValueError:
+            parser.error("--slices looks like 5, 5-10 or 5-")
+    elif args.resize == "pitch" and args.pitch <= 0 and args.manifest is None:
+        parser.error("--resize pitch needs the input --pitch")
+    elif args.manifest is None and (args.template is None or args.input is None or args.output is None):
+        parser.error("give a template, input and output, a --manifest or CWS files to --extract")
+    if args.manifest is not None and args.template is not None:
+        parser.error("give either a template, input and output or a --manifest, not both")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    return args
+
+
+def read_jobs(args):
+    """Returns the list of jobs to run as dictionaries of Honeyguide settings, with the command line options as
+    defaults."""
+    defaults = {"name": "job",
+                "template": args.template,
+                "input": args.input,
+                "output": args.output,
+                "imagemagick_cmd": args.imagemagick,
+                "engine": args.engine,
+                "streaming": args.streaming,
+                "workers": args.workers,
+                "pipeline": args.pipeline,
+                "negate": args.negate,
+                "threshold": args.threshold is not None,
+                # manifest jobs that turn threshold on without a threshval get the GUI's default
+                "threshold_val": args.threshold if args.threshold is not None else 50,
+                "repeat_first": args.repeat_first,
+                "trim_to_stack": args.trim,
+                "exposure_profile": args.profile or "",
+                "use_mask": args.mask is not None,
+                "mask_image": args.mask or "",
+                "resize": args.resize,
+                "input_pitch": args.pitch,
+                "slice_encoding": args.encoding,
+                "png_compress_level": args.compress_level,
+                "png_filter": args.png_filter}
+    if args.extract is not None:
+        jobs = []
+        for cws_file in args.extract:
+            name = os.path.splitext(os.path.basename(cws_file))[0]
+            jobs.append(dict(defaults, name=name, template=None, input=cws_file, extract=True,
+                             output=args.out_dir if len(args.extract) == 1 else os.path.join(args.out_dir, name)))
+        return jobs
+    if args.manifest is None:
+        return [defaults]
+
+    cp = ConfigParser.SafeConfigParser()
+    if not cp.read(args.manifest):
+        raise IOError("Couldn't read manifest %s" % args.manifest)
+
+    jobs = []
+    for section in cp.sections():
+        job = dict(defaults)
+        job["name"] = section
+        job["template"] = cp.get(section, "template")
+        job["input"] = cp.get(section, "inputimages")
+        job["output"] = cp.get(section, "output")
+        if cp.has_option(section, "engine"):
+            job["engine"] = cp.get(section, "engine")
+        if cp.has_option(section, "streaming"):
+            job["streaming"] = cp.getboolean(section, "streaming")
+        if cp.has_option(section, "workers"):
+            job["workers"] = cp.getint(section, "workers")
+        if cp.has_option(section, "pipeline"):
+            job["pipeline"] = cp.getboolean(section, "pipeline")
+        if cp.has_option(section, "negate"):
+            job["negate"] = cp.getboolean(section, "negate")
+        if cp.has_option(section, "threshold"):
+            job["threshold"] = cp.getboolean(section, "threshold")
+        if cp.has_option(section, "threshval"):
+            job["threshold_val"] = cp.getint(section, "threshval")
+        if cp.has_option(section, "replicatefirst"):
+            job["repeat_first"] = cp.getboolean(section, "replicatefirst")
+        if cp.has_option(section, "trim"):
+            job["trim_to_stack"] = cp.getboolean(section, "trim")
+        if cp.has_option(section, "profile"):
+            job["exposure_profile"] = cp.get(section, "profile")
+        if cp.has_option(section, "usemask"):
+            job["use_mask"] = cp.getboolean(section, "usemask")
+        if cp.has_option(section, "maskimage"):
+            job["mask_image"] = cp.get(section, "maskimage")
+        if cp.has_option(section, "resize"):
+            job["resize"] = cp.get(section, "resize")
+        if cp.has_option(section, "pitch"):
+            job["input_pitch"] = cp.getfloat(section, "pitch")
+        if cp.has_option(section, "encoding"):
+            job["slice_encoding"] = cp.get(section, "encoding")
+        if cp.has_option(section, "compresslevel"):
+            job["png_compress_level"] = cp.getint(section, "compresslevel")
+        if cp.has_option(section, "pngfilter"):
+            job["png_filter"] = cp.get(section, "pngfilter")
+        jobs.append(job)
+    return jobs
+
+
+class JobRunner:
+    """Runs jobs (see read_jobs) on their own Honeyguide objects, keeping track of the ones in progress so they can
+    be cancelled."""
+
+    def __init__(self, args):
+        self.args = args
+        self.running = set()
+        self.lock = threading.Lock()
+        self.cancelled = False
+
+    def run(self, job):
+        h = cws_scripts.Honeyguide(logfile=sys.stderr if self.args.verbose else None)
+        h.echo = False      # stdout is for results
+        h.quiet = not self.args.verbose
+        for key in ("imagemagick_cmd", "engine", "streaming", "workers", "pipeline", "negate", "threshold",
+                    "threshold_val", "repeat_first", "trim_to_stack", "exposure_profile", "use_mask", "mask_image",
+                    "resize", "input_pitch", "slice_encoding", "png_compress_level", "png_filter"):
+            setattr(h, key, job[key])
+        if self.args.slice_cache_bytes is not None:
+            h.slice_cache_bytes = self.args.slice_cache_bytes
+        if self.args.slice_memory_bytes is not None:
+            h.slice_memory_bytes = self.args.slice_memory_bytes
+        if self.args.pipeline_bytes is not None:
+            h.pipeline_bytes = self.args.pipeline_bytes
+        h.timing = self.args.timing
+        h.timing_cpu = self.args.jobs == 1     # CPU time is the whole process's, so jobs side by side would share it
+        if self.args.progress is not None:
+            h.subscribe(lambda event: self.report(job, event), self.args.progress)
+
+        with self.lock:
+            if self.cancelled:
+                return self.result(job, False, "Cancelled", 0.)
+            self.running.add(h)
+        try:
+            start = time.time()
+            try:
+                if job.get("extract"):
+                    success, message = h.extract_slices(job["input"], job["output"], self.args.slices[0],
+                                                        self.args.slices[1], self.args.format, self.args.depth)
+                else:
+                    success, message = h.do_honeyguide(job["template"], job["input"], job["output"])
+            except Exception as e:
+                success, message = False, "Unexpected error: %s" % e
+            result = self.result(job, success, message, time.time() - start)
+            if h.timing_report is not None:
+                result["timing"] = h.timing_report
+            return result
+        finally:
+            with self.lock:
+                self.running.discard(h)
+
+    def report(self, job, event):
+        """Prints a progress event from job to stderr."""
+        line = dict(event._asdict())
+        line["job"] = job["name"]
+        with self.lock:
+            sys.stderr.write(json.dumps(line, sort_keys=True) + "\n")
+            sys.stderr.flush()
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            for h in self.running:
+                h.cancel()
+
+    @staticmethod
+    def result(job, success, message, seconds):
+        result = {"job": job["name"],
+                  "template": job["template"],
+                  "input": job["input"],
+                  "output": job["output"],
+                  "success": bool(success),
+                  "message": message,
+                  "seconds": round(seconds, 3)}
+        if result["template"] is None:
+            del result["template"]      # extracting
+        return result
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    try:
+        jobs = read_jobs(args)
+    except (IOError, ConfigParser.Error) as e:
+        sys.stderr.write("%s\n" % e)
+        return 2
+
+    runner = JobRunner(args)
+    pool = multiprocessing.pool.ThreadPool(min(args.jobs, max(len(jobs), 1)))
+    all_passed = True
+    try:
+        results = pool.imap_unordered(runner.run, jobs)
+        for i in range(len(jobs)):
+            # wait with a timeout so Ctrl-C gets through
+            while True:
+                try:
+                    result = results.next(0.5)
+                    break
+                except multiprocessing.TimeoutError:
+                    pass
+            all_passed = all_passed and result["success"]
+            sys.stdout.write(json.dumps(result, sort_keys=True) + "\n")
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        runner.cancel()
+        all_passed = False
+    finally:
+        pool.close()
+        pool.join()
+    return 0 if all_passed else 1
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,766 @@
+# Honeyguide - a program for injecting image stack data into CreationWorkshop CWS files.
+# image_engine.py - in-process slice processing using NumPy and Pillow.
+#
+# Ben Weiss at the University of Washington
+#
+# Dependencies: This module requires numpy and Pillow. If they are missing, available is False and Honeyguide falls
+#               back on ImageMagick.
+#
+# (c) 2015 Ben Weiss
+# License: MIT License:
+#
+#    Copyright (c) 2015 Ben Weiss; parts (c) 2015 Ben Weiss, University of Washington
+#
+#
+#    Permission is hereby granted, free of charge, to any person obtaining a
+#    copy of this software and associated documentation files (the "Software"),
+#    to deal in the Software without restriction, including without limitation
+#    the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#    and/or sell copies of the Software, and to permit persons to whom the
+#    Software is furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included
+#    in all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#    THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#    FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#    DEALINGS IN THE SOFTWARE.
+#
+#-------------------------------------------------------------------------------
+
+__author__ = 'Ben Weiss'
+
+import io
+import math
+import os
+import collections
+import struct
+import threading
+import time
+import zlib
+
+try:
+    import numpy as np
+    from PIL import Image
+    available = True
+except ImportError:
+    available = False
+
+# Rec. 709 luma weights. This is what ImageMagick 7 uses for the pixel intensity when -threshold runs with the default
+# channel mask.
+LUMA_WEIGHTS = (0.212656, 0.715158, 0.072186)
+
+
+# Roughly how many bytes of scratch arrays SliceEngine needs per sample (pixel and channel) of a slice at its worst,
+# when a mask or threshold widens the pixels to 64-bit integers for the arithmetic.
+SCRATCH_BYTES = 24
+
+
+# The png filter types, in the order of their numbers in the png format. write_gray_png also takes "adaptive", which
+# picks the best filter for each row the way libpng does. Slices are mostly flat black and white, where rows compress
+# best unfiltered, so "none" is the default; adaptive only wins on slices with a lot of gray, and takes twice as long.
+PNG_FILTERS = ("none", "sub", "up", "average", "paeth")
+
+# rows of a png filtered and compressed at a time by write_gray_png
+PNG_CHUNK_ROWS = 256
+
+
+# The engine used by this process when it is a worker in a multiprocessing pool. See init_worker.
+_worker_engine = None
+
+
+def init_worker(settings):
+    """multiprocessing.Pool initializer. Builds the SliceEngine (from the SliceEngine.settings() of the parent's
+    engine) that this worker process uses for every slice it converts."""
+    global _worker_engine
+    _worker_engine = SliceEngine(*settings)
+
+
+def convert_in_worker(in_fname, out_fname=None):
+    """Converts in_fname with this worker's engine. Writes out_fname, or returns the png contents if out_fname is
+    None."""
+    if out_fname is None:
+        return _worker_engine.convert_to_bytes(in_fname)
+    _worker_engine.convert(in_fname, out_fname)
+
+
+def save_as(data, out_fname, out_format, depth=None):
+    """Decodes data, the contents of an image file, and saves it to out_fname as out_format ('png', 'tif' or 'bmp')
+    with depth bits per channel: 1 (black and white, split at half scale), 8 or 16 (grayscale only), or None to keep
+    the image's own. Opaque alpha and gray color channels are dropped when the depth changes. Raises ValueError (or
+    IOError from Pillow) if the image can't be saved that way."""
+    im = Image.open(io.BytesIO(data))
+    if depth is not None:
+        color, alpha, maxval = SliceEngine._to_array(im)
+        # drop channels that don't carry information, as encode() does
+        if alpha is not None and (alpha == maxval).all():
+            alpha = None
+        if color.shape[2] == 3 and (color[:, :, 0] == color[:, :, 1]).all() and \
+                (color[:, :, 0] == color[:, :, 2]).all():
+            color = color[:, :, :1]
+        if depth == 16:
+            if color.shape[2] != 1 or alpha is not None:
+                raise ValueError("only grayscale slices can be saved at 16 bits")
+            im = Image.fromarray((color[:, :, 0].astype(np.uint32) * (65535 // maxval)).astype(np.uint16), 'I;16')
+        elif depth == 1:
+            gray = color[:, :, 0].astype(np.uint32)
+            if color.shape[2] == 3:
+                # luma, as for -threshold
+                gray = LUMA_WEIGHTS[0] * color[:, :, 0] + LUMA_WEIGHTS[1] * color[:, :, 1] + \
+                    LUMA_WEIGHTS[2] * color[:, :, 2]
+            im = Image.fromarray((gray * 2 >= maxval).astype(np.uint8) * 255, 'L').convert('1')
+        else:
+            data8 = SliceEngine._to_8bit(color, maxval)
+            if alpha is not None:
+                data8 = np.concatenate((data8, SliceEngine._to_8bit(alpha, maxval)[:, :, np.newaxis]), axis=2)
+            im = Image.fromarray(data8 if data8.shape[2] > 1 else data8[:, :, 0],
+                                 {1: 'L', 2: 'LA', 3: 'RGB', 4: 'RGBA'}[data8.shape[2]])
+    im.save(out_fname, {'png': 'PNG', 'tif': 'TIFF', 'bmp': 'BMP'}[out_format])
+
+
+def thumbnail(data, size):
+    """Decodes data, the contents of an image file, and returns it shrunk to fit in size (width, height) as an 8-bit
+    'L' or 'RGB' PIL image for display. Alpha is ignored."""
+    im = Image.open(io.BytesIO(data))
+    if im.mode == '1':
+        im = im.convert('L')
+    elif im.mode not in ('L', 'RGB'):
+        color, alpha, maxval = SliceEngine._to_array(im)
+        color = SliceEngine._to_8bit(color, maxval)
+        im = Image.fromarray(color[:, :, 0], 'L') if color.shape[2] == 1 else Image.fromarray(color, 'RGB')
+    im.thumbnail(size, Image.BILINEAR)
+    return im
+
+
+# bytes per pixel Pillow uses for each image mode
+MODE_BYTES = {'1': 1, 'L': 1, 'P': 1, 'LA': 2, 'PA': 2, 'I;16': 2, 'I;16B': 2, 'RGB': 3, 'RGBA': 4, 'I': 4, 'F': 4}
+
+
+def image_bytes(im):
+    """Returns roughly how much memory the decoded PIL image im takes."""
+    return im.size[0] * im.size[1] * MODE_BYTES.get(im.mode, 4)
+
+
+def timed_call(func, *args):
+    """Calls func(*args) and returns (result, seconds it took). Used to time slices converted on a worker pool."""
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def open_image(source):
+    """Opens a slice: a filename, or a stack container entry from cws_scripts (anything with an open_image method)."""
+    if hasattr(source, 'open_image'):
+        return source.open_image()
+    return Image.open(source)
+
+
+class SharedFiles:
+    """Files kept open between reads, by filename, and shared by everything in the process reading them; opener opens
+    one. Each job reading a file hold()s it for as long as it's reading and release()s it when it's done, and the file
+    is closed once the last job lets go, so jobs running side by side never close a file out from under each other.
+    Files read without being held (e.g. in pool workers, which go away with their pool) stay open. Thread safe."""
+
+    def __init__(self, opener):
+        self.opener = opener
+        self._files = {}        # filename -> [open file or None, lock, number of holders]
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _entry(self, fname):
+        # a forked worker mustn't share its parent's file positions, so it starts afresh
+        if self._pid != os.getpid():
+            self._files = {}
+            self._pid = os.getpid()
+        if fname not in self._files:
+            self._files[fname] = [None, threading.Lock(), 0]
+        return self._files[fname]
+
+    def use(self, fname, func):
+        """Returns func(the open file fname), opening it if need be. Calls on the same file take turns."""
+        with self._lock:
+            entry = self._entry(fname)
+        with entry[1]:
+            if entry[0] is None:
+                entry[0] = self.opener(fname)
+            return func(entry[0])
+
+    def hold(self, fname):
+        with self._lock:
+            self._entry(fname)[2] += 1
+
+    def release(self, fname):
+        """Lets go of fname, closing it if nothing else holds it."""
+        with self._lock:
+            entry = self._entry(fname)
+            entry[2] -= 1
+            if entry[2] > 0:
+                return
+            del self._files[fname]
+        with entry[1]:
+            if entry[0] is not None:
+                entry[0].close()
+                entry[0] = None
+
+
+# Multi-page TIFFs being read. Pillow remembers where the pages it has been through start, so keeping the image open
+# lets reading the pages in order skip straight to each one.
+tiff_files = SharedFiles(lambda fname: Image.open(fname))
+
+
+def tiff_page(fname, index):
+    """Returns page index (counting from 0) of the multi-page TIFF fname as a PIL image of its own."""
+    def read_page(im):
+        im.seek(index)
+        im.load()
+        return im.copy()
+    return tiff_files.use(fname, read_page)
+
+
+class MaskCache:
+    """LRU cache of masks that have been loaded and stretched to a template size, keyed by the mask's filename,
+    modification time and the target size. Back-to-back jobs with the same mask and printer share one prepared mask.
+    The cache drops the least recently used masks once they take up more than max_bytes. Thread safe."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._masks = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, mask_image, size):
+        """Returns the prepared mask (mask, maxval) for mask_image at size (width, height), loading it if needed. Raises
+        IOError or OSError if the mask can't be read. The mask array is read-only, since it's shared."""
+        key = (os.path.abspath(mask_image), os.path.getmtime(mask_image), tuple(size))
+        with self._lock:
+            if key in self._masks:
+                self.hits += 1
+                entry = self._masks.pop(key)
+                self._masks[key] = entry        # now the most recently used
+                return entry
+            self.misses += 1
+
+        # load outside the lock; the worst case is two threads preparing the same mask at once.
+        mask, maxval = load_mask(mask_image, size)
+        mask.flags.writeable = False
+        with self._lock:
+            if key not in self._masks:
+                self._masks[key] = (mask, maxval)
+                self._bytes += mask.nbytes
+                while self._bytes > self.max_bytes and len(self._masks) > 1:
+                    old_mask = self._masks.popitem(last=False)[1][0]
+                    self._bytes -= old_mask.nbytes
+        return mask, maxval
+
+    def clear(self):
+        """Empties the cache."""
+        with self._lock:
+            self._masks.clear()
+            self._bytes = 0
+
+
+# Prepared masks shared by every SliceEngine in this process. 256 MB holds a dozen or so 4K color masks.
+mask_cache = MaskCache(256 * 1024 * 1024)
+
+
+def load_mask(mask_image, size):
+    """Loads a mask and stretches it to size (-resize WxH!). Returns (mask, maxval) where mask is a (H, W, channels)
+    array. Most callers want mask_cache.get() instead."""
+    im = Image.open(mask_image)
+    if im.size != tuple(size):
+        # ImageMagick uses Mitchell when enlarging and Lanczos when reducing. Pillow's bicubic isn't quite Mitchell,
+        # so a stretched mask can differ from ImageMagick's by a level or so.
+        enlarge = im.size[0] * im.size[1] < size[0] * size[1]
+        im = im.convert('L' if im.mode in ('1', 'L', 'LA') else 'RGB')
+        im = im.resize(tuple(size), Image.BICUBIC if enlarge else Image.LANCZOS)
+    color, alpha, maxval = SliceEngine._to_array(im)
+    return color, maxval
+
+
+def compare_images(im1, im2, diff_fname=None, displayed=False):
+    """Counts the pixels that differ between two images (filenames or file objects), like ImageMagick's -metric AE
+    with no fuzz: images of different color types or bit depths that hold the same pixels match. If they differ and
+    diff_fname is given, writes a diff image there (creating its folder if need be) with the differing pixels in red
+    over a faded copy of im1. Images of different sizes differ at every pixel.
+    With displayed, the images are compared as the printer host shows them instead: flattened over black, in gray, at
+    8 bits (see SliceEngine._compact_gray). That's what slices written with compact encoding are checked with."""
+    im1 = Image.open(im1)
+    im2 = Image.open(im2)
+    if im1.size != im2.size:
+        return max(im1.size[0] * im1.size[1], im2.size[0] * im2.size[1])
+    if displayed:
+        color1, alpha1 = SliceEngine._compact_gray(*SliceEngine._to_array(im1))[:, :, np.newaxis], None
+        color2, alpha2 = SliceEngine._compact_gray(*SliceEngine._to_array(im2))[:, :, np.newaxis], None
+    else:
+        color1, alpha1 = _normalized(im1)
+        color2, alpha2 = _normalized(im2)
+    # a grayscale image has one channel, which is compared against each channel of a color one
+    differ = np.zeros(color1.shape[:2], dtype=bool)
+    for channel in range(max(color1.shape[2], color2.shape[2])):
+        differ |= color1[:, :, min(channel, color1.shape[2] - 1)] != color2[:, :, min(channel, color2.shape[2] - 1)]
+    if alpha1 is not None or alpha2 is not None:
+        differ |= (65535 if alpha1 is None else alpha1) != (65535 if alpha2 is None else alpha2)
+    count = int(differ.sum())
+    if count > 0 and diff_fname is not None:
+        faded = 255 - (255 - np.asarray(im1.convert('L'), dtype=np.uint16)) // 5
+        diff = np.repeat(faded.astype(np.uint8)[:, :, np.newaxis], 3, axis=2)
+        diff[differ] = (255, 0, 0)
+        if os.path.dirname(diff_fname) and not os.path.exists(os.path.dirname(diff_fname)):
+            os.makedirs(os.path.dirname(diff_fname))
+        Image.fromarray(diff, 'RGB').save(diff_fname)
+    return count
+
+
+def _normalized(im):
+    """Returns the pixels of a PIL image as (color, alpha) 16-bit arrays, whatever its mode. color is (H, W, 1) for
+    grayscale images and (H, W, 3) for color ones; alpha is None for opaque images."""
+    color, alpha, maxval = SliceEngine._to_array(im)
+    color = color.astype(np.uint16)
+    if maxval != 65535:
+        color *= 65535 // maxval
+    if alpha is not None:
+        alpha = alpha.astype(np.uint16)
+        if maxval != 65535:
+            alpha *= 65535 // maxval
+    return color, alpha
+
+
+def write_gray_png(gray, out_fname, bits=8, compress_level=6, png_filter="none"):
+    """Writes gray, a (H, W) uint8 array, to out_fname (a filename or file object) as a grayscale png with bits (1 or
+    8) bits per pixel; at 1 bit, pixels that aren't 0 come out white. compress_level is the zlib level (0-9) and
+    png_filter the filter type (one of PNG_FILTERS, or "adaptive"). Pillow can't be told which filter to use, so this
+    writes the png itself, with nothing but the IHDR, IDAT and IEND chunks, filtering and compressing PNG_CHUNK_ROWS
+    rows at a time."""
+    compressor = zlib.compressobj(compress_level)
+    idat = []
+    previous = None
+    for y0 in range(0, gray.shape[0], PNG_CHUNK_ROWS):
+        rows = gray[y0:y0 + PNG_CHUNK_ROWS]
+        if bits == 1:
+            rows = np.packbits(rows != 0, axis=1)
+        idat.append(compressor.compress(_png_filter_rows(rows, previous, png_filter).tobytes()))
+        previous = rows[-1]
+    idat.append(compressor.flush())
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+    header = struct.pack(">IIBBBBB", gray.shape[1], gray.shape[0], bits, 0, 0, 0, 0)    # grayscale, not interlaced
+    data = "\x89PNG\r\n\x1a\n" + chunk("IHDR", header) + chunk("IDAT", "".join(idat)) + chunk("IEND", "")
+    if isinstance(out_fname, basestring):
+        with open(out_fname, "wb") as fout:
+            fout.write(data)
+    else:
+        out_fname.write(data)
+
+
+def _png_filter_rows(rows, previous, png_filter):
+    """Returns rows, (H, bytes per row) uint8 scanlines of a png with one byte per pixel or less, filtered with
+    png_filter and each starting with its filter type byte. previous is the scanline before the first row, or None at
+    the top of the image."""
+    # uint8 arithmetic wraps around the way the png filters do
+    raw = rows
+    up = np.zeros_like(raw)
+    if previous is not None:
+        up[0] = previous
+    up[1:] = raw[:-1]
+    left = np.zeros_like(raw)
+    left[:, 1:] = raw[:, :-1]
+    up_left = np.zeros_like(raw)
+    up_left[:, 1:] = up[:, :-1]
+
+    def filtered(kind):
+        if kind == 0:
+            return raw
+        if kind == 1:
+            return raw - left
+        if kind == 2:
+            return raw - up
+        if kind == 3:
+            return raw - ((left >> 1) + (up >> 1) + (left & up & 1))     # floor((left + up) / 2)
+        # Paeth: whichever of left, up and up-left is closest to left + up - up-left
+        up_diff = up.astype(np.int16) - up_left
+        left_diff = left.astype(np.int16) - up_left
+        pa = np.abs(up_diff)
+        pb = np.abs(left_diff)
+        pc = np.abs(up_diff + left_diff)
+        return raw - np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, up_left))
+
+    result = np.empty((rows.shape[0], rows.shape[1] + 1), np.uint8)
+    if png_filter != "adaptive":
+        kind = PNG_FILTERS.index(png_filter)
+        result[:, 0] = kind
+        result[:, 1:] = filtered(kind)
+        return result
+    # libpng's heuristic: the filter whose bytes, taken as signed, add up to the least
+    best = None
+    for kind in range(len(PNG_FILTERS)):
+        data = filtered(kind)
+        cost = np.abs(data.view(np.int8).astype(np.int16)).sum(axis=1, dtype=np.int32)
+        if best is None:
+            best = cost
+            result[:, 0] = kind
+            result[:, 1:] = data
+        else:
+            better = cost < best
+            best = np.where(better, cost, best)
+            result[better, 0] = kind
+            result[better, 1:] = data[better]
+    return result
+
+
+def scaled_size(size, scale):
+    """Returns size (width, height) scaled by scale (x, y), rounded the way ImageMagick rounds -resize geometry."""
+    return (max(1, int(math.floor(size[0] * scale[0] + 0.5))), max(1, int(math.floor(size[1] * scale[1] + 0.5))))
+
+
+class Resampler:
+    """Scales images of src_size to size (both (width, height)) with a triangle filter, widened by the scale factor
+    when shrinking so every source pixel counts, like ImageMagick's -filter Triangle -resize.
+
+    The filter taps only depend on the two sizes, so they're worked out once, when the resampler is made, and reused
+    for every slice; scaling a slice is then a few multiply-adds per pixel along each axis. Any rectangle of the output
+    can be made on its own from the part of the source under it (see source_box), so SliceEngine can scale a strip at
+    a time."""
+
+    def __init__(self, src_size, size):
+        self.src_size = tuple(src_size)
+        self.size = tuple(size)
+        self.x = self._taps(self.src_size[0], self.size[0])
+        self.y = self._taps(self.src_size[1], self.size[1])
+
+    @staticmethod
+    def _taps(src, dst):
+        """Returns (index, weights), each (dst, taps): output pixel i along an axis is the sum over t of
+        weights[i, t] * input pixel index[i, t]. Taps past the edge of the image have no weight."""
+        scale = float(src) / dst
+        support = max(scale, 1.)
+        centers = (np.arange(dst) + 0.5) * scale
+        first = np.clip(np.floor(centers - support + 0.5).astype(np.int64), 0, src - 1)
+        last = np.clip(np.floor(centers + support + 0.5).astype(np.int64), first + 1, src)
+        index = first[:, np.newaxis] + np.arange(int((last - first).max()))
+        weights = np.maximum(0., 1. - np.abs((index + 0.5 - centers[:, np.newaxis]) / support))
+        weights[index >= last[:, np.newaxis]] = 0.
+        weights /= weights.sum(axis=1)[:, np.newaxis]
+        return np.minimum(index, src - 1), weights.astype(np.float32)
+
+    def source_box(self, box):
+        """Returns the (left, top, right, bottom) box of the source image needed to make box of the output."""
+        x0, y0, x1, y1 = box
+        x_index, y_index = self.x[0][x0:x1], self.y[0][y0:y1]
+        return int(x_index.min()), int(y_index.min()), int(x_index.max()) + 1, int(y_index.max()) + 1
+
+    def resample(self, data, box, source, maxval):
+        """Returns box of the output, given data, the (H, W) or (H, W, channels) integer pixels of the source image
+        in source (see source_box). The result has the dtype of data, rounded and clipped to 0..maxval."""
+        x0, y0, x1, y1 = box
+        result = self._apply(data.astype(np.float32), self.y, y0, y1, source[1], 0)
+        result = self._apply(result, self.x, x0, x1, source[0], 1)
+        return np.clip(np.rint(result), 0, maxval).astype(data.dtype)
+
+    @staticmethod
+    def _apply(data, taps, first, last, offset, axis):
+        """Scales data along axis, making output pixels first to last - 1 from input pixels starting at offset."""
+        index = taps[0][first:last] - offset
+        weights = taps[1][first:last]
+        shape = [1] * data.ndim
+        shape[axis] = last - first
+        result = None
+        for t in range(index.shape[1]):
+            term = data.take(index[:, t], axis=axis)
+            term *= weights[:, t].reshape(shape)
+            if result is None:
+                result = term
+            else:
+                result += term
+        return result
+
+
+class SliceEngine:
+    """Runs the same per-slice pipeline as the ImageMagick command built in Honeyguide.do_honeyguide, but in-process:
+
+        magick ( slice [-filter Triangle -resize G] [-channel RGB -negate] [-threshold N%] -background black
+                 -compose Copy -gravity center -extent WxH -composite )
+               [( mask -resize WxH! ) -compose Multiply -gravity center -composite] out.png
+
+    Pixels are kept as integers at the bit depth of the input slice, so the results match ImageMagick's Q16 output
+    exactly for 8- and 16-bit slices. The one exception is scaling (see Resampler), which agrees with ImageMagick's to
+    within rounding rather than exactly. The mask is prepared once, when the engine is created, and comes from
+    mask_cache when possible."""
+
+    def __init__(self, size, negate=False, threshold=False, threshold_val=50, mask_image=None, mask=None,
+                 memory_budget=None, scale=None, compact=False, compress_level=6, png_filter="none"):
+        """Sets up the engine.
+          * size - (width, height) of the template slices.
+          * negate, threshold, threshold_val - same meaning as the Honeyguide members of the same name.
+          * mask_image - filename of the mask image, or None for no mask.
+          * mask - the already prepared (mask, maxval) for mask_image, if the caller has it.
+          * memory_budget - roughly how many bytes of scratch arrays a slice may take while it is processed and
+                           encoded, or None for no limit. Slices that would need more are done in horizontal strips
+                           (see _strips); the result is the same either way.
+          * scale - None to leave slices at their own size, "fit" to scale them to fit the template keeping their
+                    aspect ratio, or the (x, y) factors to scale them by. Slices are scaled before everything else.
+          * compact, compress_level, png_filter - with compact, slices are written as 1-bit grayscale pngs if they're
+                    only black and white and as 8-bit grayscale otherwise, with the given zlib level and png filter
+                    (see write_gray_png), instead of as the smallest lossless png type. See encode."""
+        self.size = tuple(size)
+        self.negate = negate
+        self.threshold = threshold
+        self.threshold_val = threshold_val
+        self.mask_image = mask_image
+        self.mask = None
+        self.mask_max = 255
+        self.memory_budget = memory_budget
+        self.scale = scale
+        self.compact = compact
+        self.compress_level = compress_level
+        self.png_filter = png_filter
+        self._resamplers = {}       # source size -> Resampler, or None where there's nothing to scale
+        if mask is not None:
+            self.mask, self.mask_max = mask
+        elif mask_image is not None:
+            self.mask, self.mask_max = mask_cache.get(mask_image, self.size)
+
+    def settings(self):
+        """Returns the arguments needed to build an identical engine, e.g. in another process. The prepared mask is
+        included so other processes don't have to load it again."""
+        mask = (self.mask, self.mask_max) if self.mask is not None else None
+        return (self.size, self.negate, self.threshold, self.threshold_val, self.mask_image, mask, self.memory_budget,
+                self.scale, self.compact, self.compress_level, self.png_filter)
+
+    def convert(self, in_fname, out_fname):
+        """Processes the slice image in_fname (see open_image) and writes the result to out_fname as a png."""
+        self.encode(self.process(open_image(in_fname)), out_fname)
+
+    def convert_to_bytes(self, in_fname):
+        """Processes the slice image in_fname (see open_image) and returns the png file contents."""
+        return self.convert_image_to_bytes(open_image(in_fname))
+
+    def convert_image_to_bytes(self, im):
+        """Processes a slice that's already been opened as the PIL image im and returns the png file contents."""
+        buf = io.BytesIO()
+        self.encode(self.process(im), buf)
+        return buf.getvalue()
+
+    def blank(self, out_fname):
+        """Writes an all-black slice to out_fname."""
+        if self.compact:
+            write_gray_png(np.zeros(self.size[::-1], np.uint8), out_fname, 1, self.compress_level, self.png_filter)
+        else:
+            Image.new('1', self.size, 0).save(out_fname, 'PNG')
+
+    def blank_bytes(self):
+        """Returns the png file contents of an all-black slice."""
+        buf = io.BytesIO()
+        self.blank(buf)
+        return buf.getvalue()
+
+    def process(self, im):
+        """Runs the pipeline on a PIL image, returning (color, alpha, maxval) where color is a (H, W, channels)
+        integer array, alpha is a (H, W) array or None and maxval is the full-scale pixel value.
+        The slice is converted a strip of output rows at a time when memory_budget calls for it. Only the part of the
+        slice that lands on the template is ever converted (and scaled)."""
+        w, h = self.size
+        resampler = self.resampler(im.size)
+        src_w, src_h = im.size if resampler is None else resampler.size
+        # -background black -gravity center -extent WxH, with ImageMagick's center gravity rounding
+        off_x = w // 2 - src_w // 2
+        off_y = h // 2 - src_h // 2
+        sx0, sx1 = max(0, -off_x), min(src_w, w - off_x)
+
+        # the pixel format of the result, from a single pixel
+        sample, sample_alpha, maxval = self._to_array(im.crop((0, 0, 1, 1)))
+        channels = sample.shape[2]
+        if self.mask is not None:
+            channels = max(channels, self.mask.shape[2])
+
+        color = alpha = None
+        for y0, y1 in self._strips(h, channels):
+            sy0, sy1 = max(0, y0 - off_y), min(src_h, y1 - off_y)
+            part = part_alpha = None
+            if sx1 > sx0 and sy1 > sy0:
+                box = (sx0, sy0, sx1, sy1)
+                source = box if resampler is None else resampler.source_box(box)
+                part, part_alpha, maxval = self._to_array(im if source == (0, 0) + im.size else im.crop(source))
+                if resampler is not None:
+                    part = resampler.resample(part, box, source, maxval)
+                    if part_alpha is not None:
+                        part_alpha = resampler.resample(part_alpha, box, source, maxval)
+                part = self._point_ops(part, maxval)
+
+            # place the part on the black canvas, unless it covers the strip already
+            if part is not None and part.shape[:2] == (y1 - y0, w):
+                strip, strip_alpha = part, part_alpha
+            else:
+                strip = np.zeros((y1 - y0, w, sample.shape[2]), sample.dtype)
+                strip_alpha = None
+                if sample_alpha is not None:
+                    strip_alpha = np.empty((y1 - y0, w), sample.dtype)
+                    strip_alpha.fill(maxval)
+                if part is not None:
+                    rows = slice(sy0 + off_y - y0, sy1 + off_y - y0)
+                    cols = slice(sx0 + off_x, sx1 + off_x)
+                    strip[rows, cols] = part
+                    if strip_alpha is not None:
+                        strip_alpha[rows, cols] = part_alpha
+
+            # ( mask -resize WxH! ) -compose Multiply -composite
+            if self.mask is not None:
+                mask = self.mask[y0:y1]
+                if strip.shape[2] != mask.shape[2]:
+                    # grayscale slice with a color mask (or the other way around) gives a color result.
+                    strip = np.repeat(strip, 3, axis=2) if strip.shape[2] == 1 else strip
+                    mask = np.repeat(mask, 3, axis=2) if mask.shape[2] == 1 else mask
+                product = strip.astype(np.int64) * mask
+                strip = ((2 * product + self.mask_max) // (2 * self.mask_max)).astype(strip.dtype)
+
+            if y1 - y0 == h:
+                return strip, strip_alpha, maxval
+            if color is None:
+                color = np.empty((h, w, strip.shape[2]), strip.dtype)
+                if strip_alpha is not None:
+                    alpha = np.empty((h, w), strip_alpha.dtype)
+            color[y0:y1] = strip
+            if alpha is not None:
+                alpha[y0:y1] = strip_alpha
+
+        return color, alpha, maxval
+
+    def resampler(self, src_size):
+        """Returns the Resampler that scales slices of src_size (width, height) to the size the scale setting calls
+        for, or None if they stay as they are. There's one per source size, made the first time it's needed."""
+        src_size = tuple(src_size)
+        if src_size not in self._resamplers:
+            resampler = None
+            if self.scale is not None:
+                if self.scale == "fit":
+                    factor = min(float(self.size[0]) / src_size[0], float(self.size[1]) / src_size[1])
+                    size = scaled_size(src_size, (factor, factor))
+                else:
+                    size = scaled_size(src_size, self.scale)
+                if size != src_size:
+                    resampler = Resampler(src_size, size)
+            self._resamplers[src_size] = resampler
+        return self._resamplers[src_size]
+
+    def _point_ops(self, color, maxval):
+        """Applies the per-pixel part of the pipeline (negate and threshold) to color, which can be any part of the
+        slice."""
+        # -channel RGB -negate: alpha is left alone.
+        if self.negate:
+            color = maxval - color
+
+        # -threshold: with the default channel mask, ImageMagick thresholds the pixel intensity and writes it to every
+        # channel. The -channel RGB left behind by -negate makes it threshold each channel on its own instead.
+        if self.threshold:
+            limit = self.threshold_val * maxval
+            if color.shape[2] == 3 and not self.negate:
+                intensity = LUMA_WEIGHTS[0] * color[:, :, 0] + LUMA_WEIGHTS[1] * color[:, :, 1] + \
+                    LUMA_WEIGHTS[2] * color[:, :, 2]
+                bw = np.where(intensity * 100 > limit, maxval, 0).astype(color.dtype)
+                color = np.repeat(bw[:, :, np.newaxis], 3, axis=2)
+            else:
+                color = np.where(color.astype(np.int64) * 100 > limit, maxval, 0).astype(color.dtype)
+        return color
+
+    def encode(self, result, out_fname):
+        """Writes the result of process() to out_fname (a filename or file object) as a png, picking the smallest png
+        type that holds the pixels losslessly, the way ImageMagick's png coder does.
+        With compact, the slice is flattened to 8-bit gray the way the printer host shows it (see _compact_gray) and
+        written as a 1-bit png if that leaves only black and white, or an 8-bit one otherwise."""
+        color, alpha, maxval = result
+        strips = list(self._strips(color.shape[0], color.shape[2] + (alpha is not None)))
+
+        # drop channels that don't carry information
+        if alpha is not None and all((alpha[y0:y1] == maxval).all() for y0, y1 in strips):
+            alpha = None
+        if color.shape[2] == 3 and all((color[y0:y1, :, 0] == color[y0:y1, :, 1]).all() and
+                                       (color[y0:y1, :, 0] == color[y0:y1, :, 2]).all() for y0, y1 in strips):
+            color = color[:, :, :1]
+
+        if self.compact:
+            gray = np.empty(color.shape[:2], np.uint8)
+            for y0, y1 in strips:
+                gray[y0:y1] = self._compact_gray(color[y0:y1], None if alpha is None else alpha[y0:y1], maxval)
+            bits = 1 if all(((gray[y0:y1] == 0) | (gray[y0:y1] == 255)).all() for y0, y1 in strips) else 8
+            write_gray_png(gray, out_fname, bits, self.compress_level, self.png_filter)
+            return
+
+        if color.shape[2] == 1 and alpha is None:
+            gray = color[:, :, 0]
+            if all(((gray[y0:y1] == 0) | (gray[y0:y1] == maxval)).all() for y0, y1 in strips):
+                data = np.empty(gray.shape, np.uint8)
+                for y0, y1 in strips:
+                    data[y0:y1] = (gray[y0:y1] == maxval).astype(np.uint8) * 255
+                im = Image.fromarray(data, 'L').convert('1')
+            elif maxval == 65535 and any((gray[y0:y1] % 257 != 0).any() for y0, y1 in strips):
+                im = Image.fromarray(gray.astype(np.int32), 'I')
+            else:
+                data = np.empty(gray.shape, np.uint8)
+                for y0, y1 in strips:
+                    data[y0:y1] = self._to_8bit(gray[y0:y1], maxval)
+                im = Image.fromarray(data, 'L')
+        else:
+            # Pillow can't write 16-bit color or gray+alpha pngs, so these go out at 8 bits.
+            data = np.empty(color.shape[:2] + (color.shape[2] + (alpha is not None),), np.uint8)
+            for y0, y1 in strips:
+                data[y0:y1, :, :color.shape[2]] = self._to_8bit(color[y0:y1], maxval)
+                if alpha is not None:
+                    data[y0:y1, :, -1] = self._to_8bit(alpha[y0:y1], maxval)
+            im = Image.fromarray(data, {2: 'LA', 3: 'RGB', 4: 'RGBA'}[data.shape[2]])
+        im.save(out_fname, 'PNG')
+
+    @staticmethod
+    def _compact_gray(color, alpha, maxval):
+        """Returns part of a slice as 8-bit gray, the way a printer host that draws slices over black at 8 bits per
+        channel shows it: color becomes its Rec. 709 luma (as ImageMagick's -colorspace Gray) and alpha is multiplied
+        in (as -background black -alpha remove)."""
+        if color.shape[2] == 1 and alpha is None:
+            return SliceEngine._to_8bit(color[:, :, 0], maxval)
+        if color.shape[2] == 3:
+            gray = (LUMA_WEIGHTS[0] * color[:, :, 0] + LUMA_WEIGHTS[1] * color[:, :, 1] +
+                    LUMA_WEIGHTS[2] * color[:, :, 2])
+        else:
+            gray = color[:, :, 0].astype(np.float64)
+        if alpha is not None:
+            gray = gray * alpha / maxval
+        return SliceEngine._to_8bit(np.clip(np.rint(gray), 0, maxval).astype(np.uint32), maxval)
+
+    def _strips(self, height, channels):
+        """Yields the (first, last + 1) rows of the strips an image of the template width, height rows and channels
+        channels is worked on in, so the scratch arrays for each strip (up to SCRATCH_BYTES per sample) fit in
+        memory_budget. With no budget, or one the whole image fits in, that's a single strip."""
+        rows = height
+        if self.memory_budget is not None:
+            rows = max(1, min(height, self.memory_budget // (self.size[0] * channels * SCRATCH_BYTES)))
+        for y0 in range(0, height, rows):
+            yield y0, min(height, y0 + rows)
+
+    @staticmethod
+    def _to_array(im):
+        """Splits a PIL image into (color, alpha, maxval). color is (H, W, 1) for grayscale images and (H, W, 3) for
+        color ones."""
+        if im.mode in ('I', 'I;16', 'I;16B', 'I;16L'):
+            # Pillow loads 16-bit grayscale pngs as 32-bit integer images
+            return np.asarray(im, dtype=np.uint16)[:, :, np.newaxis], None, 65535
+        if im.mode in ('1', 'L'):
+            return np.asarray(im.convert('L'))[:, :, np.newaxis], None, 255
+        if im.mode == 'LA':
+            data = np.asarray(im)
+            return data[:, :, :1], data[:, :, 1], 255
+        if im.mode == 'RGB':
+            return np.asarray(im), None, 255
+        data = np.asarray(im.convert('RGBA'))
+        return data[:, :, :3], data[:, :, 3], 255
+
+    @staticmethod
+    def _to_8bit(data, maxval):
+        """Rescales data to 8 bits, rounding the way ImageMagick does when it writes 8-bit files."""
+        if maxval == 255:
+            return data.astype(np.uint8)
+        return ((data.astype(np.uint32) + 128) // 257).astype(np.uint8)
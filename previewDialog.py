@@ -0,0 +1,177 @@
+# Honeyguide - a program for injecting image stack data into CreationWorkshop CWS files.
+# previewDialog.py - shows the layers of a CWS file, one at a time.
+#
+# Ben Weiss at the University of Washington
+#
+# Source: Sample code borrowed from the folowing places:
+# http://infohost.nmt.edu/tcc/help/pubs/tkinter/web/minimal-app.html
+#
+#
+# (c) 2015 Ben Weiss
+# License: MIT License:
+#
+#    Copyright (c) 2015 Ben Weiss; parts (c) 2015 Ben Weiss, University of Washington
+#
+#
+#    Permission is hereby granted, free of charge, to any person obtaining a
+#    copy of this software and associated documentation files (the "Software"),
+#    to deal in the Software without restriction, including without limitation
+#    the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#    and/or sell copies of the Software, and to permit persons to whom the
+#    Software is furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included
+#    in all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#    THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#    FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#    DEALINGS IN THE SOFTWARE.
+#
+#-------------------------------------------------------------------------------
+
+__author__ = 'Ben Weiss'
+
+import os
+import zipfile
+import ttk
+import cws_scripts as cws
+
+import Tkinter as tk
+
+try:
+    from PIL import ImageTk
+    available = cws.image_engine.available     # thumbnails are made with the built-in image engine
+except ImportError:
+    available = False
+
+
+class Preview(ttk.Frame):
+    """Lets the user scrub through the layers of the output CWS file (or the template), decoding each layer only when
+    it's shown. See cws_scripts.CwsThumbnails."""
+
+    THUMBNAIL_SIZE = (480, 270)
+
+    def __init__(self, master):
+        # non-GUI variables
+        self.thumbs = None
+        self.files = {}         # "output"/"template" -> CWS file
+        self.layer = 0
+        self.photo = None       # keep a reference, or Tk shows nothing
+        self.poll_id = None
+
+        ttk.Frame.__init__(self, master, padding="5 5 12 12")
+        self.master.title('Preview')
+        self.winfo_toplevel().columnconfigure(0, weight=1)
+        self.columnconfigure(0, weight=1)
+        self.grid(column=0, row=0, sticky=tk.N+tk.S+tk.W+tk.E)
+
+        # install closing handler
+        self.winfo_toplevel().protocol("WM_DELETE_WINDOW", self.close)
+
+        # TK variables
+        self.v_source = tk.StringVar()
+        self.v_source.set("output")
+        self.v_layer = tk.DoubleVar()
+        self.v_info = tk.StringVar()
+
+        # Create the widgets
+        self.image_label = ttk.Label(self, anchor=tk.CENTER, background="black")
+        self.image_label.grid(column=0, row=0, columnspan=3, sticky=tk.N+tk.S+tk.W+tk.E, padx=6, pady=8)
+        self.blank = tk.PhotoImage(width=self.THUMBNAIL_SIZE[0], height=self.THUMBNAIL_SIZE[1])
+        self.image_label.configure(image=self.blank)
+
+        self.scale = ttk.Scale(self, orient=tk.HORIZONTAL, from_=0, to=0, variable=self.v_layer, command=self.scrub)
+        self.scale.grid(column=0, row=1, columnspan=3, sticky=tk.W+tk.E, padx=6)
+        ttk.Label(self, textvariable=self.v_info).grid(column=0, row=2, columnspan=3, sticky=tk.W, padx=6, pady=4)
+
+        self.rb_output = ttk.Radiobutton(self, text="Output", variable=self.v_source, value="output",
+                                         command=self.open_source)
+        self.rb_output.grid(column=0, row=3, sticky=tk.W, padx=6, pady=8)
+        self.rb_template = ttk.Radiobutton(self, text="Template", variable=self.v_source, value="template",
+                                           command=self.open_source)
+        self.rb_template.grid(column=1, row=3, sticky=tk.W, padx=6, pady=8)
+        ttk.Button(self, text="Close", command=self.close).grid(column=2, row=3, sticky=tk.E, padx=6, pady=8)
+
+        # arrow keys step through the layers
+        top = self.winfo_toplevel()
+        top.bind("<Left>", lambda e: self.step(-1))
+        top.bind("<Right>", lambda e: self.step(1))
+        top.bind("<Prior>", lambda e: self.step(-10))
+        top.bind("<Next>", lambda e: self.step(10))
+        top.bind("<Home>", lambda e: self.step(-len(self.thumbs or ())))
+        top.bind("<End>", lambda e: self.step(len(self.thumbs or ())))
+
+    def show(self, output_cws, template_cws):
+        """Shows the window with the output CWS file, or the template if there isn't an output yet."""
+        self.files = {"output": output_cws, "template": template_cws}
+        self.rb_output.configure(state=tk.NORMAL if os.path.isfile(output_cws) else tk.DISABLED)
+        self.rb_template.configure(state=tk.NORMAL if os.path.isfile(template_cws) else tk.DISABLED)
+        self.v_source.set("output" if os.path.isfile(output_cws) else "template")
+        self.master.deiconify()
+        self.open_source()
+
+    def open_source(self):
+        """Opens whichever CWS file is selected and shows its first layer."""
+        self.close_thumbs()
+        fname = self.files.get(self.v_source.get(), "")
+        try:
+            self.thumbs = cws.CwsThumbnails(fname, self.THUMBNAIL_SIZE)
+        except (IOError, zipfile.BadZipfile):
+            self.thumbs = None
+        if not self.thumbs:
+            self.scale.configure(to=0)
+            self.image_label.configure(image=self.blank)
+            self.v_info.set("No slices in %s" % fname if self.thumbs is not None else "Can't open %s" % fname)
+            return
+        self.scale.configure(to=len(self.thumbs) - 1)
+        self.layer = 0
+        self.v_layer.set(0)
+        self.update_image()
+
+    def step(self, count):
+        if self.thumbs:
+            self.v_layer.set(min(max(self.layer + count, 0), len(self.thumbs) - 1))
+            self.scrub(self.v_layer.get())
+
+    def scrub(self, value):
+        """Called as the slider moves; shows the layer it's on."""
+        layer = int(float(value) + 0.5)
+        if self.thumbs and layer != self.layer:
+            self.layer = layer
+            self.update_image()
+
+    def update_image(self):
+        """Shows the current layer, or checks back shortly if it's still being decoded."""
+        if self.poll_id is not None:
+            self.after_cancel(self.poll_id)
+            self.poll_id = None
+        if self.thumbs is None:
+            return
+        thumb = self.thumbs.get(self.layer)
+        if thumb is None:
+            self.v_info.set("Layer %i of %i (loading...)" % (self.layer + 1, len(self.thumbs)))
+            self.poll_id = self.after(20, self.update_image)
+        elif thumb is False:
+            self.image_label.configure(image=self.blank)
+            self.v_info.set("Layer %i of %i can't be read" % (self.layer + 1, len(self.thumbs)))
+        else:
+            self.photo = ImageTk.PhotoImage(thumb)
+            self.image_label.configure(image=self.photo)
+            self.v_info.set("Layer %i of %i" % (self.layer + 1, len(self.thumbs)))
+
+    def close_thumbs(self):
+        if self.poll_id is not None:
+            self.after_cancel(self.poll_id)
+            self.poll_id = None
+        if self.thumbs is not None:
+            self.thumbs.close()
+            self.thumbs = None
+
+    def close(self):
+        # Just hide this window. It will get destroyed when we close down the program.
+        self.close_thumbs()
+        self.master.withdraw()
@@ -0,0 +1,296 @@
+# Honeyguide - a program for injecting image stack data into CreationWorkshop CWS files.
+# run_tests.py - builds the scenarios in Tests/tests.ini and checks them against their reference CWS files, several
+# at a time.
+#
+# Ben Weiss at the University of Washington
+#
+# Usage: python run_tests.py [scenario ...] [options]; see --help. For example
+#     python run_tests.py --jobs 4 --timeout 600 --junit results.xml
+# runs every scenario in Tests/tests.ini, four at a time, and
+#     python run_tests.py Test1 "thresh*"
+# runs only the scenarios whose section names match, ignoring case. Each scenario runs in its own process with its
+# own Honeyguide object and temporary folder, so scenarios can't affect each other and one that runs past --timeout
+# can be stopped.
+# The [General] section sets imagemagickcmd and optionally engine, streaming, workers, pipeline, slice_cache_bytes and
+# slice_encoding for every scenario, as for the test harness at the bottom of cws_scripts.py. With slice_encoding =
+# compact, the slices are compared as the printer shows them (see Honeyguide.compare_cws_files).
+#
+# A line per scenario is printed as it finishes; --json and --junit also save a summary with how long each scenario
+# took to build and to compare. The exit code is 0 if every scenario passed and 1 otherwise. Differences are written
+# next to the reference files, as compare_cws_files does.
+#
+# (c) 2015 Ben Weiss
+# License: MIT License:
+#
+#    Copyright (c) 2015 Ben Weiss; parts (c) 2015 Ben Weiss, University of Washington
+#
+#
+#    Permission is hereby granted, free of charge, to any person obtaining a
+#    copy of this software and associated documentation files (the "Software"),
+#    to deal in the Software without restriction, including without limitation
+#    the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#    and/or sell copies of the Software, and to permit persons to whom the
+#    Software is furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included
+#    in all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#    THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#    FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#    DEALINGS IN THE SOFTWARE.
+#
+#-------------------------------------------------------------------------------
+
+__author__ = 'Ben Weiss'
+
+import argparse
+import ConfigParser
+import fnmatch
+import json
+import multiprocessing
+import os
+import Queue
+import shutil
+import StringIO
+import sys
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+
+import cws_scripts
+
+# how long a scenario that ran past its timeout gets to cancel itself before its process is killed
+CANCEL_GRACE = 5.
+
+
+def read_scenarios(config):
+    """Returns the list of scenarios in the tests.ini file config, as dictionaries of the names and settings needed to
+    run them."""
+    cp = ConfigParser.SafeConfigParser()
+    if not cp.read(config):
+        raise IOError("Couldn't read %s" % config)
+
+    general = {"imagemagick_cmd": cp.get("General", "imagemagickcmd"),
+               # the tests check conversion, so don't let converted slices from an earlier run stand in for it
+               "slice_cache_bytes": 0}
+    if cp.has_option("General", "engine"):
+        general["engine"] = cp.get("General", "engine")
+    if cp.has_option("General", "streaming"):
+        general["streaming"] = cp.getboolean("General", "streaming")
+    if cp.has_option("General", "workers"):
+        general["workers"] = cp.getint("General", "workers")
+    if cp.has_option("General", "pipeline"):
+        general["pipeline"] = cp.getboolean("General", "pipeline")
+    if cp.has_option("General", "slice_encoding"):
+        general["slice_encoding"] = cp.get("General", "slice_encoding")
+    if cp.has_option("General", "slice_cache_bytes"):
+        general["slice_cache_bytes"] = cp.getint("General", "slice_cache_bytes")
+
+    scenarios = []
+    for section in cp.sections():
+        if section == "General":
+            continue
+        settings = dict(general)
+        settings.update({"negate": int(cp.get(section, "negate")),
+                         "threshold": int(cp.get(section, "threshold")),
+                         "threshold_val": int(cp.get(section, "threshval")),
+                         "repeat_first": int(cp.get(section, "replicatefirst")),
+                         "use_mask": int(cp.get(section, "usemask")),
+                         "mask_image": cp.get(section, "maskimage")})
+        scenarios.append({"name": section,
+                          "template": cp.get(section, "template"),
+                          "input": cp.get(section, "inputimages"),
+                          "refcws": cp.get(section, "refcws"),
+                          "settings": settings})
+    return scenarios
+
+
+def run_scenario(scenario, temp_dir, results, cancel_event):
+    """Builds one scenario into temp_dir and compares it with its reference, putting the result (a dictionary) on the
+    results queue. Runs in its own process; setting cancel_event cancels the build."""
+    log = StringIO.StringIO()
+    h = cws_scripts.Honeyguide(logfile=log)
+    h.echo = False
+    h.quiet = True
+    for key, value in scenario["settings"].items():
+        setattr(h, key, value)
+
+    def watch_for_cancel():
+        cancel_event.wait()
+        h.cancel()
+    watcher = threading.Thread(target=watch_for_cancel)
+    watcher.daemon = True
+    watcher.start()
+
+    result = {"name": scenario["name"], "build_seconds": 0., "compare_seconds": 0.}
+    try:
+        start = time.time()
+        success, message = h.do_honeyguide(scenario["template"], scenario["input"],
+                                           os.path.join(temp_dir, scenario["name"] + ".cws"))
+        result["build_seconds"] = round(time.time() - start, 3)
+        if not success:
+            result.update(status="error", message="Build failed: %s" % message)
+        else:
+            start = time.time()
+            same = h.compare_cws_files(scenario["refcws"], os.path.join(temp_dir, scenario["name"] + ".cws"),
+                                       h.imagemagick_cmd, displayed=h.slice_encoding == "compact")
+            result["compare_seconds"] = round(time.time() - start, 3)
+            result.update(status="passed" if same else "failed",
+                          message="Passed" if same else "Differs from %s" % scenario["refcws"])
+    except Exception as e:
+        result.update(status="error", message="Unexpected error: %s" % e)
+    result["log"] = log.getvalue()
+    results.put(result)
+
+
+def run_all(scenarios, jobs, timeout, report=None):
+    """Runs scenarios, up to jobs at a time, each in its own process and temporary folder. A scenario still running
+    timeout seconds after it started (if timeout) is cancelled. Calls report(result) as each one finishes, and returns
+    all the results in the order of scenarios."""
+    temp_root = tempfile.mkdtemp()
+    results = multiprocessing.Queue()
+    pending = list(scenarios)
+    running = {}        # name -> [process, cancel event, start time, cancelled at]
+    finished = {}
+    try:
+        while pending or running:
+            while pending and len(running) < jobs:
+                scenario = pending.pop(0)
+                temp_dir = tempfile.mkdtemp(dir=temp_root)
+                cancel_event = multiprocessing.Event()
+                process = multiprocessing.Process(target=run_scenario,
+                                                  args=(scenario, temp_dir, results, cancel_event))
+                # not a daemon, so that a scenario with workers can start its own pool; anything still running is
+                # terminated below
+                process.start()
+                running[scenario["name"]] = [process, cancel_event, time.time(), None]
+
+            try:
+                result = results.get(True, 0.1)
+            except Queue.Empty:
+                result = None
+            if result is not None and result["name"] in running:
+                process, cancel_event, start, cancelled_at = running.pop(result["name"])
+                process.join()
+                if cancelled_at is not None:
+                    result.update(status="timeout", message="Took longer than %g s" % timeout)
+                result["seconds"] = round(time.time() - start, 3)
+                finished[result["name"]] = result
+                if report is not None:
+                    report(result)
+
+            now = time.time()
+            for name, state in running.items():
+                process, cancel_event, start, cancelled_at = state
+                if timeout and cancelled_at is None and now - start > timeout:
+                    cancel_event.set()
+                    state[3] = now
+                    continue
+                # a scenario that exits normally has already put its result on the queue; anything else is stuck
+                # after being cancelled or has crashed
+                if cancelled_at is not None and now - cancelled_at > CANCEL_GRACE:
+                    status, message = "timeout", "Took longer than %g s" % timeout
+                elif not process.is_alive() and process.exitcode != 0:
+                    status, message = "error", "Stopped unexpectedly (exit code %s)" % process.exitcode
+                else:
+                    continue
+                process.terminate()
+                process.join()
+                del running[name]
+                result = {"name": name, "status": status, "message": message, "build_seconds": 0.,
+                          "compare_seconds": 0., "seconds": round(now - start, 3), "log": ""}
+                finished[name] = result
+                if report is not None:
+                    report(result)
+    finally:
+        for process, cancel_event, start, cancelled_at in running.values():
+            process.terminate()
+        shutil.rmtree(temp_root, True)
+    return [finished[scenario["name"]] for scenario in scenarios if scenario["name"] in finished]
+
+
+def junit_xml(results):
+    """Returns results as a JUnit style XML report."""
+    suite = ElementTree.Element("testsuite", name="honeyguide", tests=str(len(results)),
+                                failures=str(sum(result["status"] == "failed" for result in results)),
+                                errors=str(sum(result["status"] in ("error", "timeout") for result in results)),
+                                time="%.3f" % sum(result["seconds"] for result in results))
+    for result in results:
+        case = ElementTree.SubElement(suite, "testcase", classname="tests.ini", name=result["name"],
+                                      time="%.3f" % result["seconds"])
+        properties = ElementTree.SubElement(case, "properties")
+        for key in ("build_seconds", "compare_seconds"):
+            ElementTree.SubElement(properties, "property", name=key, value="%.3f" % result[key])
+        if result["status"] == "failed":
+            ElementTree.SubElement(case, "failure", message=result["message"])
+        elif result["status"] != "passed":
+            ElementTree.SubElement(case, "error", type=result["status"], message=result["message"])
+        ElementTree.SubElement(case, "system-out").text = result["log"]
+    return ElementTree.tostring(suite, "utf-8")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Checks Honeyguide against the reference CWS files in tests.ini.")
+    parser.add_argument("scenarios", nargs="*", metavar="SCENARIO",
+                        help="names of the scenarios to run, ignoring case; wildcards allowed (default all)")
+    parser.add_argument("--config", default=os.path.join(".", "Tests", "tests.ini"),
+                        help="scenario file (default %(default)s)")
+    parser.add_argument("--jobs", type=int, default=multiprocessing.cpu_count(),
+                        help="scenarios to run at the same time (default one per core)")
+    parser.add_argument("--timeout", type=float, default=0.,
+                        help="fail scenarios that take more than this many seconds (default no limit)")
+    parser.add_argument("--json", metavar="FILE", help="save the results as JSON")
+    parser.add_argument("--junit", metavar="FILE", help="save the results as a JUnit style XML report")
+    args = parser.parse_args(argv)
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    try:
+        scenarios = read_scenarios(args.config)
+    except (IOError, ConfigParser.Error) as e:
+        sys.stderr.write("%s\n" % e)
+        return 2
+    if args.scenarios:
+        patterns = [pattern.lower() for pattern in args.scenarios]
+        scenarios = [scenario for scenario in scenarios
+                     if any(fnmatch.fnmatchcase(scenario["name"].lower(), pattern) for pattern in patterns)]
+        if not scenarios:
+            sys.stderr.write("No scenarios match %s\n" % " ".join(args.scenarios))
+            return 2
+
+    def report(result):
+        print("%s %s (build %.2fs, compare %.2fs)%s" %
+              (result["name"], result["status"].upper(), result["build_seconds"], result["compare_seconds"],
+               "" if result["status"] == "passed" else ": %s" % result["message"]))
+        sys.stdout.flush()
+
+    start = time.time()
+    try:
+        results = run_all(scenarios, args.jobs, args.timeout, report)
+    except KeyboardInterrupt:
+        print("Cancelled.")
+        return 1
+    passed = sum(result["status"] == "passed" for result in results)
+    print("%i of %i scenarios passed in %.2fs." % (passed, len(scenarios), time.time() - start))
+
+    if args.json:
+        with open(args.json, "w") as fout:
+            json.dump(results, fout, indent=1, sort_keys=True)
+    if args.junit:
+        with open(args.junit, "w") as fout:
+            fout.write(junit_xml(results))
+    return 0 if passed == len(scenarios) else 1
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
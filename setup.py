@@ -44,7 +44,7 @@ setup(
     # targets to build
     windows=[{"script": "honeyguide.py", "icon_resources": [(1, "icon.ico")]}],
     console=[{"script": "honeyguide_console.py", "icon_resources": [(1, "icon.ico")]}],
-    scripts=["cws_scripts.py", "workingDialog.py"],
+    scripts=["cws_scripts.py", "workingDialog.py", "previewDialog.py", "image_engine.py"],
     # extra files
     data_files=find_data_files('.', '', ['instructions.html', 'LICENSE.txt', 'ImageMagick/*'])
     )
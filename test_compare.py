@@ -0,0 +1,120 @@
+# Honeyguide - a program for injecting image stack data into CreationWorkshop CWS files.
+# test_compare.py - checks that Honeyguide.compare_cws_files compares the slices that changed on a pool of workers.
+#
+# Ben Weiss at the University of Washington
+#
+# Usage: python -m unittest test_compare
+#
+# (c) 2015 Ben Weiss
+# License: MIT License:
+#
+#    Copyright (c) 2015 Ben Weiss; parts (c) 2015 Ben Weiss, University of Washington
+#
+#
+#    Permission is hereby granted, free of charge, to any person obtaining a
+#    copy of this software and associated documentation files (the "Software"),
+#    to deal in the Software without restriction, including without limitation
+#    the rights to use, copy, modify, merge, publish, distribute, sublicense,
+#    and/or sell copies of the Software, and to permit persons to whom the
+#    Software is furnished to do so, subject to the following conditions:
+#
+#    The above copyright notice and this permission notice shall be included
+#    in all copies or substantial portions of the Software.
+#
+#    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+#    THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+#    FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+#    DEALINGS IN THE SOFTWARE.
+#
+#-------------------------------------------------------------------------------
+
+__author__ = 'Ben Weiss'
+
+import io
+import multiprocessing
+import os
+import shutil
+import StringIO
+import tempfile
+import unittest
+import zipfile
+
+import cws_scripts
+import image_engine
+
+if image_engine.available:
+    import numpy as np
+    from PIL import Image
+
+
+def slice_png(pixels, mode):
+    """Returns the contents of a png of pixels, a (H, W) uint8 array, saved in mode ('L' or 'RGB')."""
+    out = io.BytesIO()
+    Image.fromarray(pixels).convert(mode).save(out, "png")
+    return out.getvalue()
+
+
+@unittest.skipUnless(image_engine.available, "needs numpy and Pillow")
+class CompareArchivesTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.slices = [np.full((24, 32), 40 * i, np.uint8) for i in range(4)]
+        self.pools = []
+        self.real_pool = multiprocessing.Pool
+
+        def counting_pool(*args, **kwargs):
+            self.pools.append(args)
+            return self.real_pool(*args, **kwargs)
+        multiprocessing.Pool = counting_pool
+
+    def tearDown(self):
+        multiprocessing.Pool = self.real_pool
+        shutil.rmtree(self.temp_dir, True)
+
+    def write_cws(self, name, slices, mode):
+        fname = os.path.join(self.temp_dir, name + ".cws")
+        zf = zipfile.ZipFile(fname, "w")
+        for number, pixels in enumerate(slices):
+            zf.writestr("%s%04i.png" % (name, number), slice_png(pixels, mode))
+        zf.writestr(name + ".gcode", ";gcode\n")
+        zf.writestr(name + ".slicing", "slicing\n")
+        zf.writestr("manifest.xml", "<manifest />\n")
+        zf.close()
+        return fname
+
+    def compare(self, file1, file2):
+        log = StringIO.StringIO()
+        h = cws_scripts.Honeyguide(logfile=log)
+        h.echo = False
+        h.workers = 2
+        return h.compare_cws_files(file1, file2, in_process=True), log.getvalue()
+
+    def test_equivalent_slices_compared_on_pool(self):
+        # the same pixels saved as gray and as RGB: every slice's bytes differ, but none of its pixels do
+        file1 = self.write_cws("part", self.slices, "L")
+        file2 = self.write_cws("other", self.slices, "RGB")
+        same, log = self.compare(file1, file2)
+        self.assertTrue(same, log)
+        self.assertEqual(self.pools, [(2,)])
+        self.assertNotIn("Found differences", log)
+
+    def test_differences_logged_in_slice_order(self):
+        changed = list(self.slices)
+        changed[0] = changed[0] + 1
+        changed[2] = changed[2] + 1
+        file1 = self.write_cws("part", self.slices, "L")
+        file2 = self.write_cws("other", changed, "RGB")
+        same, log = self.compare(file1, file2)
+        self.assertFalse(same)
+        self.assertEqual(self.pools, [(2,)])
+        found = [line.split()[-1] for line in log.splitlines() if line.startswith("Found differences: ")]
+        diff_dir = os.path.join(self.temp_dir, "part_diff")
+        self.assertEqual(found, [os.path.join(diff_dir, "diff0000.png"), os.path.join(diff_dir, "diff0002.png")])
+        self.assertTrue(os.path.exists(found[0]))
+
+
+if __name__ == "__main__":
+    unittest.main()
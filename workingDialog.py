@@ -38,6 +38,7 @@
 __author__ = 'Ben Weiss'
 
 import sys
+import Queue
 import ttk
 import cws_scripts as cws
 
@@ -50,6 +51,8 @@ class Working(ttk.Frame):
         self.cws = None
         self.cancelled = False
         self.logfile = logfile
+        self.events = Queue.Queue()     # ProgressEvents from the job's thread, waiting for the Tk thread
+        self.check_id = None            # the after() id of the next scheduled check(), if any
 
         ttk.Frame.__init__(self, master, padding="5 5 12 12")
         self.master.title('Working')
@@ -87,52 +90,69 @@ class Working(ttk.Frame):
             self.cancelled = True
 
     def go(self, cws_obj, template_cws, input_image, output_cws):
-        """Runs the Honeyguide operation on a background thread, updating the progressbar and the status every 100 ms.
-        """
+        """Runs the Honeyguide operation on a background thread, showing its progress events (see
+        Honeyguide.subscribe) as they come."""
         self.cws = cws_obj
         self.cancelled = False
         self.v_cancel_text.set("Cancel")
         self.v_info.set("Working...")
         self.v_progress.set(0)
-        cws_obj.do_honeyguide_background(template_cws, input_image, output_cws)
-
-        self.after(100, self.check)
+        self.events = Queue.Queue()
+        cws_obj.subscribe(self.progress_event, 0.1)
+        if not cws_obj.do_honeyguide_background(template_cws, input_image, output_cws):
+            cws_obj.unsubscribe(self.progress_event)
+            self.cws = None
+            self.v_info.set("Couldn't start the job.")
+            self.v_cancel_text.set("Close")
+            return
+        if self.check_id is not None:
+            self.after_cancel(self.check_id)
+        self.check_id = self.after(100, self.check)
+
+    def progress_event(self, event):
+        """Subscriber for the job's ProgressEvents. Runs on the job's thread, so it only queues the event for check()
+        to pick up on the Tk thread."""
+        self.events.put(event)
 
     def check(self):
-        """Checks on the background task and updates the UI as needed"""
+        """Shows the latest of the progress events queued since the last check, and finishes up once the job's done.
+        Reschedules itself every 100 ms until then."""
+        self.check_id = None
         if self.cws is None:
-            return      # we're done.
-
-        # honeyguide stores its messages in a queue, returing the oldest. We'll drain the queue each time so we
-        # get the most current one.
-        last_message = new_message = self.cws.status_message()
-        while new_message != "":
-            last_message = new_message
-            new_message = self.cws.status_message()
-        if last_message != "":
-            self.v_info.set(last_message)
-
-        # get the status and update the progress bar
+            return
+        event = None
+        try:
+            while True:
+                event = self.events.get_nowait()
+        except Queue.Empty:
+            pass
+        if event is not None:
+            self.v_info.set(cws.progress_text(event))
+            self.v_progress.set(int(event.percent))
+        if event is None or not event.done:
+            self.check_id = self.after(100, self.check)
+            return
+
+        self.cws.unsubscribe(self.progress_event)
         done, success, message, percent = self.cws.status_check()
-        self.v_progress.set(int(percent))
-
-        if done:
-            self.cws = None
-            self.v_info.set(message)
-            if success or self.cancelled:
-                self.v_cancel_text.set("Close")
-            else:
-                tkMessageBox.showerror("Error", "Conversion failed with the following error:\n%s" % message,
-                                       parent=self.winfo_toplevel())
-                self.close()
+        self.cws = None
+        self.v_info.set(message)
+        if success or self.cancelled:
+            self.v_cancel_text.set("Close")
         else:
-            self.after(100, self.check)
+            tkMessageBox.showerror("Error", "Conversion failed with the following error:\n%s" % message,
+                                   parent=self.winfo_toplevel())
+            self.close()
 
     def close(self):
         # Just hide this window. It will get destroyed when we close down the program.
         if self.cws is not None:
             self.cancel()
+            self.cws.unsubscribe(self.progress_event)
         self.cws = None
+        if self.check_id is not None:
+            self.after_cancel(self.check_id)
+            self.check_id = None
         self.master.withdraw()
 
 # only run this file for testing/layout purposes!!!